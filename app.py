@@ -4,126 +4,544 @@
 API Flask para o Classificador ASCOD/TOAST
 """
 
-from flask import Flask, request, jsonify, render_template, g
+from flask import Blueprint, Flask, Response, request, jsonify, render_template, stream_with_context
 from flask_cors import CORS
 import os
 import sys
 import re
 import json
-from dataclasses import fields
-from ascod_classifier import ASCODClassifier, PatientData
-import google.generativeai as genai
+import time
+import datetime
+import threading
+from contextlib import nullcontext
+from dataclasses import dataclass, replace
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from typing import Optional
+from typing import Dict, Optional
 
-# Carrega variáveis de ambiente
+# Carrega variáveis de ambiente (única chamada do processo, antes dos módulos que leem a configuração na importação)
 load_dotenv()
 
-app = Flask(__name__)
-CORS(app)
+from history import HistoryWriter
+from job_queue import JobQueue
+from metrics import metrics
+from model_backends import preload_sdk
+from resilience import transient_errors
+from note_trimmer import NoteTrimmer
+from text_extractor import Extraction, TextExtractor
+from ascod_classifier import AIAnalysis, ASCODClassifier, ASCODRuleEngine, PartialResultParser, PatientData, TierEscalation, TOAST_CLASSES
 
-# Carrega a chave da API e inicializa o classificador
+api = Blueprint('ascod', __name__)
+
+# Carrega a chave da API; o classificador é criado uma vez por processo (get_classifier)
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-if not GEMINI_API_KEY:
-    print("AVISO: Chave da API Gemini não encontrada. A análise por IA estará desabilitada.")
-    classifier = None
-else:
-    try:
-        classifier = ASCODClassifier(api_key=GEMINI_API_KEY)
-    except Exception as e:
-        print(f"Erro ao inicializar o classificador: {e}")
-        classifier = None
+# O simulador e a reprodução de respostas gravadas dispensam a chave da API
+REQUIRES_API_KEY = os.getenv('ASCOD_BACKEND', 'gemini') == 'gemini' and not (
+    os.getenv('ASCOD_RECORD_DIR') and os.getenv('ASCOD_RECORD_MODE', 'replay') == 'replay'
+)
+# Warm-up com uma chamada leve ao modelo (count_tokens) ao subir o worker
+WARMUP_MODEL_CALL = os.getenv('ASCOD_WARMUP_MODEL', 'true').lower() in ['true', '1', 'on']
+
+_classifier = None
+_classifier_ready = False
+_classifier_lock = threading.Lock()
+
+def get_classifier() -> Optional[ASCODClassifier]:
+    """Classificador único do processo, criado no primeiro uso; None sem chave da API ou se a criação falhar."""
+    global _classifier, _classifier_ready
+    if _classifier_ready:
+        return _classifier
+    with _classifier_lock:
+        if not _classifier_ready:
+            if REQUIRES_API_KEY and not GEMINI_API_KEY:
+                print("AVISO: Chave da API Gemini não encontrada. A análise por IA estará desabilitada.")
+            else:
+                try:
+                    _classifier = ASCODClassifier(api_key=GEMINI_API_KEY)
+                except Exception as e:
+                    print(f"Erro ao inicializar o classificador: {e}")
+            _classifier_ready = True
+    return _classifier
 
-def get_classifier():
-    """Cria uma instância do classificador por request."""
-    if 'classifier' not in g:
-        g.classifier = ASCODClassifier()
-    return g.classifier
+def preload():
+    """Importações pesadas feitas uma única vez no master do gunicorn (preload_app), herdadas pelos workers."""
+    preload_sdk()
+    transient_errors()
 
-@app.route('/')
+def warm_up():
+    """
+    Prepara o processo antes da primeira requisição (post_worker_init do gunicorn):
+    classificador, motor de regras e varredor da fila de jobs.
+    """
+    start = time.perf_counter()
+    job_queue.start()
+    rule_engine.evaluate(PatientData(stenosis=70, c1_afib_documented=True))
+    classifier = get_classifier()
+    if classifier:
+        classifier.warm_up(model_call=WARMUP_MODEL_CALL)
+    print(f"Worker {os.getpid()} pronto em {(time.perf_counter() - start) * 1000:.0f} ms")
+
+@api.route('/')
 def index():
     """Serve a página principal"""
     return render_template('index.html')
 
-@app.route('/api/analyze', methods=['POST'])
-def analyze():
-    if not classifier:
-        return jsonify({'success': False, 'error': 'Classificador de IA não inicializado. Verifique a chave da API.'}), 500
+ENGINES = ('rules', 'ai', 'hybrid')
+# Chaves do corpo da requisição que não são campos de PatientData
+REQUEST_OPTIONS = ('type', 'engine', 'no_cache', 'complex')
+rule_engine = ASCODRuleEngine()
 
-    data = request.get_json()
-    if not data:
-        return jsonify({'success': False, 'error': 'Requisição inválida.'}), 400
+# Pool compartilhado para /api/analyze/batch; limita as análises simultâneas por processo
+BATCH_CONCURRENCY = int(os.getenv('ASCOD_BATCH_CONCURRENCY', 8))
+BATCH_MAX_CASES = int(os.getenv('ASCOD_BATCH_MAX_CASES', 500))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix='ascod-batch')
+
+# Com o modelo indisponível, entradas estruturadas são classificadas pelo motor de regras
+FALLBACK_TO_RULES = os.getenv('ASCOD_FALLBACK_TO_RULES', 'true').lower() in ['true', '1', 'on']
+# Status HTTP para cada tipo de falha do modelo (AIAnalysis.failure)
+FAILURE_STATUS = {'circuit_open': 503, 'deadline': 504, 'upstream': 502, 'invalid': 502}
+
+# Texto livre com extração local confiável vai para o motor de regras, sem chamada ao modelo
+TEXT_ROUTING = os.getenv('ASCOD_TEXT_ROUTING', 'false').lower() in ['true', '1', 'on']
+TEXT_MIN_CONFIDENCE = float(os.getenv('ASCOD_TEXT_MIN_CONFIDENCE', 0.9))
+text_extractor = TextExtractor()
+# Notas longas enviadas ao modelo ficam com as frases relevantes, até ASCOD_TEXT_TOKEN_BUDGET tokens
+note_trimmer = NoteTrimmer()
+
+def run_ai(analysis_input, use_cache=True, complex_case=False, patient=None):
+    """Executa a análise por IA e retorna o resultado validado (None em caso de falha) e os metadados da chamada."""
+    analysis = get_classifier().analyze(analysis_input, use_cache=use_cache, complex_case=complex_case, patient=patient)
+    return analysis.result, analysis
+
+@dataclass
+class AnalysisRequest:
+    """Entrada já validada de uma análise."""
+    analysis_input: str
+    natural_language_prompt: str
+    patient_data: Optional[PatientData]
+    engine: str
+    use_cache: bool
+    # Envia o caso direto ao modelo pro (roteamento em camadas)
+    complex_case: bool = False
+    # Extração local do texto livre (ASCOD_TEXT_ROUTING)
+    extraction: Optional[Extraction] = None
+    # Quanto da nota foi podado antes do envio ao modelo (None se coube no orçamento)
+    trimming: Optional[Dict] = None
+
+def parse_analysis_request(data, validate_only=False):
+    """
+    Valida o corpo da requisição; retorna (AnalysisRequest, None) ou (None, (payload, status)).
+    validate_only (POST /api/jobs) só valida: sem métricas, sem poda e sem extração, exceto
+    quando ela decide se o texto pode ir ao motor de regras sem o classificador de IA.
+    """
+    time_stage = (lambda stage: nullcontext()) if validate_only else metrics.time_stage
+    if not isinstance(data, dict) or not data:
+        return None, ({'success': False, 'error': 'Requisição inválida.'}, 400)
 
     analysis_input = ""
     natural_language_prompt = ""
+    patient_data = None
+    extraction = None
 
     if data.get('type') == 'structured':
-        # Remove o 'type' para não passar para o dataclass
-        form_data = data.copy()
-        form_data.pop('type', None)
-        
-        # Converte os valores para os tipos corretos
-        for field in fields(PatientData):
-            if field.name in form_data:
-                # Converte strings de números para int
-                if field.type == Optional[int] and isinstance(form_data[field.name], str):
-                    try:
-                        form_data[field.name] = int(form_data[field.name])
-                    except (ValueError, TypeError):
-                        form_data[field.name] = None
-                # Garante que os booleanos sejam booleanos
-                elif field.type == bool:
-                    form_data[field.name] = str(form_data[field.name]).lower() in ['true', '1', 'on']
-
         try:
-            patient_data = PatientData(**form_data)
-            natural_language_prompt = patient_data.to_natural_language()
+            with time_stage('coercion'):
+                # Remove o 'type' e as opções da análise para não passar para o dataclass
+                form_data = data.copy()
+                for option in REQUEST_OPTIONS:
+                    form_data.pop(option, None)
+                patient_data = PatientData.from_form(form_data)
+            with time_stage('to_natural_language'):
+                natural_language_prompt = patient_data.to_natural_language()
             analysis_input = natural_language_prompt
         except TypeError as e:
-            return jsonify({'success': False, 'error': f'Dados do formulário inválidos: {e}'}), 400
+            return None, ({'success': False, 'error': f'Dados do formulário inválidos: {e}'}, 400)
 
     elif data.get('type') == 'text':
         analysis_input = data.get('text', '')
         natural_language_prompt = analysis_input
     
     else:
-        return jsonify({'success': False, 'error': 'Tipo de análise inválido.'}), 400
+        return None, ({'success': False, 'error': 'Tipo de análise inválido.'}, 400)
 
     if not analysis_input:
-        return jsonify({'success': False, 'error': 'Nenhuma informação para análise.'}), 400
+        return None, ({'success': False, 'error': 'Nenhuma informação para análise.'}, 400)
+
+    if TEXT_ROUTING and data.get('type') == 'text' and not data.get('engine') and not (validate_only and get_classifier()):
+        with time_stage('text_extraction'):
+            extraction = text_extractor.extract(analysis_input)
+        route = 'rules' if extraction.confidence >= TEXT_MIN_CONFIDENCE else 'ai'
+        if not validate_only:
+            metrics.inc('ascod_text_routing_total', {'route': route})
+        if route == 'rules':
+            patient_data = extraction.patient()
+
+    # Entrada estruturada (ou texto extraído com confiança) usa o motor de regras local por padrão
+    engine = data.get('engine') or ('rules' if patient_data else 'ai')
+    if engine not in ENGINES:
+        return None, ({'success': False, 'error': f'Motor de análise inválido: {engine}. Use rules, ai ou hybrid.'}, 400)
+    if engine in ('rules', 'hybrid') and not patient_data:
+        return None, ({'success': False, 'error': 'O motor de regras requer entrada estruturada.'}, 400)
+    if engine in ('ai', 'hybrid') and not get_classifier():
+        return None, ({'success': False, 'error': 'Classificador de IA não inicializado. Verifique a chave da API.'}, 500)
+
+    trimming = None
+    if not patient_data and not validate_only:
+        with metrics.time_stage('note_trimming'):
+            trimmed = note_trimmer.trim(analysis_input)
+        if trimmed.trimmed:
+            analysis_input = natural_language_prompt = trimmed.text
+            trimming = trimmed.to_dict()
+            metrics.inc('ascod_trimmed_tokens_total', amount=trimming['removed_tokens'])
+
+    # Flag explícita para ignorar o cache de respostas
+    use_cache = str(data.get('no_cache', False)).lower() not in ['true', '1', 'on']
+    complex_case = str(data.get('complex', False)).lower() in ['true', '1', 'on']
+
+    return AnalysisRequest(analysis_input, natural_language_prompt, patient_data, engine, use_cache, complex_case, extraction, trimming), None
+
+def build_final_response(req, result, analysis=None, extra=None):
+    """Monta a resposta final a partir do ClassificationResult e dos campos adicionais."""
+    return {
+        'success': True,
+        'engine': req.engine,
+        'cached': analysis.cached if analysis else False,
+        'coalesced': analysis.coalesced if analysis else False,
+        'usage': analysis.usage if analysis else None,
+        'prompt_size': analysis.prompt_size if analysis else None,
+        'model': analysis.model if analysis else None,
+        'tier': analysis.tier if analysis else None,
+        'escalation': analysis.escalation if analysis else None,
+        'repairs': analysis.repairs if analysis else None,
+        'split': analysis.split if analysis else None,
+        'near_duplicate': analysis.near_duplicate if analysis else None,
+        'trimming': req.trimming,
+        'extraction': req.extraction.to_dict() if req.extraction else None,
+        'ascod_code': result.ascod_code,
+        'toast_code': result.toast_code,
+        'natural_language_prompt': req.natural_language_prompt,
+        **result.to_dict(),  # Mescla 'ascod' e 'toast' na resposta principal
+        **(extra or {})
+    }
+
+def handle_ai_failure(req, analysis):
+    """Resposta para uma análise sem retorno do modelo: motor de regras ou erro 502/503/504."""
+    if FALLBACK_TO_RULES and req.patient_data:
+        extra = {'fallback': {'from': req.engine, 'reason': analysis.failure}}
+        payload = build_final_response(replace(req, engine='rules'), rule_engine.evaluate(req.patient_data), extra=extra)
+        return payload, 200
+    if analysis.failure == 'invalid':
+        error = 'Resposta inválida do modelo de IA: ' + '; '.join(analysis.problems or [])
+    else:
+        error = 'Modelo de IA indisponível: ' + '; '.join(analysis.problems or [])
+    payload = {'success': False, 'engine': req.engine, 'failure': analysis.failure, 'error': error}
+    return payload, FAILURE_STATUS.get(analysis.failure, 502)
+
+def combine_results(req, ai_result=None):
+    """Combina o motor de regras e a IA conforme o engine escolhido; retorna (resultado, campos adicionais)."""
+    if req.engine == 'ai':
+        return ai_result, None
+    result = rule_engine.evaluate(req.patient_data)
+    if req.engine == 'hybrid':
+        # Segunda opinião da IA, mantendo o resultado determinístico como principal
+        return result, {'second_opinion': {
+            'ascod_code': ai_result.ascod_code,
+            'toast_code': ai_result.toast_code,
+            **ai_result.to_dict()
+        }}
+    return result, None
+
+def record_request(data, payload, status, started=None):
+    """Conta a análise em ascod_requests_total e enfileira as bem-sucedidas para o histórico."""
+    data = data if isinstance(data, dict) else {}
+    if status < 400:
+        history.record(data, payload, (time.perf_counter() - started) * 1000 if started else None)
+    if status >= 500:
+        outcome = 'error'
+    elif status >= 400:
+        outcome = 'invalid'
+    else:
+        outcome = 'success' if payload.get('success') else 'error'
+    metrics.inc('ascod_requests_total', {
+        'type': data.get('type') if data.get('type') in ('structured', 'text') else 'unknown',
+        'engine': payload.get('engine') or 'none',
+        'outcome': outcome,
+    })
+
+def run_analysis(data):
+    """Executa uma análise completa e retorna (payload, status HTTP)."""
+    started = time.perf_counter()
+    payload, status = _run_analysis(data)
+    record_request(data, payload, status, started)
+    return payload, status
+
+def _run_analysis(data):
+    req, error = parse_analysis_request(data)
+    if error:
+        return error
 
     try:
-        # A resposta da IA já é uma string JSON
-        ai_response_str = classifier.analyze_with_ai(analysis_input)
-        ai_result = json.loads(ai_response_str)
-
-        # Constrói o código ASCOD e TOAST
-        ascod_code = "N/A"
-        toast_code = "N/A"
-
-        if 'ascod' in ai_result:
-            ascod_grades = [ai_result['ascod'].get(cat, {}).get('grade', '9') for cat in ['A', 'S', 'C', 'O', 'D']]
-            ascod_code = ''.join(f"{letter}{grade}" for letter, grade in zip(['A','S','C','O','D'], ascod_grades))
-
-        if 'toast' in ai_result:
-            toast_code = ai_result['toast'].get('classification', 'Indeterminado')
-
-
-        # Monta a resposta final, mesclando o resultado da IA
-        final_response = {
-            'success': True,
-            'ascod_code': ascod_code,
-            'toast_code': toast_code,
-            'natural_language_prompt': natural_language_prompt,
-            **ai_result  # Mescla o dicionário da IA na resposta principal
-        }
-        
-        return jsonify(final_response)
-
-    except json.JSONDecodeError:
-        return jsonify({'success': False, 'error': 'Falha ao decodificar a resposta da IA. Resposta recebida: ' + ai_response_str}), 500
+        ai_result, analysis = None, None
+        if req.engine in ('ai', 'hybrid'):
+            ai_result, analysis = run_ai(req.analysis_input, req.use_cache, req.complex_case, req.patient_data)
+            if analysis.failure:
+                return handle_ai_failure(req, analysis)
+        result, extra = combine_results(req, ai_result)
+        return build_final_response(req, result, analysis, extra), 200
+
     except Exception as e:
-        return jsonify({'success': False, 'error': f'Erro inesperado durante a análise: {str(e)}'}), 500
+        return {'success': False, 'error': f'Erro inesperado durante a análise: {str(e)}'}, 500
+
+# Histórico das classificações, gravado por uma thread em segundo plano (GET /api/history)
+history = HistoryWriter()
+
+# Jobs persistentes executados em segundo plano (POST /api/jobs)
+job_queue = JobQueue(handler=run_analysis)
+
+def sse_event(event, data):
+    """Formata um evento Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@api.route('/api/analyze', methods=['POST'])
+def analyze():
+    payload, status = run_analysis(request.get_json())
+    return jsonify(payload), status
+
+@api.route('/api/analyze/stream', methods=['POST'])
+def analyze_stream():
+    """Classificação com Server-Sent Events: progresso, graus parciais e, por fim, o mesmo payload de /api/analyze."""
+    data = request.get_json()
+    req, error = parse_analysis_request(data)
+    if error:
+        payload, status = error
+        record_request(data, payload, status)
+        return jsonify(payload), status
+
+    def generate():
+        started = time.perf_counter()
+        yield sse_event('progress', {'stage': 'started', 'engine': req.engine})
+        if req.engine == 'rules':
+            result, extra = combine_results(req)
+            payload = build_final_response(req, result, extra=extra)
+            record_request(data, payload, 200, started)
+            yield sse_event('final', payload)
+            return
+
+        parser = PartialResultParser()
+        analysis = None
+        received = 0
+        yield sse_event('progress', {'stage': 'model'})
+        for item in get_classifier().analyze_stream(req.analysis_input, use_cache=req.use_cache, complex_case=req.complex_case,
+                                                    patient=req.patient_data):
+            if isinstance(item, AIAnalysis):
+                analysis = item
+                break
+            if isinstance(item, TierEscalation):
+                # A resposta do modelo rápido foi descartada; os graus parciais recomeçam com o pro
+                parser = PartialResultParser()
+                received = 0
+                yield sse_event('progress', {'stage': 'escalated', 'reasons': item.reasons})
+                continue
+            received += len(item)
+            yield sse_event('progress', {'stage': 'receiving', 'chars': received})
+            for event in parser.feed(item):
+                yield sse_event(event.pop('event'), event)
+
+        if analysis.failure:
+            payload, status = handle_ai_failure(req, analysis)
+            record_request(data, payload, status, started)
+            yield sse_event('final' if payload['success'] else 'error', payload)
+            return
+
+        try:
+            result, extra = combine_results(req, analysis.result)
+            payload = build_final_response(req, result, analysis, extra)
+            record_request(data, payload, 200, started)
+            yield sse_event('final', payload)
+        except Exception as e:
+            payload = {'success': False, 'error': f'Erro inesperado durante a análise: {str(e)}'}
+            record_request(data, payload, 500)
+            yield sse_event('error', payload)
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=headers)
+
+@api.route('/api/stats', methods=['GET'])
+def stats():
+    """Contadores de economia de chamadas ao modelo (agregados entre workers)."""
+    classifier = get_classifier()
+    if not classifier:
+        return jsonify({'success': False, 'error': 'Classificador de IA não inicializado. Verifique a chave da API.'}), 500
+    counters = classifier.cache.counters() if classifier.cache else {}
+    return jsonify({
+        'success': True,
+        'coalesced_requests': counters.get('coalesced_requests', classifier.flights.coalesced),
+        'coalesced_requests_this_worker': classifier.flights.coalesced,
+    })
+
+@api.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Métricas no formato de exposição do Prometheus, somadas entre todos os workers."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@api.route('/api/jobs', methods=['POST'])
+def create_job():
+    """Enfileira uma análise e retorna o id do job imediatamente."""
+    data = request.get_json()
+    # Valida a entrada antes de enfileirar, para que erros do usuário não virem jobs
+    _, error = parse_analysis_request(data, validate_only=True)
+    if error:
+        payload, status = error
+        return jsonify(payload), status
+
+    job_id = job_queue.submit(data)
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': f'/api/jobs/{job_id}',
+    }), 202
+
+@api.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Retorna o status e, quando concluído, o resultado do job."""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job não encontrado.'}), 404
+    return jsonify({'success': True, **job})
+
+# Filtros do histórico: grau por categoria (ex.: C1) e código ASCOD completo
+HISTORY_GRADE_RE = re.compile(r'^([ASCOD])([01239])$')
+HISTORY_CODE_RE = re.compile(r'^A[01239]S[01239]C[01239]O[01239]D[01239]$')
+
+def parse_history_time(value):
+    """Data ISO (2026-10-01 ou 2026-10-01T08:00) ou epoch em segundos."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+def parse_history_filters(args):
+    """Converte os parâmetros de /api/history em filtros; retorna (filtros, None) ou (None, erro)."""
+    filters = {'grades': {}}
+    for value in args.getlist('ascod'):
+        for part in value.replace(',', ' ').split():
+            match = HISTORY_GRADE_RE.match(part.upper())
+            if not match:
+                return None, f'Filtro ASCOD inválido: {part}. Use categoria e grau, ex.: C1.'
+            filters['grades'][match.group(1)] = int(match.group(2))
+    if args.get('code'):
+        if not HISTORY_CODE_RE.match(args['code'].upper()):
+            return None, f"Código ASCOD inválido: {args['code']}."
+        filters['ascod_code'] = args['code'].upper()
+    if args.get('toast'):
+        if args['toast'].lower() not in TOAST_CLASSES:
+            return None, f"Classe TOAST inválida: {args['toast']}. Use {', '.join(TOAST_CLASSES)}."
+        filters['toast'] = args['toast'].lower()
+    for name in ('input_hash', 'engine', 'model'):
+        if args.get(name):
+            filters[name] = args[name]
+
+    period = args.get('period')
+    if period:
+        today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        starts = {'today': today, 'week': today - datetime.timedelta(days=today.weekday()), 'month': today.replace(day=1)}
+        if period not in starts:
+            return None, 'Período inválido. Use today, week ou month.'
+        filters['since'] = starts[period].timestamp()
+    try:
+        if args.get('since'):
+            filters['since'] = parse_history_time(args['since'])
+        if args.get('until'):
+            filters['until'] = parse_history_time(args['until'])
+        if args.get('cursor'):
+            filters['before_id'] = int(args['cursor'])
+    except ValueError as e:
+        return None, f'Parâmetro inválido: {e}'
+    return filters, None
+
+def parse_limit(args, default):
+    try:
+        return max(1, int(args.get('limit', default)))
+    except ValueError:
+        return default
+
+@api.route('/api/history', methods=['GET'])
+def list_history():
+    """Classificações gravadas, mais recentes primeiro, com filtros e paginação por cursor."""
+    filters, error = parse_history_filters(request.args)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    items, next_cursor = history.store.query(filters, parse_limit(request.args, 50))
+    return jsonify({'success': True, 'count': len(items), 'items': items, 'next_cursor': next_cursor})
+
+@api.route('/api/history/export', methods=['GET'])
+def export_history():
+    """Todas as classificações que atendem aos filtros em NDJSON, lidas e enviadas em páginas."""
+    filters, error = parse_history_filters(request.args)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    limit = parse_limit(request.args, None) if request.args.get('limit') else None
+
+    def generate():
+        for item in history.store.iterate(filters, limit=limit):
+            yield json.dumps(item, ensure_ascii=False) + '\n'
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@api.route('/api/history/<int:entry_id>', methods=['GET'])
+def get_history_entry(entry_id):
+    """Uma classificação gravada, com a entrada, o prompt e a saída completos."""
+    item = history.store.get(entry_id)
+    if item is None:
+        return jsonify({'success': False, 'error': 'Registro não encontrado.'}), 404
+    return jsonify({'success': True, **item})
+
+@api.route('/api/analyze/batch', methods=['POST'])
+def analyze_batch():
+    """Classifica uma lista de casos em paralelo, com concorrência limitada."""
+    data = request.get_json()
+    cases = data.get('cases') if isinstance(data, dict) else None
+    if not isinstance(cases, list) or not cases:
+        return jsonify({'success': False, 'error': 'Envie uma lista não vazia em "cases".'}), 400
+    if len(cases) > BATCH_MAX_CASES:
+        return jsonify({'success': False, 'error': f'Máximo de {BATCH_MAX_CASES} casos por lote.'}), 400
+
+    def run_item(index, case):
+        # Erros de um item não derrubam o lote inteiro
+        try:
+            payload, status = run_analysis(case)
+        except Exception as e:
+            payload, status = {'success': False, 'error': f'Erro inesperado durante a análise: {str(e)}'}, 500
+        return {'index': index, 'status': status, **payload}
+
+    futures = [batch_executor.submit(run_item, i, case) for i, case in enumerate(cases)]
+
+    if data.get('stream') or request.accept_mimetypes.best == 'application/x-ndjson':
+        # NDJSON: cada resultado é enviado assim que fica pronto
+        def generate():
+            for future in as_completed(futures):
+                yield json.dumps(future.result(), ensure_ascii=False) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    results = [future.result() for future in futures]
+    succeeded = sum(1 for item in results if item['success'])
+    return jsonify({
+        'success': True,
+        'total': len(results),
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'results': results,
+    })
+
+def create_app() -> Flask:
+    """Cria a aplicação Flask; as rotas ficam no blueprint e o classificador é criado sob demanda."""
+    flask_app = Flask(__name__)
+    CORS(flask_app)
+    flask_app.register_blueprint(api)
+    return flask_app
+
+# Instância usada por gunicorn app:app, Vercel e o test client
+app = create_app()
 
 if __name__ == '__main__':
     # Cria diretório templates se não existir
@@ -132,4 +550,5 @@ if __name__ == '__main__':
     os.makedirs('static/css', exist_ok=True)
     os.makedirs('static/js', exist_ok=True)
     
+    warm_up()
     app.run(debug=True, port=int(os.getenv("PORT", 5000))) 
\ No newline at end of file
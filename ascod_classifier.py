@@ -6,24 +6,24 @@ Versão Python com integração Google Gemini
 """
 
 import os
-import sys
+import re
 import json
 import time
-import requests
-from dataclasses import dataclass, asdict, fields
-from typing import Dict, List, Optional, Tuple
-from enum import Enum
-from dotenv import load_dotenv
-import google.generativeai as genai
-
-# Carrega variáveis de ambiente
-load_dotenv()
-
-# Configuração da API Gemini
-GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
-if not GEMINI_API_KEY:
-    print("⚠️  AVISO: Variável de ambiente GEMINI_API_KEY não configurada!")
-    print("   Configure a chave da API no arquivo .env ou como variável de ambiente.")
+import asyncio
+import dataclasses
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, fields
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from metrics import metrics
+from model_backends import DEFAULT_MODEL_NAME, FAST_MODEL_NAME, ModelResponse, UpstreamTimeout, create_backend
+from prompt_builder import AssembledPrompt, PromptBuilder
+from resilience import CallPolicy, CircuitOpenError, Deadline, DeadlineExceeded, transient_errors
+from near_duplicates import NearDuplicateIndex
+from result_cache import ResultCache, hash_text
+from singleflight import SingleFlight
+
+# O .env é carregado pelos pontos de entrada (app.py e a CLI abaixo), uma única vez por processo
 # A URL da API é gerenciada pela biblioteca google-generativeai, então a construção manual foi removida.
 
 # Prompt do sistema ASCOD
@@ -307,6 +307,12 @@ Conclusão: [Breve explicação de como os dados do paciente se encaixam no crit
 """
 # Fim do ASCOD_SYSTEM_INSTRUCTION
 
+# Padrão do infarto repetido nos resumos por categoria que dependem dele (modo dividido)
+INFARCT_PATTERNS = {
+    'subcortical_small_lacunar': 'Infarto subcortical lacunar <1.5cm',
+    'cortical_large': 'Infarto cortical ou >1.5cm',
+}
+
 
 @dataclass
 class PatientData:
@@ -354,9 +360,53 @@ class PatientData:
     d2_weak_evidence: bool = False
     d0_dissection_excluded: bool = False # Adicionado para exclusão explícita
 
+    @classmethod
+    def from_form(cls, form_data: Dict) -> 'PatientData':
+        """
+        Cria o PatientData a partir de valores de formulário (strings), como no /api/analyze.
+        Campos desconhecidos geram TypeError.
+        """
+        form_data = dict(form_data)
+        # Converte os valores para os tipos corretos
+        for field in fields(cls):
+            if field.name in form_data:
+                # Converte strings de números para int
+                if field.type == Optional[int] and isinstance(form_data[field.name], str):
+                    try:
+                        form_data[field.name] = int(form_data[field.name])
+                    except (ValueError, TypeError):
+                        form_data[field.name] = None
+                # Garante que os booleanos sejam booleanos
+                elif field.type == bool:
+                    form_data[field.name] = str(form_data[field.name]).lower() in ['true', '1', 'on']
+        return cls(**form_data)
+
     def to_natural_language(self):
         """Gera um texto em linguagem natural a partir dos dados estruturados."""
-        parts = []
+        parts = [block for block in self._category_blocks().values() if block]
+        if not parts:
+            return "Nenhuma informação clínica fornecida."
+        return "Resumo clínico do paciente: " + " ".join(parts)
+
+    def category_summary(self, category: str) -> str:
+        """
+        Resumo só com os dados de uma categoria (modo dividido). Depende apenas dos campos
+        que alimentam a categoria: a mudança de outro campo não altera o prompt dela.
+        """
+        block = self._category_blocks()[category]
+        if category == 'A' and self.infarct_type in INFARCT_PATTERNS:
+            # O padrão do infarto indica se a estenose ipsilateral pode ser a causa (A1 x A2/A3)
+            block = f"{block} {INFARCT_PATTERNS[self.infarct_type]}." if block else None
+        if category == 'C' and self.infarct_type == 'cortical_large':
+            # O padrão do infarto entra nos critérios de FOP (C2/C3)
+            block = f"{block} {INFARCT_PATTERNS['cortical_large']}." if block else None
+        if not block:
+            return f"Nenhuma informação clínica fornecida sobre {CATEGORY_NAMES[category]}."
+        return "Resumo clínico do paciente: " + block
+
+    def _category_blocks(self) -> Dict[str, Optional[str]]:
+        """Frase de cada categoria ASCOD (None quando não há dados)."""
+        parts = {}
 
         # Aterosclerose (A)
         a_parts = []
@@ -372,7 +422,7 @@ class PatientData:
         if self.a1_aortic_mobile_thrombus: a_parts.append("Trombo móvel no arco aórtico (A1)")
         if self.a2_aortic_plaque_ge_4mm: a_parts.append("Placa aórtica >=4mm sem componente móvel (A2)")
         if self.a3_history_mi_pad: a_parts.append("História de IAM ou Doença Arterial Periférica (A3)")
-        if a_parts: parts.append(f"Aterosclerose: {'; '.join(a_parts)}.")
+        parts['A'] = f"Aterosclerose: {'; '.join(a_parts)}." if a_parts else None
 
         # Doença de Pequenos Vasos (S)
         s_parts = []
@@ -386,7 +436,7 @@ class PatientData:
         if self.s1_lacunar_infarct_syndrome: s_parts.append("Apresentou síndrome lacunar clínica clássica (S1)")
         if self.s1_lacunar_plus_severe_leuko: s_parts.append("Associado a leucoaraiose grave / Fazekas III (S1)")
         if self.s3_severe_leuko_isolated: s_parts.append("Leucoaraiose grave isolada (S3)")
-        if s_parts: parts.append(f"Pequenos Vasos: {'; '.join(s_parts)}.")
+        parts['S'] = f"Pequenos Vasos: {'; '.join(s_parts)}." if s_parts else None
 
         # Cardiopatia (C)
         c_parts = []
@@ -403,7 +453,7 @@ class PatientData:
         if self.c1_pfo_pe_dvt: c_parts.append("FOP com TEP/TVP prévio (C1)")
         if self.c2_pfo_asa: c_parts.append("FOP com Aneurisma de Septo Atrial (C2)")
         if self.c3_pfo_isolated: c_parts.append("FOP isolado (C3)")
-        if c_parts: parts.append(f"Cardiopatia: {'; '.join(c_parts)}.")
+        parts['C'] = f"Cardiopatia: {'; '.join(c_parts)}." if c_parts else None
 
         # Outras Causas (O)
         o_parts = []
@@ -415,82 +465,1263 @@ class PatientData:
         if self.o2_migraine_with_aura: o_parts.append("Enxaqueca com aura e déficit prolongado (O2)")
         if self.o3_malignancy: o_parts.append("Malignidade com hipercoagulação (O3)")
         if self.o0_other_causes_excluded: o_parts.append("Investigação para outras causas raras foi negativa (sugestivo de O0)")
-        if o_parts: parts.append(f"Outras Causas: {'; '.join(o_parts)}.")
+        parts['O'] = f"Outras Causas: {'; '.join(o_parts)}." if o_parts else None
 
         # Dissecção (D)
         d_parts = []
         if self.d1_direct: d_parts.append("Demonstração direta de hematoma mural (D1)")
         if self.d2_weak_evidence: d_parts.append("Evidência fraca de dissecção (clínica, Horner) (D2)")
         if self.d0_dissection_excluded: d_parts.append("Avaliação vascular completa excluiu dissecção (sugestivo de D0)")
-        if d_parts: parts.append(f"Dissecção: {'; '.join(d_parts)}.")
-        
-        if not parts:
-            return "Nenhuma informação clínica fornecida."
-        return "Resumo clínico do paciente: " + " ".join(parts)
+        parts['D'] = f"Dissecção: {'; '.join(d_parts)}." if d_parts else None
+        return parts
+
+
+# Ordem canônica das categorias ASCOD
+ASCOD_CATEGORIES = ['A', 'S', 'C', 'O', 'D']
+
+# Nomes das classes TOAST, conforme a Base de Conhecimento 2 do prompt
+TOAST_CLASSES = {
+    '1': "TOAST 1 – Aterosclerose de Grandes Artérias (LAA)",
+    '2': "TOAST 2 – Cardioembólico (CE)",
+    '3': "TOAST 3 – Oclusão de Pequenas Artérias (SVD)",
+    '4': "TOAST 4 – AVC de Outra Etiologia Determinada",
+    '5a': "TOAST 5a – Etiologia Indeterminada (Duas ou mais causas identificadas)",
+    '5b': "TOAST 5b – Etiologia Indeterminada (Avaliação negativa / Criptogênico)",
+    '5c': "TOAST 5c – Etiologia Indeterminada (Avaliação incompleta)",
+}
+
+# Categoria ASCOD com grau 1 -> classe TOAST correspondente (O e D são "outra etiologia")
+ASCOD_TO_TOAST = {'A': '1', 'S': '3', 'C': '2', 'O': '4', 'D': '4'}
+
+CATEGORY_NAMES = {
+    'A': 'Aterosclerose',
+    'S': 'Doença de Pequenos Vasos',
+    'C': 'Cardiopatia',
+    'O': 'Outras Causas',
+    'D': 'Dissecção',
+}
+
+
+def derive_toast(grades: Dict[str, int]) -> Dict[str, str]:
+    """Deriva a classe TOAST a partir dos graus ASCOD (A, S, C, O, D)."""
+    grades = {cat: int(grade) for cat, grade in grades.items()}
+    causal = [cat for cat in ASCOD_CATEGORIES if grades.get(cat) == 1]
+    toast_classes = sorted({ASCOD_TO_TOAST[cat] for cat in causal})
+
+    if len(toast_classes) >= 2:
+        key = '5a'
+        causes = ', '.join(f"{CATEGORY_NAMES[cat]} ({cat}1)" for cat in causal)
+        justification = f"Duas ou mais causas potenciais identificadas: {causes}."
+    elif len(toast_classes) == 1:
+        key = toast_classes[0]
+        causes = ', '.join(f"{CATEGORY_NAMES[cat]} ({cat}1)" for cat in causal)
+        justification = f"Causa única com grau 1 na classificação ASCOD: {causes}."
+    elif all(grades.get(cat, 9) != 9 for cat in ASCOD_CATEGORIES):
+        key = '5b'
+        justification = "Nenhuma causa grau 1 identificada apesar da avaliação completa de todas as categorias."
+    else:
+        key = '5c'
+        incomplete = ', '.join(cat for cat in ASCOD_CATEGORIES if grades.get(cat, 9) == 9)
+        justification = f"Nenhuma causa grau 1 identificada e avaliação incompleta ({incomplete}9)."
+
+    return {'classification': TOAST_CLASSES[key], 'justification': justification}
+
+
+VALID_GRADES = (0, 1, 2, 3, 9)
+TOAST_KEY_RE = re.compile(r'TOAST\s*(\d)\s*([abc])?', re.IGNORECASE)
+TOAST_SUBTYPE_RE = re.compile(r'\b5\s*([abc])\b|subtipo\s*5?([abc])\b', re.IGNORECASE)
+
+
+def parse_toast_key(classification: str) -> Optional[str]:
+    """Extrai a chave de TOAST_CLASSES ('1'...'5c') do texto da classificação."""
+    match = TOAST_KEY_RE.search(classification or '')
+    if not match:
+        return None
+    number, subtype = match.group(1), match.group(2)
+    if number != '5':
+        return number if number in TOAST_CLASSES else None
+    if not subtype:
+        # Ex.: "TOAST 5 – Etiologia Indeterminada (subtipo 5a: ...)"
+        sub = TOAST_SUBTYPE_RE.search(classification[match.end():])
+        subtype = (sub.group(1) or sub.group(2)) if sub else None
+    return f'5{subtype.lower()}' if subtype else None
+
+
+# Esquema da resposta passado ao modelo (response_schema do Gemini); espelha ASCOD_OUTPUT_FORMAT
+CATEGORY_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'grade': {'type': 'integer', 'description': 'Grau ASCOD: 0, 1, 2, 3 ou 9.'},
+        'justification': {'type': 'string'},
+    },
+    'required': ['grade', 'justification'],
+}
+RESPONSE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'ascod': {
+            'type': 'object',
+            'properties': {cat: CATEGORY_SCHEMA for cat in ASCOD_CATEGORIES},
+            'required': list(ASCOD_CATEGORIES),
+        },
+        'toast': {
+            'type': 'object',
+            'properties': {
+                'classification': {'type': 'string', 'description': 'Uma das classes: ' + '; '.join(TOAST_CLASSES.values())},
+                'justification': {'type': 'string'},
+            },
+            'required': ['classification', 'justification'],
+        },
+    },
+    'required': ['ascod', 'toast'],
+}
+
+
+class InvalidResultError(ValueError):
+    """Resposta que não segue o esquema ASCOD/TOAST ou é incoerente."""
+
+    def __init__(self, problems: List[str]):
+        super().__init__('; '.join(problems))
+        self.problems = problems
+
+
+@dataclass(frozen=True)
+class CategoryResult:
+    grade: int
+    justification: str
+
+
+@dataclass(frozen=True)
+class ClassificationResult:
+    """Classificação ASCOD/TOAST já validada (da IA ou do motor de regras)."""
+    ascod: Dict[str, CategoryResult]
+    toast_classification: str
+    toast_justification: str = ''
+
+    @property
+    def grades(self) -> Dict[str, int]:
+        return {cat: self.ascod[cat].grade for cat in ASCOD_CATEGORIES}
+
+    @property
+    def ascod_code(self) -> str:
+        """Código ASCOD na ordem canônica, ex.: A1S9C0O0D0."""
+        return ''.join(f"{cat}{self.ascod[cat].grade}" for cat in ASCOD_CATEGORIES)
+
+    @property
+    def toast_code(self) -> str:
+        return self.toast_classification
+
+    @property
+    def toast_key(self) -> Optional[str]:
+        return parse_toast_key(self.toast_classification)
+
+    def to_dict(self) -> Dict:
+        """Mesmo formato do JSON pedido ao modelo."""
+        return {
+            'ascod': {cat: {'grade': r.grade, 'justification': r.justification} for cat, r in self.ascod.items()},
+            'toast': {'classification': self.toast_classification, 'justification': self.toast_justification},
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), ensure_ascii=False)
+
+    @classmethod
+    def from_grades(cls, ascod: Dict[str, CategoryResult]) -> 'ClassificationResult':
+        """Monta o resultado com a classe TOAST derivada dos graus."""
+        toast = derive_toast({cat: ascod[cat].grade for cat in ASCOD_CATEGORIES})
+        return cls(ascod, toast['classification'], toast['justification'])
+
+    @classmethod
+    def parse(cls, data) -> Tuple[Optional['ClassificationResult'], List[str]]:
+        """
+        Valida o esquema e a coerência entre os graus e a classe TOAST em uma única passada.
+        Retorna (resultado, []) ou (None, problemas).
+        """
+        if not isinstance(data, dict):
+            return None, ['A resposta não é um objeto JSON.']
+        if 'error' in data:
+            return None, [f"O modelo retornou erro: {data.get('details') or data['error']}"]
+        problems = []
+        ascod = data.get('ascod')
+        categories = {}
+        if not isinstance(ascod, dict):
+            problems.append("Campo 'ascod' ausente ou inválido.")
+        else:
+            for cat in ASCOD_CATEGORIES:
+                entry = ascod.get(cat)
+                try:
+                    grade = int(entry.get('grade'))
+                except (AttributeError, TypeError, ValueError):
+                    problems.append(f"Grau ausente ou inválido para {cat}.")
+                    continue
+                if grade not in VALID_GRADES:
+                    problems.append(f"Grau {grade} inválido para {cat}.")
+                    continue
+                justification = entry.get('justification')
+                if not isinstance(justification, str) or not justification.strip():
+                    problems.append(f"Justificativa ausente para {cat}.")
+                    continue
+                categories[cat] = CategoryResult(grade, justification)
+
+        toast = data.get('toast')
+        if not isinstance(toast, dict) or not isinstance(toast.get('classification'), str):
+            problems.append("Campo 'toast' ausente ou inválido.")
+            return None, problems
+        key = parse_toast_key(toast['classification'])
+        if key is None:
+            problems.append(f"Classe TOAST não reconhecida: {toast['classification']}.")
+            return None, problems
+        if problems:
+            return None, problems
+
+        grades = {cat: categories[cat].grade for cat in ASCOD_CATEGORIES}
+        causal = [cat for cat in ASCOD_CATEGORIES if grades[cat] == 1]
+        # Cada classe TOAST de causa única exige o grau 1 na categoria correspondente
+        required = {'1': ('A',), '2': ('C',), '3': ('S',), '4': ('O', 'D')}
+        if key in required and not any(grades[cat] == 1 for cat in required[key]):
+            needed = ' ou '.join(f'{cat}1' for cat in required[key])
+            problems.append(f"TOAST {key} exige {needed}.")
+        if key in required and len({ASCOD_TO_TOAST[cat] for cat in causal}) >= 2:
+            problems.append("Causas grau 1 de classes TOAST diferentes exigem TOAST 5a.")
+        if key == '5a' and len(causal) < 2:
+            problems.append("TOAST 5a exige duas ou mais categorias com grau 1.")
+        if key in ('5b', '5c') and causal:
+            problems.append(f"TOAST {key} é incompatível com causa grau 1 ({', '.join(f'{cat}1' for cat in causal)}).")
+        if key == '5b' and any(grade == 9 for grade in grades.values()):
+            problems.append("TOAST 5b exige avaliação completa (nenhum grau 9).")
+        if problems:
+            return None, problems
+        justification = toast.get('justification')
+        return cls(categories, toast['classification'], justification if isinstance(justification, str) else ''), []
+
+    @classmethod
+    def from_dict(cls, data) -> 'ClassificationResult':
+        result, problems = cls.parse(data)
+        if result is None:
+            raise InvalidResultError(problems)
+        return result
+
+    @classmethod
+    def from_json(cls, text: str) -> 'ClassificationResult':
+        try:
+            data = json.loads(text)
+        except (json.JSONDecodeError, TypeError):
+            raise InvalidResultError(['A resposta não é um JSON válido.'])
+        return cls.from_dict(data)
+
+
+def validate_result(result) -> List[str]:
+    """
+    Verifica o esquema da resposta ASCOD/TOAST e a coerência entre os graus e a classe TOAST.
+    Retorna a lista de problemas encontrados (vazia se a resposta for válida).
+    """
+    return ClassificationResult.parse(result)[1]
+
+
+def _close_truncated_json(text: str) -> Optional[str]:
+    """Fecha strings, objetos e listas abertos de um JSON cortado; None se não houver o que fechar."""
+    stack = []
+    in_string = escaped = False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in '{[':
+            stack.append('}' if ch == '{' else ']')
+        elif ch in '}]' and stack:
+            stack.pop()
+    if not stack and not in_string:
+        return None
+    closed = text + ('"' if in_string else '')
+    closed = re.sub(r'[,:]\s*$', '', closed.rstrip())
+    return closed + ''.join(reversed(stack))
+
+
+def _parse_truncated_json(text: str, attempts: int = 8):
+    """Decodifica um JSON cortado, recuando até a última vírgula quando o corte caiu no meio de um par."""
+    for _ in range(attempts):
+        closed = _close_truncated_json(text)
+        if closed is None:
+            return None
+        try:
+            return json.loads(closed)
+        except json.JSONDecodeError:
+            cut = text.rfind(',')
+            if cut < 0:
+                return None
+            text = text[:cut]
+    return None
+
+
+def repair_response(text: str) -> Tuple[Optional[ClassificationResult], List[str], List[str]]:
+    """
+    Decodifica a resposta do modelo aplicando reparos locais baratos antes de desistir:
+    texto ao redor do JSON, JSON truncado e justificativas vazias. A classe TOAST nunca
+    é reescrita: incoerente com os graus, a resposta é inválida (nova pergunta ou pro).
+    Retorna (resultado, problemas, reparos feitos).
+    """
+    repairs = []
+    try:
+        data = json.loads(text)
+    except (json.JSONDecodeError, TypeError):
+        data = None
+        raw = text or ''
+        start, end = raw.find('{'), raw.rfind('}')
+        if start >= 0 and end > start:
+            try:
+                data = json.loads(raw[start:end + 1])
+                repairs.append('extracted')
+            except json.JSONDecodeError:
+                pass
+        if data is None and start >= 0:
+            data = _parse_truncated_json(raw[start:])
+            if data is not None:
+                repairs.append('truncated')
+        if data is None:
+            return None, ['A resposta não é um JSON válido.'], repairs
+
+    result, problems = ClassificationResult.parse(data)
+    if result is not None or not isinstance(data, dict) or 'error' in data:
+        return result, problems, repairs
+
+    # Graus válidos com justificativa vazia: reparo local
+    ascod = data.get('ascod') if isinstance(data.get('ascod'), dict) else {}
+    categories = {}
+    for cat in ASCOD_CATEGORIES:
+        entry = ascod.get(cat)
+        try:
+            grade = int(entry.get('grade'))
+        except (AttributeError, TypeError, ValueError):
+            return None, problems, repairs
+        if grade not in VALID_GRADES:
+            return None, problems, repairs
+        justification = entry.get('justification')
+        if not isinstance(justification, str) or not justification.strip():
+            justification = f"{cat}{grade}: justificativa não informada pelo modelo."
+            if 'justification' not in repairs:
+                repairs.append('justification')
+        categories[cat] = CategoryResult(grade, justification)
+    result, toast_problems = ClassificationResult.parse({
+        'ascod': {cat: {'grade': r.grade, 'justification': r.justification} for cat, r in categories.items()},
+        'toast': data.get('toast'),
+    })
+    # Graus e classe TOAST em desacordo indicam um raciocínio incoerente: a resposta não é aproveitada
+    if result is None:
+        return None, toast_problems, repairs
+    return result, [], repairs
+
+
+class ASCODRuleEngine:
+    """Classificação determinística ASCOD/TOAST a partir de PatientData, sem chamada à IA."""
+
+    def classify(self, patient: PatientData) -> Dict:
+        """Retorna um dicionário no mesmo formato da resposta JSON da IA."""
+        return self.evaluate(patient).to_dict()
+
+    def evaluate(self, patient: PatientData) -> ClassificationResult:
+        rules = {
+            'A': self.grade_atherosclerosis,
+            'S': self.grade_small_vessel,
+            'C': self.grade_cardiac,
+            'O': self.grade_other,
+            'D': self.grade_dissection,
+        }
+        ascod = {}
+        for cat in ASCOD_CATEGORIES:
+            ascod[cat] = CategoryResult(*rules[cat](patient))
+        return ClassificationResult.from_grades(ascod)
+
+    @staticmethod
+    def _pick(category, findings, excluded=False, excluded_msg='', missing_msg=''):
+        """Escolhe o grau mais causal (1 > 2 > 3) entre os achados; senão 0 ou 9."""
+        if findings:
+            best = min(grade for grade, _ in findings)
+            main = [text for grade, text in findings if grade == best]
+            others = [f"{category}{grade}: {text}" for grade, text in findings if grade != best]
+            justification = f"{category}{best}: " + '; '.join(main) + '.'
+            if others:
+                justification += " Outros achados: " + '; '.join(others) + '.'
+            return best, justification
+        if excluded:
+            return 0, f"{category}0: {excluded_msg}"
+        return 9, f"{category}9: {missing_msg}"
+
+    def grade_atherosclerosis(self, p: PatientData) -> Tuple[int, str]:
+        findings = []
+        if p.stenosis is not None:
+            if p.stenosis >= 50:
+                findings.append((1, f"Estenose arterial ipsilateral de {p.stenosis}% (≥50%)"))
+            elif 30 <= p.stenosis < 50:
+                findings.append((2, f"Estenose arterial ipsilateral de {p.stenosis}% (<50%)"))
+            elif p.stenosis > 0:
+                findings.append((3, f"Estenose arterial ipsilateral de {p.stenosis}%"))
+        if p.a1_stenosis_lt_50_thrombus:
+            findings.append((1, "Estenose <50% com trombo luminal"))
+        if p.a1_aortic_mobile_thrombus:
+            findings.append((1, "Trombo móvel no arco aórtico"))
+        if p.a2_aortic_plaque_ge_4mm:
+            findings.append((2, "Placa aórtica ≥4mm sem componente móvel"))
+        if p.a3_history_mi_pad:
+            findings.append((3, "História de IAM ou doença arterial periférica"))
+        return self._pick('A', findings, missing_msg="Avaliação vascular (cervical, intracraniana e arco aórtico) não informada.")
+
+    def grade_small_vessel(self, p: PatientData) -> Tuple[int, str]:
+        findings = []
+        lacunar = p.infarct_type == 'subcortical_small_lacunar'
+        if lacunar and p.s1_lacunar_infarct_syndrome:
+            findings.append((1, "Síndrome lacunar clássica com infarto subcortical <1,5cm"))
+        if lacunar and p.s_has_htn_or_dm:
+            findings.append((1, "Infarto subcortical <1,5cm isolado em paciente com HAS ou DM"))
+        if p.s1_lacunar_plus_severe_leuko:
+            findings.append((1, "Infarto lacunar associado a leucoaraiose grave (Fazekas III)"))
+        if lacunar and not findings:
+            findings.append((2, "Infarto subcortical <1,5cm sem síndrome lacunar clássica nem HAS/DM"))
+        if p.s3_severe_leuko_isolated:
+            findings.append((3, "Leucoaraiose grave (Fazekas III) isolada"))
+        # Regra rigorosa de S0: um infarto cortical não basta, a ausência de marcadores precisa ser descrita.
+        return self._pick('S', findings, missing_msg="Ausência de marcadores de doença de pequenos vasos não descrita na imagem.")
+
+    def grade_cardiac(self, p: PatientData) -> Tuple[int, str]:
+        findings = []
+        # Critério C1 (10) da tabela: FEVE <30%
+        if p.lvef is not None and p.lvef < 30:
+            findings.append((1, f"Fração de ejeção do VE de {p.lvef}%"))
+        c1_flags = [
+            (p.c1_afib_documented, "FA/Flutter documentado"),
+            (p.c1_mechanical_valve, "Prótese valvar mecânica"),
+            (p.c1_mural_thrombus, "Trombo mural em cavidades esquerdas"),
+            (p.c1_recent_mi, "Infarto do miocárdio recente (<3 meses)"),
+            (p.c1_infective_endocarditis, "Endocardite infecciosa"),
+            (p.c1_cardiomyopathy, "Cardiomiopatia dilatada"),
+            (p.c1_intracardiac_mass, "Massa intracardíaca (mixoma, etc.)"),
+            (p.c1_mitral_stenosis, "Estenose mitral reumática"),
+            (p.c1_pfo_pe_dvt, "FOP com TEP/TVP prévio"),
+        ]
+        findings.extend((1, text) for flag, text in c1_flags if flag)
+        if p.c2_pfo_asa:
+            # C1(11): padrão de infarto embólico com fonte cardíaca de risco menor
+            if p.infarct_type == 'cortical_large':
+                findings.append((1, "FOP com aneurisma de septo atrial associado a padrão de infarto embólico (C1(11))"))
+            else:
+                findings.append((2, "FOP com aneurisma de septo atrial"))
+        if p.c3_pfo_isolated:
+            findings.append((3, "FOP isolado"))
+        return self._pick('C', findings, missing_msg="ECG, Holter e ecocardiograma não informados.")
+
+    def grade_other(self, p: PatientData) -> Tuple[int, str]:
+        flags = [
+            (p.o1_antiphospholipid, 1, "Síndrome antifosfolípide"),
+            (p.o1_other_angiitis, 1, "Vasculite / angiite do SNC"),
+            (p.o1_thrombophilia, 1, "Trombofilia com trombose ativa"),
+            (p.o1_hematologic, 1, "Doença hematológica (policitemia/trombocitemia)"),
+            (p.o1_moyamoya, 1, "Doença de Moyamoya"),
+            (p.o2_migraine_with_aura, 2, "Enxaqueca com aura"),
+            (p.o3_malignancy, 3, "Malignidade com hipercoagulação"),
+        ]
+        findings = [(grade, text) for flag, grade, text in flags if flag]
+        return self._pick('O', findings, excluded=p.o0_other_causes_excluded,
+                          excluded_msg="Investigação para outras causas raras foi negativa.",
+                          missing_msg="Investigação de outras causas não informada.")
+
+    def grade_dissection(self, p: PatientData) -> Tuple[int, str]:
+        findings = []
+        if p.d1_direct:
+            findings.append((1, "Demonstração direta de hematoma mural"))
+        if p.d2_weak_evidence:
+            findings.append((2, "Evidência fraca de dissecção (clínica, Horner)"))
+        return self._pick('D', findings, excluded=p.d0_dissection_excluded,
+                          excluded_msg="Avaliação vascular completa excluiu dissecção.",
+                          missing_msg="Avaliação das artérias cervicais e intracranianas para dissecção não informada.")
+
+
+# Formato de saída exigido do modelo (parte estática, enviada junto com a instrução do sistema)
+ASCOD_OUTPUT_FORMAT = """
+**## Formato da Resposta**
+
+Com base nos dados fornecidos e aplicando ESTRITAMENTE os critérios ASCOD e TOAST descritos na sua base de conhecimento, gere a classificação.
+Responda APENAS com um objeto JSON válido, sem nenhum texto ou formatação adicional (como ```json).
+Sua resposta deve ser um JSON puro, começando com `{` e terminando com `}`.
+A estrutura do JSON deve ser:
+{
+  "ascod": {
+    "A": {"grade": 9, "justification": "Avaliação incompleta por falta de dados."},
+    "S": {"grade": 9, "justification": "Avaliação incompleta por falta de dados."},
+    "C": {"grade": 9, "justification": "Avaliação incompleta por falta de dados."},
+    "O": {"grade": 9, "justification": "Avaliação incompleta por falta de dados."},
+    "D": {"grade": 9, "justification": "Avaliação incompleta por falta de dados."}
+  },
+  "toast": {
+    "classification": "...",
+    "justification": "..."
+  }
+}
+"""
+
+
+def build_user_prompt(text):
+    """Parte variável do prompt: apenas o resumo clínico do paciente."""
+    return f"""**## Dados do Paciente para Análise**
+
+Analise o seguinte resumo clínico do paciente:
+"{text}"
+"""
+
+
+def build_repair_prompt(text, previous, problems):
+    """Pede de novo a classificação, apontando os problemas da resposta anterior."""
+    listed = '\n'.join(f"- {problem}" for problem in problems)
+    return build_user_prompt(text) + f"""
+**## Correção da Resposta Anterior**
+
+Sua resposta anterior não pôde ser usada:
+{listed}
+
+Resposta anterior:
+{previous[:4000]}
+
+Gere novamente a classificação completa, corrigindo esses problemas, e responda apenas com o JSON no formato exigido.
+"""
+
+
+def build_category_format(category):
+    """Formato da resposta de uma única categoria (modo dividido); a classe TOAST é derivada localmente."""
+    return f"""
+**## Tarefa e Formato da Resposta**
+
+Avalie SOMENTE a categoria {category} ({CATEGORY_NAMES[category]}), aplicando ESTRITAMENTE os critérios acima. As demais categorias e a classificação TOAST são avaliadas separadamente.
+Responda APENAS com um objeto JSON válido, sem nenhum texto ou formatação adicional (como ```json):
+{{"grade": 9, "justification": "Avaliação incompleta por falta de dados."}}
+"""
+
+
+def build_category_prompt(text, category, previous=None, problems=None):
+    """Prompt do paciente para uma categoria; com previous, pede a correção da resposta anterior."""
+    prompt = build_user_prompt(text) + f"\nCategoria ASCOD avaliada: {category} ({CATEGORY_NAMES[category]})\n"
+    if previous is None:
+        return prompt
+    listed = '\n'.join(f"- {problem}" for problem in problems or [])
+    return prompt + f"""
+**## Correção da Resposta Anterior**
+
+Sua resposta anterior não pôde ser usada:
+{listed}
+
+Resposta anterior:
+{previous[:2000]}
+
+Responda novamente apenas com o JSON da categoria {category} no formato exigido.
+"""
+
+
+def sum_usage(usages) -> Optional[Dict[str, int]]:
+    """Soma a contagem de tokens de várias chamadas (None se nenhuma informou)."""
+    usages = [usage for usage in usages if usage]
+    if not usages:
+        return None
+    return {key: sum(usage.get(key) or 0 for usage in usages) for key in usages[0]}
+
+
+def parse_category_response(text: str, category: str) -> Tuple[Optional[CategoryResult], List[str]]:
+    """Decodifica a resposta de uma categoria ({"grade", "justification"}); retorna (resultado, problemas)."""
+    raw = text or ''
+    start, end = raw.find('{'), raw.rfind('}')
+    try:
+        data = json.loads(raw[start:end + 1] if start >= 0 and end > start else raw)
+    except json.JSONDecodeError:
+        return None, [f'A resposta da categoria {category} não é um JSON válido.']
+    # Aceita também a categoria aninhada ({"C": {...}} ou {"ascod": {"C": {...}}})
+    if isinstance(data, dict) and isinstance(data.get('ascod'), dict):
+        data = data['ascod']
+    if isinstance(data, dict) and isinstance(data.get(category), dict):
+        data = data[category]
+    if not isinstance(data, dict):
+        return None, [f'A resposta da categoria {category} não é um objeto JSON.']
+    if 'error' in data:
+        return None, [f"O modelo retornou erro: {data.get('details') or data['error']}"]
+    try:
+        grade = int(data.get('grade'))
+    except (TypeError, ValueError):
+        return None, [f"Grau ausente ou inválido para {category}."]
+    if grade not in VALID_GRADES:
+        return None, [f"Grau {grade} inválido para {category}."]
+    justification = data.get('justification')
+    if not isinstance(justification, str) or not justification.strip():
+        return None, [f"Justificativa ausente para {category}."]
+    return CategoryResult(grade, justification), []
+
+
+@dataclass
+class AIAnalysis:
+    """Resultado bruto de uma chamada à IA (texto JSON) e seus metadados."""
+    text: str
+    model: str
+    cached: bool = False
+    usage: Optional[Dict[str, int]] = None
+    # True quando a resposta veio de uma chamada idêntica já em andamento
+    coalesced: bool = False
+    # Tamanho da instrução do sistema enviada (ver PromptBuilder)
+    prompt_size: Optional[Dict] = None
+    # Camada que respondeu ('fast' ou 'pro') e, se houve escalonamento, os motivos
+    tier: Optional[str] = None
+    escalation: Optional[List[str]] = None
+    # Tipo da falha quando não houve resposta utilizável: 'circuit_open', 'deadline', 'upstream' ou 'invalid'
+    failure: Optional[str] = None
+    # Resposta decodificada e validada (None se inválida), os problemas encontrados e os reparos aplicados
+    result: Optional[ClassificationResult] = None
+    problems: Optional[List[str]] = None
+    repairs: Optional[List[str]] = None
+    # Modo dividido: por categoria, se houve chamada ao modelo (ou veio do cache) e a latência dela
+    split: Optional[Dict[str, Dict]] = None
+    # Resposta reaproveitada de um texto quase idêntico: {id, similarity} no índice de quase-duplicatas
+    near_duplicate: Optional[Dict] = None
+
+
+@dataclass
+class CategoryAnalysis:
+    """Resultado de uma chamada de categoria no modo dividido."""
+    category: str
+    result: Optional[CategoryResult] = None
+    usage: Optional[Dict[str, int]] = None
+    failure: Optional[str] = None
+    problems: Optional[List[str]] = None
+    # False quando o grau 9 foi atribuído localmente (categoria sem dados no resumo)
+    model_call: bool = True
+    latency_ms: Optional[float] = None
+    # True quando veio do cache por categoria (entrada da categoria inalterada)
+    cached: bool = False
+
+
+@dataclass
+class TierEscalation:
+    """Gerado por analyze_stream quando a resposta do modelo rápido é descartada e o pro assume."""
+    reasons: List[str]
+
+
+class PartialResultParser:
+    """Extrai graus e justificativas de um JSON de resposta recebido aos pedaços."""
+
+    _CATEGORY_RE = re.compile(r'"([ASCOD])"\s*:\s*\{')
+    _GRADE_RE = re.compile(r'"grade"\s*:\s*"?(\d)')
+    _JUSTIFICATION_RE = re.compile(r'"justification"\s*:\s*"((?:[^"\\]|\\.)*)(")?')
+    _TOAST_RE = re.compile(r'"toast"\s*:\s*\{.*?"classification"\s*:\s*"((?:[^"\\]|\\.)*)"', re.S)
+
+    def __init__(self):
+        self.buffer = ''
+        self.grades = {}
+        self.justifications = {}
+        self.toast = None
+
+    @staticmethod
+    def _decode(partial):
+        # Remove uma barra de escape incompleta no fim antes de decodificar
+        if partial.endswith('\\') and not partial.endswith('\\\\'):
+            partial = partial[:-1]
+        try:
+            return json.loads(f'"{partial}"')
+        except json.JSONDecodeError:
+            return partial
+
+    def feed(self, chunk) -> List[Dict]:
+        """Acrescenta um pedaço da resposta e retorna os eventos novos."""
+        self.buffer += chunk
+        events = []
+        starts = list(self._CATEGORY_RE.finditer(self.buffer))
+        toast_start = self.buffer.find('"toast"')
+        for i, match in enumerate(starts):
+            category = match.group(1)
+            end = starts[i + 1].start() if i + 1 < len(starts) else len(self.buffer)
+            if match.start() < toast_start < end:
+                end = toast_start
+            block = self.buffer[match.end():end]
+
+            grade_match = self._GRADE_RE.search(block)
+            if grade_match and category not in self.grades:
+                self.grades[category] = int(grade_match.group(1))
+                events.append({'event': 'grade', 'category': category, 'grade': self.grades[category]})
+
+            justification_match = self._JUSTIFICATION_RE.search(block)
+            if justification_match:
+                text = self._decode(justification_match.group(1))
+                if text != self.justifications.get(category):
+                    self.justifications[category] = text
+                    events.append({
+                        'event': 'justification',
+                        'category': category,
+                        'text': text,
+                        'complete': justification_match.group(2) is not None,
+                    })
+
+        if self.toast is None:
+            toast_match = self._TOAST_RE.search(self.buffer)
+            if toast_match:
+                self.toast = self._decode(toast_match.group(1))
+                events.append({'event': 'toast', 'classification': self.toast})
+        return events
 
 
 class ASCODClassifier:
-    """Encapsula a lógica de classificação usando a API Gemini."""
-    def __init__(self, api_key=None):
-        self.api_key = api_key or os.getenv('GEMINI_API_KEY')
-        if not self.api_key:
-            raise ValueError("API key for Gemini not found. Please set the GEMINI_API_KEY environment variable.")
-        genai.configure(api_key=self.api_key)
-        # Modelo atualizado para gemini-2.5-pro conforme solicitado para maior precisão
-        self.model = genai.GenerativeModel('gemini-2.5-pro')
-
-    def analyze_with_ai(self, text):
+    """Encapsula a lógica de classificação sobre um backend de modelo (Gemini por padrão)."""
+    def __init__(self, api_key=None, cache=None, context_cache_ttl=None, max_upstream_calls=None, backend=None,
+                 fast_backend=None, routing=None, split_categories=None, category_backend=None, near_index=None):
+        # A instrução do sistema é registrada uma única vez por processo; cada requisição leva só o resumo do paciente
+        self.system_instruction = ASCOD_SYSTEM_INSTRUCTION + ASCOD_OUTPUT_FORMAT
+        # Envia só os critérios das categorias com dados no caso (ASCOD_PROMPT_PRUNING)
+        self.prompts = PromptBuilder(ASCOD_SYSTEM_INSTRUCTION, ASCOD_OUTPUT_FORMAT)
+        # Backend escolhido por ASCOD_BACKEND (gemini | simulator), opcionalmente com gravação/reprodução
+        self.backend = backend or create_backend(DEFAULT_MODEL_NAME, self.system_instruction, api_key=api_key,
+                                                 context_cache_ttl=context_cache_ttl, response_schema=RESPONSE_SCHEMA)
+        self.model_name = self.backend.model_id
+        # Roteamento em camadas: modelo rápido primeiro, escalando para o pro se a resposta não for válida
+        if routing is None:
+            routing = fast_backend is not None or os.getenv('ASCOD_ROUTING', 'false').lower() in ['true', '1', 'on']
+        self.fast_backend = None
+        if routing:
+            self.fast_backend = fast_backend or create_backend(os.getenv('ASCOD_FAST_MODEL', FAST_MODEL_NAME), self.system_instruction,
+                                                               api_key=api_key, context_cache_ttl=context_cache_ttl, tier='fast',
+                                                               response_schema=RESPONSE_SCHEMA)
+        # Textos acima deste tamanho vão direto para o pro
+        self.complex_chars = int(os.getenv('ASCOD_ROUTING_COMPLEX_CHARS', 3000))
+        # Resposta final inválida mesmo após os reparos locais: pede a correção ao modelo uma vez
+        self.reask = os.getenv('ASCOD_REASK_INVALID', 'true').lower() in ['true', '1', 'on']
+        # Cache de respostas compartilhado entre workers (None desabilita)
+        self.cache = cache if cache is not None else ResultCache.from_env()
+        # Textos livres quase idênticos a um já classificado reaproveitam a resposta (None desabilita)
+        self.near_index = near_index if near_index is not None else NearDuplicateIndex.from_env()
+        # Requisições idênticas em andamento compartilham uma única chamada ao modelo
+        self.flights = SingleFlight(cache=self.cache or None)
+        # Limite de chamadas simultâneas ao modelo por processo (as demais aguardam a vez)
+        self.max_upstream_calls = int(max_upstream_calls if max_upstream_calls is not None else os.getenv('ASCOD_MAX_UPSTREAM_CALLS', 32))
+        self._upstream_slots = threading.BoundedSemaphore(self.max_upstream_calls)
+        self._async_upstream_slots = None
+        # Prazo total por requisição (abaixo do timeout do gunicorn) e política de chamadas por camada
+        self.deadline_seconds = float(os.getenv('ASCOD_DEADLINE_SECONDS', 90))
+        if self.deadline_seconds >= float(os.getenv('ASCOD_WORKER_TIMEOUT', 120)):
+            print("⚠️  AVISO: ASCOD_DEADLINE_SECONDS deve ser menor que ASCOD_WORKER_TIMEOUT (o worker seria reiniciado antes do erro).")
+        self.policies = {'pro': CallPolicy.from_env('pro'), 'fast': CallPolicy.from_env('fast')}
+        # Modo dividido: uma chamada por categoria ASCOD, em paralelo, com a classe TOAST derivada dos graus
+        if split_categories is None:
+            split_categories = category_backend is not None or os.getenv('ASCOD_SPLIT_CATEGORIES', 'false').lower() in ['true', '1', 'on']
+        self.split_categories = split_categories
+        self.category_backend = None
+        if split_categories:
+            # Mesmo modelo do pro, com o esquema de resposta de uma categoria
+            self.category_backend = category_backend or (backend if backend is not None else create_backend(
+                self.backend.model_name, self.system_instruction, api_key=api_key, context_cache_ttl=0,
+                response_schema=CATEGORY_SCHEMA))
+            self._category_executor = ThreadPoolExecutor(max_workers=self.max_upstream_calls, thread_name_prefix='ascod-category')
+
+    def warm_up(self, model_call: bool = True):
+        """
+        Executa uma vez, antes da primeira requisição, o que a primeira análise pagaria:
+        montagem do prompt podado, exceções de nova tentativa e a conexão com o modelo.
+        """
+        self._assemble_prompt(PatientData(stenosis=70, c1_afib_documented=True).to_natural_language(), structured=True)
+        if self.split_categories:
+            for cat in ASCOD_CATEGORIES:
+                self.prompts.category_instruction(cat, build_category_format(cat))
+        transient_errors()
+        if not model_call:
+            return
+        for backend in filter(None, (self.backend, self.fast_backend, self.category_backend)):
+            try:
+                backend.warm_up()
+            except Exception as e:
+                # O worker sobe mesmo assim; a primeira chamada real passa pelas novas tentativas
+                print(f"Warm-up do modelo {backend.model_id} falhou: {e}")
+
+    def count_prompt_tokens(self, text) -> Dict[str, int]:
+        """Compara os tokens de entrada do prompt antigo (instrução embutida) com o atual (só o paciente)."""
+        user_prompt = build_user_prompt(text)
+        inline = self.backend.count_tokens(self.system_instruction + user_prompt)
+        request_only = self.backend.count_tokens(user_prompt)
+        assembled = self.prompts.build(text)
+        return {
+            'inline_prompt_tokens': inline,
+            'request_prompt_tokens': request_only,
+            'system_instruction_tokens': inline - request_only,
+            'pruned_system_instruction_tokens': self.backend.count_tokens(assembled.system_instruction),
+            'pruned_categories': list(assembled.categories),
+        }
+
+    def analyze_with_ai(self, text, use_cache=True):
         """
         Analisa o texto clínico e retorna a classificação em formato JSON.
         """
-        # Adiciona um comentário com o timestamp atual para evitar cache
-        cache_buster = f"<!-- Cache buster: {time.time()} -->"
+        return self.analyze(text, use_cache=use_cache).text
 
-        # Prompt otimizado que inclui as instruções completas do sistema e o resumo do paciente.
-        prompt = f"""
-        {ASCOD_SYSTEM_INSTRUCTION}
-        {cache_buster}
+    async def analyze_with_ai_async(self, text, use_cache=True):
+        """
+        Versão assíncrona de analyze_with_ai, para uso em um loop asyncio.
+        """
+        return (await self.analyze_async(text, use_cache=use_cache)).text
 
-        **## Dados do Paciente para Análise**
+    def analyze(self, text, use_cache=True, complex_case=False, patient=None) -> AIAnalysis:
+        """
+        Analisa o texto clínico, consultando antes o cache de respostas.
+        complex_case envia o caso direto ao modelo pro quando o roteamento está ativo.
+        patient (PatientData do formulário) faz o modo dividido enviar a cada categoria
+        só os dados dela, reaproveitando as categorias cujos campos não mudaram.
+        """
+        cache_key, cached = self._cache_lookup(text, use_cache, structured=patient is not None, near=patient is None)
+        if cached is not None:
+            return cached
+        if not use_cache:
+            # Bypass explícito: sempre uma chamada nova, sem coalescer
+            return self._generate(text, complex_case, patient, use_cache=False)
+
+        def call():
+            analysis = self._generate(text, complex_case, patient)
+            self._cache_store(cache_key, analysis, text if patient is None else None)
+            return analysis
+
+        flight_key = cache_key or ResultCache.make_key(text, self.model_name, self._cache_instruction(text, patient is not None))
+        remote_fetch = (lambda: self._cache_lookup(text, use_cache, structured=patient is not None)[1]) if cache_key else None
+        analysis, coalesced = self.flights.do(flight_key, call, remote_fetch)
+        if coalesced:
+            metrics.inc('ascod_coalesced_requests_total')
+            return dataclasses.replace(analysis, coalesced=True)
+        return analysis
+
+    async def analyze_async(self, text, use_cache=True, complex_case=False, patient=None) -> AIAnalysis:
+        """
+        Igual a analyze, mas sem bloquear o loop durante a chamada ao modelo.
+        """
+        cache_key, cached = self._cache_lookup(text, use_cache, structured=patient is not None, near=patient is None)
+        if cached is not None:
+            return cached
 
-        Analise o seguinte resumo clínico do paciente:
-        "{text}"
+        analysis = await self._generate_async(text, complex_case, patient, use_cache)
+        self._cache_store(cache_key, analysis, text if patient is None else None)
+        return analysis
 
-        **## Tarefa**
-        
-        Com base nos dados fornecidos e aplicando ESTRITAMENTE os critérios ASCOD e TOAST descritos na sua base de conhecimento, gere a classificação.
-        Responda APENAS com um objeto JSON válido, sem nenhum texto ou formatação adicional (como ```json).
-        Sua resposta deve ser um JSON puro, começando com `{{` e terminando com `}}`.
-        A estrutura do JSON deve ser:
-        {{
-          "ascod": {{
-            "A": {{"grade": 9, "justification": "Avaliação incompleta por falta de dados."}},
-            "S": {{"grade": 9, "justification": "Avaliação incompleta por falta de dados."}},
-            "C": {{"grade": 9, "justification": "Avaliação incompleta por falta de dados."}},
-            "O": {{"grade": 9, "justification": "Avaliação incompleta por falta de dados."}},
-            "D": {{"grade": 9, "justification": "Avaliação incompleta por falta de dados."}}
-          }},
-          "toast": {{
-            "classification": "...",
-            "justification": "..."
-          }}
-        }}
+    def _cache_lookup(self, text, use_cache, structured=False, near=False):
+        """
+        Retorna a chave do cache e a resposta armazenada, se houver.
+        structured indica um resumo gerado pelo formulário (poda por categoria);
+        near consulta também o índice de quase-duplicatas (textos livres) quando não há resposta exata.
+        """
+        if not (use_cache and (self.cache or self.near_index)):
+            return None, None
+        # A chave usa a instrução efetivamente enviada (podada, completa ou as das categorias)
+        instruction = self._cache_instruction(text, structured)
+        cache_key = None
+        if self.cache:
+            cache_key = self.cache.make_key(text, self.model_name, instruction)
+            cached = self.cache.get(cache_key)
+            result = self._stored_result(cached)
+            metrics.inc('ascod_cache_requests_total', {'result': 'miss' if result is None else 'hit'})
+            if result is not None:
+                return cache_key, AIAnalysis(text=cached, model=self.model_name, cached=True, result=result)
+        if near and self.near_index:
+            found = self.near_index.lookup(text, self._near_scope(instruction))
+            result = self._stored_result(found[0]) if found else None
+            metrics.inc('ascod_near_duplicate_requests_total', {'result': 'miss' if result is None else 'hit'})
+            if result is not None:
+                return cache_key, AIAnalysis(text=found[0], model=self.model_name, cached=True, result=result,
+                                             near_duplicate=found[1])
+        return cache_key, None
+
+    @staticmethod
+    def _stored_result(value) -> Optional[ClassificationResult]:
+        if value is None:
+            return None
+        try:
+            return ClassificationResult.from_json(value)
+        except InvalidResultError:
+            # Entrada gravada antes da validação atual; tratada como ausente
+            return None
+
+    def _near_scope(self, instruction) -> str:
+        # Quase-duplicatas só reaproveitam respostas do mesmo modelo e da mesma instrução
+        return hash_text(self.model_name + '\x1f' + instruction)
+
+    def _cache_instruction(self, text, structured=False) -> str:
+        if self.split_categories:
+            return 'split\x1f' + ''.join(self.prompts.category_instruction(cat, build_category_format(cat))
+                                          for cat in self.prompts.relevant_categories(text, structured))
+        return self.prompts.build(text, structured).system_instruction
+
+    def _cache_store(self, cache_key, analysis, near_text=None):
+        """Armazena respostas validadas no cache e, para textos livres (near_text), no índice de quase-duplicatas."""
+        if analysis.result is None:
+            return
+        if cache_key is not None:
+            self.cache.set(cache_key, analysis.text)
+        if near_text and self.near_index and not analysis.near_duplicate:
+            self.near_index.add(near_text, self._near_scope(self._cache_instruction(near_text)), analysis.text)
+
+    def _generate(self, text, complex_case=False, patient=None, use_cache=True) -> AIAnalysis:
+        """Chama o modelo enviando apenas o resumo do paciente (com roteamento, o rápido primeiro)."""
+        deadline = Deadline(self.deadline_seconds)
+        if self.split_categories:
+            return self._merge_split(list(self._split_calls(text, deadline, patient, use_cache)))
+        with metrics.time_stage('prompt_assembly'):
+            assembled, prompt, instruction = self._assemble_prompt(text, patient is not None)
+        escalation = None
+        if self.fast_backend is not None:
+            escalation = self._complex_reasons(text, complex_case)
+            if not escalation:
+                analysis = self._call_backend(self.fast_backend, 'fast', prompt, instruction, assembled, deadline)
+                escalation = self._review(analysis)
+                if not escalation:
+                    return analysis
+        analysis = self._call_backend(self.backend, 'pro', prompt, instruction, assembled, deadline)
+        analysis = self._finish(analysis, text, instruction, assembled, deadline)
+        return dataclasses.replace(analysis, escalation=escalation) if escalation else analysis
+
+    def analyze_stream(self, text, use_cache=True, complex_case=False, patient=None) -> Iterator[Union[str, TierEscalation, AIAnalysis]]:
+        """
+        Gera a resposta do modelo em pedaços de texto à medida que chegam.
+        Se a resposta do modelo rápido for descartada, gera um TierEscalation e
+        recomeça com o texto do pro. O último item gerado é o AIAnalysis completo
+        (o mesmo que analyze retornaria).
         """
+        cache_key, cached = self._cache_lookup(text, use_cache, structured=patient is not None, near=patient is None)
+        if cached is not None:
+            yield cached.text
+            yield cached
+            return
+
+        deadline = Deadline(self.deadline_seconds)
+        if self.split_categories:
+            analysis = yield from self._stream_split(text, deadline, patient, use_cache)
+            self._cache_store(cache_key, analysis, text if patient is None else None)
+            yield analysis
+            return
+        with metrics.time_stage('prompt_assembly'):
+            assembled, prompt, instruction = self._assemble_prompt(text, patient is not None)
+        escalation = None
+        analysis = None
+        if self.fast_backend is not None:
+            escalation = self._complex_reasons(text, complex_case)
+            if not escalation:
+                analysis = yield from self._stream_backend(self.fast_backend, 'fast', prompt, instruction, assembled, deadline)
+                escalation = self._review(analysis)
+                if escalation:
+                    yield TierEscalation(escalation)
+        if analysis is None or escalation:
+            analysis = yield from self._stream_backend(self.backend, 'pro', prompt, instruction, assembled, deadline)
+            # A correção, se necessária, vem sem streaming; o evento final traz o resultado válido
+            analysis = self._finish(analysis, text, instruction, assembled, deadline)
+            if escalation:
+                analysis = dataclasses.replace(analysis, escalation=escalation)
+
+        self._cache_store(cache_key, analysis, text if patient is None else None)
+        yield analysis
+
+    async def _generate_async(self, text, complex_case=False, patient=None, use_cache=True) -> AIAnalysis:
+        """Versão assíncrona de _generate."""
+        if self.split_categories:
+            # As categorias já rodam em paralelo no pool de threads do classificador
+            return await asyncio.to_thread(self._generate, text, complex_case, patient, use_cache)
+        if self._async_upstream_slots is None:
+            self._async_upstream_slots = asyncio.Semaphore(self.max_upstream_calls)
+        deadline = Deadline(self.deadline_seconds)
+        with metrics.time_stage('prompt_assembly'):
+            assembled, prompt, instruction = self._assemble_prompt(text, patient is not None)
+        escalation = None
+        if self.fast_backend is not None:
+            escalation = self._complex_reasons(text, complex_case)
+            if not escalation:
+                analysis = await self._call_backend_async(self.fast_backend, 'fast', prompt, instruction, assembled, deadline)
+                escalation = self._review(analysis)
+                if not escalation:
+                    return analysis
+        analysis = await self._call_backend_async(self.backend, 'pro', prompt, instruction, assembled, deadline)
+        if analysis.result is None and not analysis.failure:
+            # Mesma correção de _finish
+            retry = None
+            if self.reask:
+                self._count_reask()
+                retry = await self._call_backend_async(self.backend, 'pro', build_repair_prompt(text, analysis.text, analysis.problems),
+                                                       instruction, assembled, deadline)
+            analysis = self._reask_outcome(analysis, retry)
+        return dataclasses.replace(analysis, escalation=escalation) if escalation else analysis
+
+    def _model_attempt(self, backend, prompt, instruction):
+        def attempt(timeout):
+            # A espera por uma vaga conta no prazo da requisição
+            if not self._upstream_slots.acquire(timeout=timeout):
+                raise DeadlineExceeded('Prazo esgotado aguardando vaga para chamar o modelo.')
+            try:
+                with metrics.time_stage('model_call'):
+                    return backend.generate(prompt, instruction, timeout=timeout)
+            finally:
+                self._upstream_slots.release()
+        return attempt
+
+    def _call_backend(self, backend, tier, prompt, instruction, assembled, deadline) -> AIAnalysis:
         try:
-            # Configuração para forçar a saída em JSON
-            generation_config = genai.types.GenerationConfig(
-                response_mime_type="application/json"
-            )
-            response = self.model.generate_content(prompt, generation_config=generation_config)
-            
-            # A API com response_mime_type="application/json" já retorna o texto limpo
-            return response.text
-            
+            response = self.policies[tier].call(self._model_attempt(backend, prompt, instruction), deadline)
         except Exception as e:
-            print(f"Error during AI analysis: {e}")
-            # Em caso de erro, retorna um JSON de erro para consistência
-            error_response = {
-                "error": "Failed to get a valid response from AI model.",
-                "details": str(e)
-            }
-            return json.dumps(error_response) 
\ No newline at end of file
+            return self._error_analysis(e, backend, tier)
+        return self._model_analysis(response, assembled, backend, tier)
+
+    def _stream_backend(self, backend, tier, prompt, instruction, assembled, deadline):
+        """Repassa os pedaços de texto do backend e retorna (via StopIteration) o AIAnalysis."""
+        def open_stream(timeout):
+            if not self._upstream_slots.acquire(timeout=timeout):
+                raise DeadlineExceeded('Prazo esgotado aguardando vaga para chamar o modelo.')
+            try:
+                with metrics.time_stage('model_call'):
+                    yield from backend.generate_stream(prompt, instruction, timeout=timeout)
+            finally:
+                self._upstream_slots.release()
+
+        analysis = None
+        try:
+            for item in self.policies[tier].stream(open_stream, deadline):
+                if isinstance(item, ModelResponse):
+                    analysis = self._model_analysis(item, assembled, backend, tier)
+                else:
+                    yield item
+        except Exception as e:
+            analysis = self._error_analysis(e, backend, tier)
+        return analysis
+
+    async def _call_backend_async(self, backend, tier, prompt, instruction, assembled, deadline) -> AIAnalysis:
+        async def attempt(timeout):
+            try:
+                await asyncio.wait_for(self._async_upstream_slots.acquire(), timeout)
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded('Prazo esgotado aguardando vaga para chamar o modelo.')
+            try:
+                start = time.perf_counter()
+                response = await backend.generate_async(prompt, instruction, timeout=timeout)
+                metrics.observe('ascod_stage_duration_seconds', time.perf_counter() - start, {'stage': 'model_call'})
+                return response
+            finally:
+                self._async_upstream_slots.release()
+
+        try:
+            response = await self.policies[tier].call_async(attempt, deadline)
+        except Exception as e:
+            return self._error_analysis(e, backend, tier)
+        return self._model_analysis(response, assembled, backend, tier)
+
+    def _category_call(self, category, text, deadline, cache_key=None) -> CategoryAnalysis:
+        """Classifica uma categoria com a instrução só dela; resposta inválida é reenviada uma vez (ASCOD_REASK_INVALID)."""
+        instruction = self.prompts.category_instruction(category, build_category_format(category))
+        start = time.perf_counter()
+        usages = []
+        previous = problems = None
+        for _ in range(2 if self.reask else 1):
+            if previous is not None:
+                self._count_reask()
+            prompt = build_category_prompt(text, category, previous, problems)
+            try:
+                response = self.policies['pro'].call(self._model_attempt(self.category_backend, prompt, instruction), deadline)
+            except Exception as e:
+                failed = self._error_analysis(e, self.category_backend, 'pro')
+                return CategoryAnalysis(category, usage=sum_usage(usages), failure=failed.failure,
+                                        problems=[f'{category}: {problem}' for problem in failed.problems],
+                                        latency_ms=(time.perf_counter() - start) * 1000)
+            metrics.inc('ascod_model_calls_total', {'outcome': 'success', 'tier': 'pro'})
+            metrics.record_usage(response.usage)
+            metrics.inc('ascod_prompt_chars_total', {'pruned': 'true'}, len(instruction))
+            usages.append(response.usage)
+            with metrics.time_stage('json_decode'):
+                result, problems = parse_category_response(response.text, category)
+            if result is not None:
+                if cache_key is not None:
+                    self.cache.set(cache_key, json.dumps({'grade': result.grade, 'justification': result.justification},
+                                                         ensure_ascii=False))
+                return CategoryAnalysis(category, result, sum_usage(usages), latency_ms=(time.perf_counter() - start) * 1000)
+            previous = response.text
+        metrics.inc('ascod_response_repairs_total', {'kind': 'invalid'})
+        return CategoryAnalysis(category, usage=sum_usage(usages), failure='invalid', problems=problems,
+                                latency_ms=(time.perf_counter() - start) * 1000)
+
+    def _split_calls(self, text, deadline, patient=None, use_cache=True) -> Iterator[CategoryAnalysis]:
+        """
+        Dispara em paralelo as categorias com dados no caso e gera cada resultado assim
+        que fica pronto; as demais recebem grau 9 sem chamada ao modelo. Categorias com
+        o mesmo prompt de uma análise anterior vêm do cache por categoria.
+        """
+        relevant = self.prompts.relevant_categories(text, patient is not None)
+        pending = {}
+        for cat in ASCOD_CATEGORIES:
+            if cat not in relevant:
+                yield CategoryAnalysis(cat, CategoryResult(9, 'Avaliação correspondente não relatada no resumo do paciente.'),
+                                       model_call=False)
+                continue
+            # Do formulário, cada categoria recebe só os próprios dados
+            category_text = patient.category_summary(cat) if patient is not None else text
+            cache_key, cached = self._category_cache_lookup(cat, category_text, use_cache)
+            if cached is not None:
+                yield cached
+            else:
+                pending[cat] = (category_text, cache_key)
+        futures = [self._category_executor.submit(self._category_call, cat, category_text, deadline, cache_key)
+                   for cat, (category_text, cache_key) in pending.items()]
+        for future in as_completed(futures):
+            yield future.result()
+
+    def _category_cache_lookup(self, category, text, use_cache) -> Tuple[Optional[str], Optional[CategoryAnalysis]]:
+        """Chave do cache da categoria (prompt dela + instrução dela) e o resultado armazenado, se houver."""
+        if not (self.cache and use_cache):
+            return None, None
+        instruction = self.prompts.category_instruction(category, build_category_format(category))
+        cache_key = self.cache.make_key(text, self.category_backend.model_id, instruction)
+        cached = self.cache.get(cache_key)
+        result = parse_category_response(cached, category)[0] if cached is not None else None
+        metrics.inc('ascod_category_cache_requests_total', {'category': category, 'result': 'miss' if result is None else 'hit'})
+        if result is None:
+            return cache_key, None
+        return cache_key, CategoryAnalysis(category, result, model_call=False, cached=True)
+
+    def _merge_split(self, parts: List[CategoryAnalysis]) -> AIAnalysis:
+        """Junta as categorias em um AIAnalysis, com a classe TOAST derivada dos graus (derive_toast)."""
+        parts = {part.category: part for part in parts}
+        usage = sum_usage(part.usage for part in parts.values())
+        split = {cat: {'model_call': parts[cat].model_call, 'cached': parts[cat].cached,
+                       'latency_ms': round(parts[cat].latency_ms, 1) if parts[cat].latency_ms is not None else None}
+                 for cat in ASCOD_CATEGORIES}
+        called = [cat for cat in ASCOD_CATEGORIES if parts[cat].model_call]
+        # Sem nenhuma chamada ao modelo, a resposta conta como vinda do cache
+        cached = not called and any(parts[cat].cached for cat in ASCOD_CATEGORIES)
+        chars = sum(len(self.prompts.category_instruction(cat, build_category_format(cat))) for cat in called)
+        full_chars = len(self.system_instruction)
+        prompt_size = {'chars': chars, 'full_chars': full_chars, 'estimated_tokens': chars // 4,
+                       'reduction': round(1 - chars / full_chars, 3), 'categories': called}
+        model = self.category_backend.model_id
+        failed = [parts[cat] for cat in ASCOD_CATEGORIES if parts[cat].failure]
+        if failed:
+            problems = [problem for part in failed for problem in part.problems or []]
+            error_response = {"error": "Failed to get a valid response from AI model.", "details": '; '.join(problems)}
+            return AIAnalysis(text=json.dumps(error_response), model=model, usage=usage, prompt_size=prompt_size, tier='pro',
+                              failure=failed[0].failure, problems=problems, split=split)
+        result = ClassificationResult.from_grades({cat: parts[cat].result for cat in ASCOD_CATEGORIES})
+        return AIAnalysis(text=result.to_json(), model=model, cached=cached, usage=usage, prompt_size=prompt_size, tier='pro',
+                          result=result, split=split)
+
+    def _stream_split(self, text, deadline, patient=None, use_cache=True):
+        """
+        Gera o JSON da resposta aos pedaços, uma categoria por vez, na ordem em que
+        ficam prontas (o PartialResultParser as reconhece); retorna o AIAnalysis.
+        """
+        parts = []
+        yield '{"ascod": {'
+        for part in self._split_calls(text, deadline, patient, use_cache):
+            if part.result is not None:
+                entry = {part.category: {'grade': part.result.grade, 'justification': part.result.justification}}
+                yield (', ' if any(p.result for p in parts) else '') + json.dumps(entry, ensure_ascii=False)[1:-1]
+            parts.append(part)
+        analysis = self._merge_split(parts)
+        if analysis.result is not None:
+            yield '}, "toast": ' + json.dumps(analysis.result.to_dict()['toast'], ensure_ascii=False) + '}'
+        return analysis
+
+    def _finish(self, analysis, text, instruction, assembled, deadline) -> AIAnalysis:
+        """Com a resposta final do pro inválida, pede a correção uma vez; sem sucesso, marca a falha."""
+        if analysis.result is not None or analysis.failure:
+            return analysis
+        retry = None
+        if self.reask:
+            self._count_reask()
+            retry = self._call_backend(self.backend, 'pro', build_repair_prompt(text, analysis.text, analysis.problems),
+                                       instruction, assembled, deadline)
+        return self._reask_outcome(analysis, retry)
+
+    @staticmethod
+    def _count_reask():
+        metrics.inc('ascod_response_repairs_total', {'kind': 'reask'})
+
+    @staticmethod
+    def _reask_outcome(analysis, retry) -> AIAnalysis:
+        if retry is not None and retry.result is not None:
+            return dataclasses.replace(retry, repairs=['reask'] + (retry.repairs or []))
+        if retry is not None and retry.failure:
+            return retry
+        metrics.inc('ascod_response_repairs_total', {'kind': 'invalid'})
+        problems = retry.problems if retry is not None else analysis.problems
+        return dataclasses.replace(analysis, failure='invalid', problems=problems)
+
+    def _complex_reasons(self, text, complex_case) -> List[str]:
+        """Motivos para enviar o caso direto ao pro, sem passar pelo modelo rápido."""
+        if complex_case:
+            reasons = ['Caso marcado como complexo.']
+        elif len(text) > self.complex_chars:
+            reasons = [f'Texto clínico longo ({len(text)} caracteres).']
+        else:
+            return []
+        metrics.inc('ascod_routing_total', {'tier': 'pro', 'reason': 'complex'})
+        return reasons
+
+    def _review(self, analysis: AIAnalysis) -> List[str]:
+        """
+        Valida a resposta do modelo rápido; a lista de problemas vazia significa que ela é aceita.
+        Resposta que precisou de reparo local (JSON cercado de texto, truncado, justificativa vazia) vai para o pro.
+        """
+        if analysis.result is None:
+            problems = analysis.problems or ['A resposta do modelo rápido não é válida.']
+        elif analysis.repairs:
+            problems = [f"A resposta do modelo rápido precisou de reparos ({', '.join(analysis.repairs)})."]
+        else:
+            problems = []
+        metrics.inc('ascod_routing_total', {'tier': 'pro' if problems else 'fast', 'reason': 'invalid' if problems else 'validated'})
+        return problems
+
+    def _assemble_prompt(self, text, structured=False) -> Tuple[AssembledPrompt, str, Optional[str]]:
+        """Instrução do sistema para o caso (None = a padrão do backend) e o prompt do paciente."""
+        assembled = self.prompts.build(text, structured)
+        instruction = assembled.system_instruction if assembled.pruned else None
+        return assembled, build_user_prompt(text), instruction
+
+    def _model_analysis(self, response: ModelResponse, assembled: AssembledPrompt, backend=None, tier='pro') -> AIAnalysis:
+        metrics.inc('ascod_model_calls_total', {'outcome': 'success', 'tier': tier})
+        metrics.record_usage(response.usage)
+        metrics.inc('ascod_prompt_chars_total', {'pruned': str(assembled.pruned).lower()}, len(assembled.system_instruction))
+        with metrics.time_stage('json_decode'):
+            result, problems, repairs = repair_response(response.text)
+        for kind in repairs:
+            metrics.inc('ascod_response_repairs_total', {'kind': kind})
+        # Respostas válidas são guardadas já normalizadas (graus inteiros, ordem canônica)
+        return AIAnalysis(text=result.to_json() if result else response.text, model=(backend or self.backend).model_id,
+                          usage=response.usage, prompt_size=assembled.size(), tier=tier,
+                          result=result, problems=problems or None, repairs=repairs or None)
+
+    def _error_analysis(self, e, backend=None, tier='pro') -> AIAnalysis:
+        if isinstance(e, CircuitOpenError):
+            failure = 'circuit_open'
+        elif isinstance(e, (DeadlineExceeded, UpstreamTimeout)):
+            failure = 'deadline'
+        else:
+            failure = 'upstream'
+        metrics.inc('ascod_model_calls_total', {'outcome': failure, 'tier': tier})
+        print(f"Error during AI analysis: {e}")
+        # Em caso de erro, retorna um JSON de erro para consistência
+        error_response = {
+            "error": "Failed to get a valid response from AI model.",
+            "details": str(e)
+        }
+        return AIAnalysis(text=json.dumps(error_response), model=(backend or self.backend).model_id, tier=tier,
+                          failure=failure, problems=[f"O modelo retornou erro: {e}"])
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description='Classificador ASCOD/TOAST com Gemini')
+    parser.add_argument('text', help='Resumo clínico do paciente')
+    parser.add_argument('--tokens', action='store_true', help='Apenas compara a contagem de tokens de entrada (antes/depois)')
+    args = parser.parse_args()
+
+    classifier = ASCODClassifier()
+    if args.tokens:
+        print(json.dumps(classifier.count_prompt_tokens(args.text), indent=2))
+    else:
+        analysis = classifier.analyze(args.text)
+        print(analysis.text)
+        if analysis.usage:
+            print(json.dumps(analysis.usage, indent=2), file=sys.stderr)
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark de carga e latência do /api/analyze
+
+Executa o app Flask em processo (test client) ou via HTTP contra um servidor
+local, variando a concorrência, e grava vazão, percentis de latência e taxas
+de erro em JSON para comparar versões do app.py / ascod_classifier.py.
+
+Exemplos:
+    ASCOD_BACKEND=simulator ASCOD_SIM_LATENCY_MS=200 python benchmark.py --concurrency 1,8,32
+    python benchmark.py --mode http --start-server --backend simulator --output bench.json
+    python benchmark.py --compare bench_antigo.json --output bench_novo.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import platform
+import datetime
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import fields
+from typing import Dict, List, Optional
+
+import requests
+
+from ascod_classifier import PatientData
+
+DEFAULT_OUTPUT = 'benchmark_results.json'
+
+# Frases de texto livre combinadas aleatoriamente para o corpus
+TEXT_FRAGMENTS = [
+    "Paciente de 68 anos, hipertenso e diabético, com hemiparesia direita súbita.",
+    "Angiotomografia mostra estenose de 70% na carótida interna esquerda.",
+    "Ecocardiograma transtorácico com FEVE de 30% e acinesia apical.",
+    "Holter de 24 horas documentou fibrilação atrial paroxística.",
+    "RM de crânio com infarto lacunar em cápsula interna e leucoaraiose moderada.",
+    "Forame oval patente com aneurisma de septo atrial ao ecocardiograma transesofágico.",
+    "Angio-RM cervical evidencia dissecção de artéria vertebral com hematoma mural.",
+    "Investigação para trombofilia e síndrome antifosfolípide negativa.",
+    "Doppler de carótidas sem estenoses significativas.",
+    "Antecedente de infarto agudo do miocárdio há 5 anos e doença arterial periférica.",
+    "Sem alterações ao ecocardiograma e Holter sem arritmias.",
+    "Neoplasia de pulmão em tratamento quimioterápico.",
+]
+
+
+def build_corpus(size: int, text_ratio: float, seed: int) -> List[Dict]:
+    """Gera um corpus determinístico de casos estruturados e de texto livre."""
+    rng = random.Random(seed)
+    bool_fields = [f.name for f in fields(PatientData) if f.type == bool]
+    cases = []
+    for _ in range(size):
+        if rng.random() < text_ratio:
+            text = ' '.join(rng.sample(TEXT_FRAGMENTS, rng.randint(2, 5)))
+            cases.append({'type': 'text', 'text': text})
+            continue
+        case = {'type': 'structured', 'stenosis': str(rng.choice([0, 0, 20, 40, 55, 70, 90]))}
+        if rng.random() < 0.3:
+            case['lvef'] = str(rng.choice([25, 40, 60]))
+        if rng.random() < 0.3:
+            case['infarct_type'] = rng.choice(['lacunar', 'cortical_large', 'none'])
+        for name in rng.sample(bool_fields, rng.randint(0, 3)):
+            case[name] = 'true'
+        cases.append(case)
+    return cases
+
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    """Percentil pelo método do posto mais próximo."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(pct / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(samples: List[Dict], elapsed: float) -> Dict:
+    """Agrega amostras (latência, tipo, erro) em vazão, percentis e taxas de erro."""
+    latencies = sorted(s['latency_ms'] for s in samples)
+    errors = {}
+    for s in samples:
+        if s['error']:
+            errors[s['error']] = errors.get(s['error'], 0) + 1
+    total_errors = sum(errors.values())
+    return {
+        'requests': len(samples),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(samples) / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 2) if latencies else None,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None,
+        },
+        'errors': errors,
+        'error_rate': round(total_errors / len(samples), 4) if samples else 0,
+        'cached': sum(1 for s in samples if s.get('cached')),
+    }
+
+
+def classify_outcome(status: int, body: Optional[Dict]) -> Optional[str]:
+    """Classifica o resultado de uma requisição; None quando bem-sucedida."""
+    if status >= 500:
+        return 'http_5xx'
+    if status >= 400:
+        return 'http_4xx'
+    if not body or not body.get('success'):
+        return 'analysis_error'
+    # A IA pode responder 200 com JSON de erro ou sem o código ASCOD
+    if body.get('error') or body.get('ascod_code') in (None, 'N/A'):
+        return 'invalid_result'
+    return None
+
+
+class InProcessClient:
+    """Chama o app Flask diretamente pelo test client (sem rede nem servidor WSGI)."""
+
+    def __init__(self):
+        from app import app
+        self.app = app
+        self._local = threading.local()
+
+    def post(self, payload: Dict):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.post('/api/analyze', json=payload)
+        return response.status_code, response.get_json(silent=True)
+
+
+class HttpClient:
+    """Chama o /api/analyze de um servidor em execução."""
+
+    def __init__(self, base_url: str, timeout: float):
+        self.url = base_url.rstrip('/') + '/api/analyze'
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def post(self, payload: Dict):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        response = session.post(self.url, json=payload, timeout=self.timeout)
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        return response.status_code, body
+
+
+def run_level(client, corpus: List[Dict], concurrency: int, total: int) -> Dict:
+    """Executa `total` requisições com `concurrency` threads e resume por tipo de caso."""
+    samples = []
+    lock = threading.Lock()
+
+    def one(i):
+        payload = corpus[i % len(corpus)]
+        start = time.perf_counter()
+        try:
+            status, body = client.post(payload)
+            error = classify_outcome(status, body)
+            cached = bool(body and body.get('cached'))
+        except Exception:
+            error, cached = 'transport', False
+        sample = {
+            'type': payload['type'],
+            'latency_ms': round((time.perf_counter() - start) * 1000, 3),
+            'error': error,
+            'cached': cached,
+        }
+        with lock:
+            samples.append(sample)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(total)))
+    elapsed = time.perf_counter() - start
+
+    level = {'concurrency': concurrency, 'overall': summarize(samples, elapsed), 'by_type': {}}
+    for case_type in sorted({s['type'] for s in samples}):
+        level['by_type'][case_type] = summarize([s for s in samples if s['type'] == case_type], elapsed)
+    return level
+
+
+def start_server(port: int, env: Dict) -> subprocess.Popen:
+    """Inicia o gunicorn local com a configuração do repositório e aguarda a porta responder."""
+    cmd = [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}', 'app:app']
+    process = subprocess.Popen(cmd, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'O servidor encerrou ao iniciar (código {process.returncode}).')
+        try:
+            requests.get(f'http://127.0.0.1:{port}/', timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('O servidor não respondeu em 30 segundos.')
+
+
+def source_fingerprint() -> Dict:
+    """Commit e hash dos módulos principais, para identificar a versão medida."""
+    base = os.path.dirname(os.path.abspath(__file__))
+    fingerprint = {}
+    for name in ('app.py', 'ascod_classifier.py'):
+        with open(os.path.join(base, name), 'rb') as f:
+            fingerprint[name] = hashlib.sha256(f.read()).hexdigest()[:12]
+    try:
+        fingerprint['git_commit'] = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=base, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        fingerprint['git_commit'] = None
+    return fingerprint
+
+
+def compare(previous: Dict, current: Dict):
+    """Imprime a variação de vazão e p99 em relação a um resultado anterior."""
+    old_levels = {lvl['concurrency']: lvl['overall'] for lvl in previous.get('levels', [])}
+    print(f"\nComparação com {previous.get('source', {}).get('git_commit')} ({previous.get('timestamp')}):")
+    for lvl in current['levels']:
+        old = old_levels.get(lvl['concurrency'])
+        if not old:
+            continue
+        new = lvl['overall']
+
+        def delta(a, b):
+            return f"{(b - a) / a * 100:+.1f}%" if a and b is not None else 'n/d'
+
+        print(f"  c={lvl['concurrency']:<4} vazão {delta(old['throughput_rps'], new['throughput_rps']):>8}"
+              f"   p99 {delta(old['latency_ms']['p99'], new['latency_ms']['p99']):>8}"
+              f"   erros {old['error_rate']:.2%} -> {new['error_rate']:.2%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de carga do /api/analyze')
+    parser.add_argument('--mode', choices=['inproc', 'http'], default='inproc')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='Servidor alvo no modo http')
+    parser.add_argument('--start-server', action='store_true', help='Inicia um gunicorn local para o modo http')
+    parser.add_argument('--port', type=int, default=5055, help='Porta do servidor iniciado com --start-server')
+    parser.add_argument('--backend', choices=['gemini', 'simulator'], help='Define ASCOD_BACKEND para o app medido')
+    parser.add_argument('--concurrency', default='1,4,16,64', help='Níveis de concorrência separados por vírgula')
+    parser.add_argument('--requests', type=int, default=200, help='Requisições por nível')
+    parser.add_argument('--corpus-size', type=int, default=100)
+    parser.add_argument('--text-ratio', type=float, default=0.5, help='Fração de casos em texto livre')
+    parser.add_argument('--engine', choices=['rules', 'ai', 'hybrid'], help='Força o motor para os casos estruturados')
+    parser.add_argument('--no-cache', action='store_true', help='Envia no_cache em todas as requisições')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--compare', help='Resultado anterior (JSON) para comparação')
+    args = parser.parse_args()
+
+    if args.backend:
+        os.environ['ASCOD_BACKEND'] = args.backend
+    # O corpus sintético não entra no histórico de classificações
+    os.environ['ASCOD_HISTORY_ENABLED'] = 'false'
+
+    corpus = build_corpus(args.corpus_size, args.text_ratio, args.seed)
+    for case in corpus:
+        if args.engine and case['type'] == 'structured':
+            case['engine'] = args.engine
+        if args.no_cache:
+            case['no_cache'] = True
+
+    server = None
+    if args.mode == 'http':
+        if args.start_server:
+            server = start_server(args.port, dict(os.environ))
+            args.url = f'http://127.0.0.1:{args.port}'
+        client = HttpClient(args.url, args.timeout)
+    else:
+        client = InProcessClient()
+
+    levels = []
+    try:
+        for concurrency in [int(c) for c in args.concurrency.split(',') if c.strip()]:
+            level = run_level(client, corpus, concurrency, args.requests)
+            levels.append(level)
+            overall = level['overall']
+            print(f"c={concurrency:<4} {overall['throughput_rps']:>9} req/s   "
+                  f"p50 {overall['latency_ms']['p50']:>9} ms   p95 {overall['latency_ms']['p95']:>9} ms   "
+                  f"p99 {overall['latency_ms']['p99']:>9} ms   erros {overall['error_rate']:.2%}")
+    finally:
+        if server:
+            server.terminate()
+            server.wait(timeout=30)
+
+    result = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'source': source_fingerprint(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'backend': os.getenv('ASCOD_BACKEND', 'gemini'),
+        },
+        'config': {
+            'mode': args.mode,
+            'url': args.url if args.mode == 'http' else None,
+            'requests_per_level': args.requests,
+            'corpus_size': args.corpus_size,
+            'text_ratio': args.text_ratio,
+            'engine': args.engine,
+            'no_cache': args.no_cache,
+            'seed': args.seed,
+        },
+        'levels': levels,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\nResultados gravados em {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(json.load(f), result)
+
+
+if __name__ == "__main__":
+    main()
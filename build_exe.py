@@ -40,6 +40,9 @@ a = Analysis(
         'flask',
         'flask_cors',
         'requests',
+        'dotenv',
+        # Importado sob demanda pelo backend gemini (model_backends.load_genai)
+        'google.generativeai',
         'json',
         'os',
         'sys'
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Classificação em lote de registros de AVC (CSV ou JSONL)
+
+Lê a entrada linha a linha (memória constante), preenche o PatientData com a
+mesma coerção do /api/analyze, classifica com um pool limitado de threads e
+grava cada resultado assim que fica pronto, na ordem da entrada. Um checkpoint
+ao lado da saída permite retomar o processamento após uma interrupção.
+
+Exemplos:
+    python cohort.py registro.csv resultados.jsonl
+    python cohort.py registro.jsonl resultados.csv --engine hybrid --workers 16
+    python cohort.py evolucoes.csv resultados.jsonl --text-column evolucao
+    python cohort.py evolucoes.csv resultados.jsonl --text-column evolucao --route-text 0.9
+    python cohort.py registro.csv resultados.jsonl --resume
+    python cohort.py registro.csv graus.csv --vectorized --chunk-size 50000
+"""
+
+import os
+import sys
+import csv
+import io
+import json
+import time
+import argparse
+import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import fields
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from ascod_classifier import ASCOD_CATEGORIES, TOAST_CLASSES, ASCODClassifier, ASCODRuleEngine, PatientData
+from note_trimmer import NoteTrimmer
+from text_extractor import TextExtractor
+
+ENGINES = ('rules', 'ai', 'hybrid')
+PATIENT_FIELDS = {f.name for f in fields(PatientData)}
+# Colunas da saída em CSV (na JSONL vão também 'ascod' e 'toast' completos)
+CSV_COLUMNS = ['row', 'id', 'success', 'engine', 'ascod_code', 'toast_code', *ASCOD_CATEGORIES,
+               'tier', 'cached', 'fallback', 'extraction_confidence', 'error']
+
+
+def detect_format(path: str, explicit: Optional[str] = None) -> str:
+    if explicit:
+        return explicit
+    return 'csv' if path.lower().endswith(('.csv', '.tsv')) else 'jsonl'
+
+
+def read_rows(path: str, fmt: str) -> Iterator[Dict]:
+    """Gera um dicionário por linha da entrada, sem carregar o arquivo inteiro."""
+    with open(path, newline='' if fmt == 'csv' else None, encoding='utf-8-sig') as f:
+        if fmt == 'csv':
+            delimiter = '\t' if path.lower().endswith('.tsv') else ','
+            yield from csv.DictReader(f, delimiter=delimiter)
+            return
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                row = {'__error__': f'JSON inválido: {e}'}
+            yield row if isinstance(row, dict) else {'__error__': 'A linha não é um objeto JSON.'}
+
+
+class RowClassifier:
+    """Classifica uma linha do registro com o motor escolhido (mesmas regras do /api/analyze)."""
+
+    def __init__(self, engine: str, text_column: Optional[str] = None, id_column: Optional[str] = None,
+                 use_cache: bool = True, fallback_to_rules: bool = True, vectorized: bool = False,
+                 route_text: Optional[float] = None):
+        self.engine = engine
+        # Motor de regras vetorizado (columnar.py, requer NumPy): só graus e TOAST, sem justificativas
+        self.vectorized = vectorized
+        self.text_column = text_column
+        self.id_column = id_column
+        self.use_cache = use_cache
+        self.fallback_to_rules = fallback_to_rules
+        self.rule_engine = ASCODRuleEngine()
+        self.classifier = ASCODClassifier() if engine in ('ai', 'hybrid') else None
+        # Confiança mínima da extração local para classificar o texto livre pelo motor de regras
+        self.route_text = route_text
+        self.text_extractor = TextExtractor() if route_text is not None else None
+        # Textos longos vão ao modelo podados para ASCOD_TEXT_TOKEN_BUDGET tokens
+        self.note_trimmer = NoteTrimmer() if text_column else None
+
+    def patient_data(self, row: Dict) -> PatientData:
+        # Células vazias valem como ausentes (usam o padrão do PatientData)
+        form_data = {k: v for k, v in row.items() if k in PATIENT_FIELDS and v not in ('', None)}
+        return PatientData.from_form(form_data)
+
+    def classify_many(self, batch: List[Tuple[int, Dict]]) -> List[Dict]:
+        if self.vectorized:
+            return self._classify_vectorized(batch)
+        return [self.classify(index, row) for index, row in batch]
+
+    def _classify_vectorized(self, batch: List[Tuple[int, Dict]]) -> List[Dict]:
+        from columnar import CohortColumns, evaluate_cohort
+
+        records, valid, patients = [], [], []
+        for index, row in batch:
+            record = {'row': index, 'id': row.get(self.id_column) if self.id_column else None}
+            try:
+                if '__error__' in row:
+                    raise ValueError(row['__error__'])
+                patients.append(self.patient_data(row))
+                valid.append(record)
+            except Exception as e:
+                record.update({'success': False, 'error': str(e)})
+            records.append(record)
+        if patients:
+            result = evaluate_cohort(CohortColumns.from_patients(patients))
+            codes, toast_keys = result.ascod_codes(), result.toast_keys()
+            for j, record in enumerate(valid):
+                toast = TOAST_CLASSES[toast_keys[j]]
+                record.update({
+                    'success': True,
+                    'engine': 'rules',
+                    'ascod_code': str(codes[j]),
+                    'toast_code': toast,
+                    'ascod': {cat: {'grade': int(result.grades[cat][j])} for cat in ASCOD_CATEGORIES},
+                    'toast': {'classification': toast},
+                })
+        return records
+
+    def classify(self, index: int, row: Dict) -> Dict:
+        record = {'row': index, 'id': row.get(self.id_column) if self.id_column else None}
+        try:
+            if '__error__' in row:
+                raise ValueError(row['__error__'])
+            record.update(self._classify(row))
+        except Exception as e:
+            record.update({'success': False, 'error': str(e)})
+        return record
+
+    def _classify(self, row: Dict) -> Dict:
+        patient = None
+        trimming = None
+        if self.text_column:
+            text = (row.get(self.text_column) or '').strip()
+            if not text:
+                raise ValueError(f"Coluna '{self.text_column}' vazia.")
+            if self.text_extractor:
+                extraction = self.text_extractor.extract(text)
+                if extraction.confidence >= self.route_text:
+                    record = self._record(self.rule_engine.evaluate(extraction.patient()), 'rules')
+                    record['extraction_confidence'] = extraction.confidence
+                    return record
+            trimmed = self.note_trimmer.trim(text)
+            if trimmed.trimmed:
+                text, trimming = trimmed.text, trimmed.to_dict()
+        else:
+            patient = self.patient_data(row)
+            text = patient.to_natural_language()
+
+        if self.engine == 'rules':
+            return self._record(self.rule_engine.evaluate(patient), 'rules')
+
+        analysis = self.classifier.analyze(text, use_cache=self.use_cache, patient=patient)
+        if analysis.failure:
+            if self.fallback_to_rules and patient is not None:
+                record = self._record(self.rule_engine.evaluate(patient), 'rules')
+                record['fallback'] = analysis.failure
+                return record
+            raise RuntimeError(f"Falha da IA ({analysis.failure}): {'; '.join(analysis.problems or [])}")
+        if self.engine == 'ai':
+            record = self._record(analysis.result, 'ai')
+        else:
+            record = self._record(self.rule_engine.evaluate(patient), 'hybrid')
+            record['second_opinion'] = {'ascod_code': analysis.result.ascod_code, 'toast_code': analysis.result.toast_code}
+        record.update({'tier': analysis.tier, 'cached': analysis.cached})
+        if trimming:
+            record['trimming'] = trimming
+        return record
+
+    @staticmethod
+    def _record(result, engine: str) -> Dict:
+        return {
+            'success': True,
+            'engine': engine,
+            'ascod_code': result.ascod_code,
+            'toast_code': result.toast_code,
+            **result.to_dict(),
+        }
+
+
+class ResultWriter:
+    """Grava os resultados em JSONL ou CSV, em modo append, com flush+fsync nos checkpoints."""
+
+    def __init__(self, path: str, fmt: str, resume_bytes: Optional[int] = None):
+        self.fmt = fmt
+        if resume_bytes is not None and os.path.exists(path):
+            self.file = open(path, 'r+', newline='', encoding='utf-8')
+            # Descarta o que foi escrito depois do último checkpoint
+            self.file.truncate(resume_bytes)
+            self.file.seek(resume_bytes)
+        else:
+            self.file = open(path, 'w', newline='', encoding='utf-8')
+        if fmt == 'csv' and self.file.tell() == 0:
+            csv.DictWriter(self.file, fieldnames=CSV_COLUMNS).writeheader()
+
+    def write_many(self, records: List[Dict]):
+        # Uma única escrita por lote: uma interrupção não deixa o lote pela metade
+        if self.fmt != 'csv':
+            self.file.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records))
+            return
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS, extrasaction='ignore')
+        for record in records:
+            grades = {cat: entry['grade'] for cat, entry in record.get('ascod', {}).items()}
+            writer.writerow({**record, **grades})
+        self.file.write(buffer.getvalue())
+
+    def sync(self) -> int:
+        """Garante que tudo foi para o disco e retorna o tamanho do arquivo."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class Checkpoint:
+    """Linhas já gravadas e o tamanho da saída nesse ponto, salvos de forma atômica."""
+
+    def __init__(self, output_path: str):
+        self.path = output_path + '.checkpoint.json'
+
+    def load(self) -> Optional[Dict]:
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def save(self, input_path: str, rows_done: int, output_bytes: int, errors: int):
+        state = {
+            'input': os.path.abspath(input_path),
+            'rows_done': rows_done,
+            'output_bytes': output_bytes,
+            'errors': errors,
+            'updated_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        }
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Progress:
+    """Relatório periódico de linhas/s no stderr."""
+
+    def __init__(self, interval: float, start_rows: int = 0):
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.start_rows = start_rows
+        self.last_report = self.start
+
+    def rate(self, rows_done: int) -> float:
+        elapsed = time.perf_counter() - self.start
+        return (rows_done - self.start_rows) / elapsed if elapsed > 0 else 0.0
+
+    def maybe_report(self, rows_done: int, errors: int):
+        now = time.perf_counter()
+        if self.interval and now - self.last_report >= self.interval:
+            self.last_report = now
+            print(f"{rows_done} linhas | {self.rate(rows_done):.1f} linhas/s | {errors} erros", file=sys.stderr)
+
+
+def run(args) -> Tuple[int, int, float]:
+    """Processa a entrada; retorna (linhas gravadas, erros, linhas/s nesta execução)."""
+    input_format = detect_format(args.input, args.input_format)
+    output_format = detect_format(args.output, args.output_format)
+    checkpoint = Checkpoint(args.output)
+    state = checkpoint.load()
+    if state and not args.resume and not args.overwrite:
+        raise SystemExit(f"Existe um checkpoint em {checkpoint.path}: use --resume para continuar ou --overwrite para recomeçar.")
+    if args.resume and state and state['input'] != os.path.abspath(args.input):
+        raise SystemExit(f"O checkpoint é de outra entrada: {state['input']}")
+    if not (args.resume and state):
+        state = None
+
+    rows_done = state['rows_done'] if state else 0
+    errors = state['errors'] if state else 0
+    if state:
+        print(f"Retomando após {rows_done} linhas.", file=sys.stderr)
+
+    engine = args.engine or ('ai' if args.text_column else 'rules')
+    row_classifier = RowClassifier(engine, text_column=args.text_column, id_column=args.id_column,
+                                   use_cache=not args.no_cache, fallback_to_rules=not args.no_fallback,
+                                   vectorized=args.vectorized, route_text=args.route_text)
+    # Cada tarefa do pool é um lote de linhas (uma só, exceto no modo vetorizado)
+    batch_size = args.chunk_size if args.vectorized else 1
+    writer = ResultWriter(args.output, output_format, resume_bytes=state['output_bytes'] if state else None)
+    progress = Progress(args.progress_interval, start_rows=rows_done)
+    # Janela limitada de lotes em andamento: memória constante e escrita na ordem da entrada
+    window = deque()
+    max_in_flight = args.workers * 2
+    last_checkpoint = rows_done
+
+    def write_next():
+        nonlocal rows_done, errors, last_checkpoint
+        # Só remove da janela depois de gravar: uma interrupção durante a espera não perde o lote
+        records = window[0].result()
+        writer.write_many(records)
+        window.popleft()
+        rows_done += len(records)
+        errors += sum(1 for record in records if not record.get('success'))
+        if rows_done - last_checkpoint >= args.checkpoint_every:
+            checkpoint.save(args.input, rows_done, writer.sync(), errors)
+            last_checkpoint = rows_done
+        progress.maybe_report(rows_done, errors)
+
+    def submit(batch):
+        window.append(executor.submit(row_classifier.classify_many, batch))
+        if len(window) >= max_in_flight:
+            write_next()
+
+    executor = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='ascod-cohort')
+    try:
+        batch = []
+        for index, row in enumerate(read_rows(args.input, input_format)):
+            if index < rows_done:
+                continue
+            if args.limit is not None and index >= args.limit:
+                break
+            batch.append((index, row))
+            if len(batch) >= batch_size:
+                submit(batch)
+                batch = []
+        if batch:
+            submit(batch)
+        while window:
+            write_next()
+    except KeyboardInterrupt:
+        # Grava as linhas já concluídas em ordem e descarta o restante
+        while window and window[0].done():
+            write_next()
+        for future in window:
+            future.cancel()
+        checkpoint.save(args.input, rows_done, writer.sync(), errors)
+        writer.close()
+        executor.shutdown(wait=False, cancel_futures=True)
+        print(f"\nInterrompido após {rows_done} linhas; use --resume para continuar.", file=sys.stderr)
+        raise SystemExit(130)
+
+    writer.sync()
+    writer.close()
+    executor.shutdown()
+    checkpoint.clear()
+    return rows_done, errors, progress.rate(rows_done)
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Classificação ASCOD/TOAST em lote de registros CSV ou JSONL')
+    parser.add_argument('input', help='Arquivo de entrada (.csv, .tsv ou .jsonl)')
+    parser.add_argument('output', help='Arquivo de saída (.jsonl ou .csv)')
+    parser.add_argument('--input-format', choices=('csv', 'jsonl'), help='Formato da entrada (padrão: pela extensão)')
+    parser.add_argument('--output-format', choices=('csv', 'jsonl'), help='Formato da saída (padrão: pela extensão)')
+    parser.add_argument('--engine', choices=ENGINES, help='Motor de análise (padrão: rules; ai com --text-column)')
+    parser.add_argument('--text-column', help='Coluna com texto clínico livre (em vez dos campos do PatientData)')
+    parser.add_argument('--route-text', type=float, metavar='CONFIANÇA',
+                        help='Com --text-column, usa o motor de regras nos textos cuja extração local atinge a confiança (0 a 1)')
+    parser.add_argument('--id-column', help='Coluna copiada para o campo id da saída')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('ASCOD_COHORT_WORKERS', 8)), help='Linhas classificadas em paralelo')
+    parser.add_argument('--checkpoint-every', type=int, default=500, help='Linhas entre checkpoints')
+    parser.add_argument('--progress-interval', type=float, default=5.0, help='Segundos entre relatórios de progresso (0 desativa)')
+    parser.add_argument('--limit', type=int, help='Processa apenas as primeiras N linhas')
+    parser.add_argument('--resume', action='store_true', help='Continua a partir do checkpoint da saída')
+    parser.add_argument('--overwrite', action='store_true', help='Ignora um checkpoint existente e recomeça')
+    parser.add_argument('--no-cache', action='store_true', help='Ignora o cache de respostas da IA')
+    parser.add_argument('--no-fallback', action='store_true', help='Não usa o motor de regras quando a IA falha')
+    parser.add_argument('--vectorized', action='store_true', help='Motor de regras vetorizado com NumPy (sem justificativas)')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='Linhas por lote no modo vetorizado')
+    args = parser.parse_args()
+    if args.workers < 1 or args.checkpoint_every < 1:
+        parser.error('--workers e --checkpoint-every devem ser positivos.')
+    if args.text_column and args.engine in ('rules', 'hybrid'):
+        parser.error('O motor de regras requer entrada estruturada (sem --text-column).')
+    if args.route_text is not None and not (args.text_column and 0 < args.route_text <= 1):
+        parser.error('--route-text requer --text-column e uma confiança entre 0 e 1.')
+    if args.vectorized and (args.text_column or args.engine not in (None, 'rules')):
+        parser.error('--vectorized se aplica apenas ao motor de regras.')
+
+    rows_done, errors, rate = run(args)
+    print(f"Concluído: {rows_done} linhas, {errors} erros, {rate:.1f} linhas/s -> {args.output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
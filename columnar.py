@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Coorte em formato colunar (NumPy) e avaliação vetorizada dos graus ASCOD e da classe TOAST
+
+Os campos booleanos do PatientData ficam em uma máscara de bits por paciente
+(uint64), estenose e FEVE em colunas float (NaN = não informado) e o tipo de
+infarto em códigos uint8. evaluate_cohort aplica as mesmas regras do
+ASCODRuleEngine sobre as colunas inteiras; verify_against_rules confere o
+resultado paciente a paciente.
+
+Exemplo (gera uma coorte aleatória, mede e verifica):
+    python columnar.py --size 1000000 --verify 100000
+"""
+
+import sys
+import time
+import random
+import argparse
+from operator import attrgetter
+from dataclasses import dataclass, fields
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+from ascod_classifier import ASCOD_CATEGORIES, TOAST_CLASSES, ASCODRuleEngine, PatientData
+
+BOOL_FIELDS = tuple(f.name for f in fields(PatientData) if f.type == bool)
+INT_FIELDS = tuple(f.name for f in fields(PatientData) if f.type == Optional[int])
+# Valores do formulário (usados na coorte aleatória)
+INFARCT_TYPES = ('none', 'cortical_large', 'subcortical_small_lacunar')
+# Índice de cada classe TOAST nas colunas de resultado
+TOAST_KEYS = tuple(TOAST_CLASSES)
+
+assert len(BOOL_FIELDS) <= 64, 'A máscara de bits comporta no máximo 64 campos booleanos.'
+BIT = {name: np.uint64(1 << i) for i, name in enumerate(BOOL_FIELDS)}
+
+
+@dataclass
+class CohortColumns:
+    """PatientData de uma coorte inteira em colunas NumPy."""
+    bits: np.ndarray                 # uint64, um bit por campo de BOOL_FIELDS
+    numbers: Dict[str, np.ndarray]   # float64 por campo de INT_FIELDS; NaN = None
+    infarct_type: np.ndarray         # uint8, índice em infarct_types
+    infarct_types: Sequence[str]
+
+    def __len__(self) -> int:
+        return len(self.bits)
+
+    @classmethod
+    def from_patients(cls, patients: Iterable[PatientData]) -> 'CohortColumns':
+        getter = attrgetter(*BOOL_FIELDS, *INT_FIELDS, 'infarct_type')
+        rows = [getter(p) for p in patients]
+        n_bools = len(BOOL_FIELDS)
+        columns = list(zip(*rows)) if rows else [()] * (n_bools + len(INT_FIELDS) + 1)
+        values = {name: columns[i] for i, name in enumerate(BOOL_FIELDS)}
+        for j, name in enumerate(INT_FIELDS):
+            values[name] = columns[n_bools + j]
+        values['infarct_type'] = columns[-1]
+        return cls.from_columns(values, len(rows))
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, Sequence], size: int) -> 'CohortColumns':
+        """
+        Monta a coorte a partir de colunas já tipadas (bool, int/None, str), ex.: de um
+        DataFrame ou de arquivos colunares; campos ausentes usam o padrão do PatientData.
+        """
+        defaults = {f.name: f.default for f in fields(PatientData)}
+        bits = np.zeros(size, dtype=np.uint64)
+        for i, name in enumerate(BOOL_FIELDS):
+            if name in columns:
+                bits |= np.asarray(columns[name], dtype=bool).astype(np.uint64) << np.uint64(i)
+            elif defaults[name]:
+                bits |= BIT[name]
+        numbers = {}
+        for name in INT_FIELDS:
+            column = columns.get(name)
+            if column is None:
+                default = defaults[name]
+                numbers[name] = np.full(size, np.nan if default is None else default, dtype=np.float64)
+            else:
+                # None vira NaN na conversão para float
+                numbers[name] = np.array(column, dtype=np.float64)
+        infarct = columns.get('infarct_type')
+        if infarct is None:
+            infarct = [defaults['infarct_type']] * size
+        types, codes = np.unique(np.asarray(infarct, dtype=str), return_inverse=True)
+        if len(types) > 256:
+            raise ValueError('Tipos de infarto demais para a coluna uint8.')
+        return cls(bits=bits, numbers=numbers, infarct_type=codes.astype(np.uint8).reshape(-1),
+                   infarct_types=tuple(str(t) for t in types))
+
+    def flag(self, name: str) -> np.ndarray:
+        """Coluna booleana de um campo da máscara de bits."""
+        return (self.bits & BIT[name]) != 0
+
+    def infarct_is(self, value: str) -> np.ndarray:
+        if value not in self.infarct_types:
+            return np.zeros(len(self), dtype=bool)
+        return self.infarct_type == self.infarct_types.index(value)
+
+    def patient(self, i: int) -> PatientData:
+        """Reconstrói o PatientData da linha i."""
+        values = {name: bool(self.bits[i] & BIT[name]) for name in BOOL_FIELDS}
+        for name in INT_FIELDS:
+            number = self.numbers[name][i]
+            values[name] = None if np.isnan(number) else int(number)
+        values['infarct_type'] = self.infarct_types[self.infarct_type[i]]
+        return PatientData(**values)
+
+
+@dataclass
+class CohortGrades:
+    """Graus ASCOD (uint8) e classe TOAST (índice em TOAST_KEYS) de cada paciente."""
+    grades: Dict[str, np.ndarray]
+    toast: np.ndarray
+
+    def toast_keys(self) -> np.ndarray:
+        return np.array(TOAST_KEYS)[self.toast]
+
+    def ascod_codes(self) -> np.ndarray:
+        """Códigos no formato A1S9C0O0D0."""
+        codes = np.full(len(self.toast), '', dtype='<U10')
+        for cat in ASCOD_CATEGORIES:
+            codes = np.char.add(np.char.add(codes, cat), self.grades[cat].astype('<U1'))
+        return codes
+
+    def counts(self) -> Dict[str, int]:
+        """Pacientes por classe TOAST."""
+        totals = np.bincount(self.toast, minlength=len(TOAST_KEYS))
+        return {key: int(total) for key, total in zip(TOAST_KEYS, totals)}
+
+
+def _grade(findings_1, findings_2, findings_3, excluded=None) -> np.ndarray:
+    """Grau mais causal entre os achados (1 > 2 > 3); senão 0 (excluído) ou 9, como em ASCODRuleEngine._pick."""
+    default = np.where(excluded, 0, 9) if excluded is not None else 9
+    return np.select([findings_1, findings_2, findings_3], [1, 2, 3], default=default).astype(np.uint8)
+
+
+def evaluate_cohort(cohort: CohortColumns) -> CohortGrades:
+    """Aplica as regras de ASCODRuleEngine a todas as linhas de uma vez."""
+    f = cohort.flag
+    # Comparações com NaN são falsas, como os testes de None do caminho por paciente
+    with np.errstate(invalid='ignore'):
+        stenosis = cohort.numbers['stenosis']
+        lvef = cohort.numbers['lvef']
+        a = _grade(
+            (stenosis >= 50) | f('a1_stenosis_lt_50_thrombus') | f('a1_aortic_mobile_thrombus'),
+            ((stenosis >= 30) & (stenosis < 50)) | f('a2_aortic_plaque_ge_4mm'),
+            ((stenosis > 0) & (stenosis < 30)) | f('a3_history_mi_pad'),
+        )
+        low_lvef = lvef < 30
+
+    lacunar = cohort.infarct_is('subcortical_small_lacunar')
+    s1 = (lacunar & (f('s1_lacunar_infarct_syndrome') | f('s_has_htn_or_dm'))) | f('s1_lacunar_plus_severe_leuko')
+    s = _grade(s1, lacunar & ~s1, f('s3_severe_leuko_isolated'))
+
+    embolic_pattern = cohort.infarct_is('cortical_large')
+    c1 = low_lvef | (f('c2_pfo_asa') & embolic_pattern)
+    for name in BOOL_FIELDS:
+        if name.startswith('c1_'):
+            c1 |= f(name)
+    c = _grade(c1, f('c2_pfo_asa') & ~embolic_pattern, f('c3_pfo_isolated'))
+
+    o1 = np.zeros(len(cohort), dtype=bool)
+    for name in BOOL_FIELDS:
+        if name.startswith('o1_'):
+            o1 |= f(name)
+    o = _grade(o1, f('o2_migraine_with_aura'), f('o3_malignancy'), excluded=f('o0_other_causes_excluded'))
+    d = _grade(f('d1_direct'), f('d2_weak_evidence'), np.zeros(len(cohort), dtype=bool),
+               excluded=f('d0_dissection_excluded'))
+
+    grades = {'A': a, 'S': s, 'C': c, 'O': o, 'D': d}
+    return CohortGrades(grades, derive_toast_columns(grades))
+
+
+def derive_toast_columns(grades: Dict[str, np.ndarray]) -> np.ndarray:
+    """Versão vetorizada de derive_toast; retorna índices em TOAST_KEYS."""
+    # Uma causa por classe TOAST (O e D contam juntas como TOAST 4)
+    causes = {
+        '1': grades['A'] == 1,
+        '2': grades['C'] == 1,
+        '3': grades['S'] == 1,
+        '4': (grades['O'] == 1) | (grades['D'] == 1),
+    }
+    n_classes = sum(mask.astype(np.uint8) for mask in causes.values())
+    complete = np.logical_and.reduce([grades[cat] != 9 for cat in ASCOD_CATEGORIES])
+    conditions = [n_classes >= 2] + [(n_classes == 1) & mask for mask in causes.values()] + [complete]
+    choices = [TOAST_KEYS.index(key) for key in ('5a', '1', '2', '3', '4', '5b')]
+    return np.select(conditions, choices, default=TOAST_KEYS.index('5c')).astype(np.uint8)
+
+
+def verify_against_rules(cohort: CohortColumns, result: CohortGrades, rows: Optional[Iterable[int]] = None) -> List[Dict]:
+    """Compara com ASCODRuleEngine.evaluate linha a linha; retorna as divergências."""
+    engine = ASCODRuleEngine()
+    mismatches = []
+    for i in (rows if rows is not None else range(len(cohort))):
+        expected = engine.evaluate(cohort.patient(i))
+        got = {cat: int(result.grades[cat][i]) for cat in ASCOD_CATEGORIES}
+        toast = TOAST_KEYS[result.toast[i]]
+        if got != expected.grades or toast != expected.toast_key:
+            mismatches.append({'row': i, 'expected': (expected.ascod_code, expected.toast_key),
+                               'got': (''.join(f'{cat}{got[cat]}' for cat in ASCOD_CATEGORIES), toast)})
+    return mismatches
+
+
+def random_patients(size: int, seed: int = 0) -> Iterable[PatientData]:
+    """Pacientes aleatórios cobrindo os limiares das regras (estenose 30/50%, FEVE 30%)."""
+    rng = random.Random(seed)
+    stenosis_values = [None, 0, 1, 29, 30, 49, 50, 70, 100]
+    lvef_values = [None, 20, 29, 30, 34, 60]
+    for _ in range(size):
+        values = {name: rng.random() < 0.08 for name in BOOL_FIELDS}
+        values['stenosis'] = rng.choice(stenosis_values)
+        values['lvef'] = rng.choice(lvef_values)
+        values['infarct_type'] = rng.choice(INFARCT_TYPES)
+        yield PatientData(**values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Avaliação vetorizada ASCOD/TOAST de uma coorte aleatória')
+    parser.add_argument('--size', type=int, default=1_000_000, help='Pacientes na coorte')
+    parser.add_argument('--verify', type=int, default=100_000, help='Pacientes conferidos com o caminho por paciente (0 = nenhum)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    patients = list(random_patients(args.size, args.seed))
+    start = time.perf_counter()
+    cohort = CohortColumns.from_patients(patients)
+    build_time = time.perf_counter() - start
+    del patients
+
+    start = time.perf_counter()
+    result = evaluate_cohort(cohort)
+    eval_time = time.perf_counter() - start
+    print(f"{args.size} pacientes: montagem {build_time:.2f}s, avaliação vetorizada {eval_time:.3f}s "
+          f"({args.size / eval_time:,.0f} pacientes/s)")
+    print(f"TOAST: {result.counts()}")
+
+    if args.verify:
+        rows = range(min(args.verify, args.size))
+        start = time.perf_counter()
+        mismatches = verify_against_rules(cohort, result, rows)
+        per_patient = time.perf_counter() - start
+        print(f"Verificação de {len(rows)} pacientes pelo caminho por paciente: {per_patient:.2f}s "
+              f"({len(rows) / per_patient:,.0f} pacientes/s), {len(mismatches)} divergências")
+        for mismatch in mismatches[:10]:
+            print(mismatch)
+        if mismatches:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Avaliação de acurácia e latência contra um conjunto de casos rotulados (padrão-ouro)
+
+Executa cada caso de gold_cases.jsonl (estruturado ou texto livre, com os graus
+ASCOD e a classe TOAST esperados) pelos motores escolhidos, em paralelo e em
+processo, e compara lado a lado: concordância e kappa por categoria, acerto do
+código ASCOD completo e da classe TOAST, matrizes de confusão, latência e tokens.
+
+Com --replay a IA responde a partir de respostas gravadas (ASCOD_RECORD_DIR),
+sem rede nem chave de API, o que permite usar a avaliação como gate para
+mudanças no ASCOD_SYSTEM_INSTRUCTION ou no modelo. As gravações são feitas
+uma vez com --record contra o modelo real.
+
+Exemplos:
+    python evaluate.py --engines rules,ai --record gravacoes/ --output avaliacao.json
+    python evaluate.py --engines rules,ai --replay gravacoes/ --compare avaliacao.json
+    python evaluate.py --replay gravacoes/ --min-exact 0.8 --min-toast 0.9
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import datetime
+import platform
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from ascod_classifier import ASCOD_CATEGORIES, TOAST_CLASSES, VALID_GRADES, parse_toast_key
+from benchmark import InProcessClient, percentile, source_fingerprint
+from metrics import TOKEN_KINDS
+
+DEFAULT_CORPUS = 'gold_cases.jsonl'
+DEFAULT_OUTPUT = 'evaluation_results.json'
+
+GRADES = sorted(VALID_GRADES)
+TOAST_KEYS = list(TOAST_CLASSES)
+# Motores que aceitam cada tipo de entrada (o motor de regras não lê texto livre)
+ENGINE_INPUTS = {'rules': ('structured',), 'hybrid': ('structured',), 'ai': ('structured', 'text')}
+
+
+def parse_ascod_code(code: str) -> Dict[str, int]:
+    """Converte um código como A1S9C0O0D0 em {'A': 1, 'S': 9, ...}."""
+    code = (code or '').replace(' ', '').upper()
+    grades = {}
+    for i in range(0, len(code), 2):
+        cat, grade = code[i:i + 2][:1], code[i + 1:i + 2]
+        if cat not in ASCOD_CATEGORIES or not grade.isdigit() or int(grade) not in VALID_GRADES:
+            raise ValueError(f'Código ASCOD inválido: {code}')
+        grades[cat] = int(grade)
+    if sorted(grades) != sorted(ASCOD_CATEGORIES):
+        raise ValueError(f'O código ASCOD deve ter as cinco categorias: {code}')
+    return grades
+
+
+def load_corpus(path: str) -> List[Dict]:
+    """Lê e valida o corpus rotulado (uma linha JSON por caso)."""
+    cases, ids = [], set()
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('//'):
+                continue
+            try:
+                case = json.loads(line)
+                case_id = str(case['id'])
+                case_input = case['input']
+                expected = case['expected']
+                grades = parse_ascod_code(expected['ascod'])
+                toast = str(expected['toast']).lower()
+            except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+                raise ValueError(f'{path}:{line_number}: caso inválido ({e})')
+            if toast not in TOAST_CLASSES:
+                raise ValueError(f'{path}:{line_number}: classe TOAST inválida: {toast}')
+            if case_input.get('type') not in ('structured', 'text'):
+                raise ValueError(f"{path}:{line_number}: 'input.type' deve ser structured ou text")
+            if case_id in ids:
+                raise ValueError(f'{path}:{line_number}: id repetido: {case_id}')
+            ids.add(case_id)
+            cases.append({'id': case_id, 'input': case_input, 'grades': grades, 'toast': toast,
+                          'notes': case.get('notes', '')})
+    return cases
+
+
+def file_digest(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+
+def predicted_labels(payload: Dict) -> Tuple[Optional[Dict[str, int]], Optional[str]]:
+    """Graus e chave TOAST da resposta do /api/analyze."""
+    try:
+        grades = {cat: int(payload['ascod'][cat]['grade']) for cat in ASCOD_CATEGORIES}
+    except (KeyError, TypeError, ValueError):
+        return None, None
+    return grades, parse_toast_key(payload.get('toast_code') or payload.get('toast', {}).get('classification'))
+
+
+def classify_error(status: int, payload: Optional[Dict]) -> Optional[str]:
+    """Motivo da falha de um caso; None quando há resultado para comparar."""
+    payload = payload or {}
+    if payload.get('fallback'):
+        # A IA falhou e o motor de regras respondeu no lugar dela: não conta como acerto da IA
+        return f"fallback_{payload['fallback'].get('reason')}"
+    if status >= 400 or not payload.get('success'):
+        if 'Resposta gravada não encontrada' in (payload.get('error') or ''):
+            return 'missing_recording'
+        return payload.get('failure') or f'http_{status}'
+    if predicted_labels(payload)[0] is None:
+        return 'invalid_result'
+    return None
+
+
+def run_case(client, case: Dict, engine: str) -> Dict:
+    payload = dict(case['input'], engine=engine, no_cache=True)
+    start = time.perf_counter()
+    try:
+        status, body = client.post(payload)
+    except Exception as e:
+        status, body = 599, {'success': False, 'error': str(e)}
+    latency_ms = (time.perf_counter() - start) * 1000
+    error = classify_error(status, body)
+    grades, toast = predicted_labels(body) if not error else (None, None)
+    return {
+        'id': case['id'],
+        'engine': engine,
+        'type': case['input']['type'],
+        'expected': {'grades': case['grades'], 'toast': case['toast']},
+        'predicted': {'grades': grades, 'toast': toast} if grades else None,
+        'latency_ms': round(latency_ms, 2),
+        'usage': (body or {}).get('usage'),
+        'tier': (body or {}).get('tier'),
+        'error': error,
+        'detail': (body or {}).get('error') if error else None,
+    }
+
+
+def cohen_kappa(pairs: List[Tuple], labels: List) -> Optional[float]:
+    """Kappa de Cohen entre os rótulos esperados e os previstos."""
+    n = len(pairs)
+    if not n:
+        return None
+    observed = sum(1 for expected, predicted in pairs if expected == predicted) / n
+    chance = sum(
+        (sum(1 for e, _ in pairs if e == label) / n) * (sum(1 for _, p in pairs if p == label) / n)
+        for label in labels
+    )
+    if chance >= 1:
+        return 1.0 if observed == 1 else None
+    return round((observed - chance) / (1 - chance), 4)
+
+
+def confusion_matrix(pairs: List[Tuple], labels: List) -> Dict[str, Dict[str, int]]:
+    """Contagens esperado -> previsto, com todas as linhas e colunas dos rótulos."""
+    matrix = {str(e): {str(p): 0 for p in labels} for e in labels}
+    for expected, predicted in pairs:
+        row = matrix.setdefault(str(expected), {str(p): 0 for p in labels})
+        row[str(predicted)] = row.get(str(predicted), 0) + 1
+    return matrix
+
+
+def agreement(pairs: List[Tuple]) -> Optional[float]:
+    return round(sum(1 for e, p in pairs if e == p) / len(pairs), 4) if pairs else None
+
+
+def summarize_engine(samples: List[Dict]) -> Dict:
+    """Agrega os casos de um motor: concordância, matrizes, latência, tokens e erros."""
+    scored = [s for s in samples if s['predicted']]
+    categories = {}
+    for cat in ASCOD_CATEGORIES:
+        pairs = [(s['expected']['grades'][cat], s['predicted']['grades'][cat]) for s in scored]
+        categories[cat] = {
+            'agreement': agreement(pairs),
+            'kappa': cohen_kappa(pairs, GRADES),
+            'confusion': confusion_matrix(pairs, GRADES),
+        }
+    toast_pairs = [(s['expected']['toast'], s['predicted']['toast']) for s in scored]
+    exact_pairs = [(s['expected']['grades'], s['predicted']['grades']) for s in scored]
+
+    latencies = sorted(s['latency_ms'] for s in samples)
+    tokens = {kind: 0 for kind in TOKEN_KINDS.values()}
+    for s in samples:
+        for field, kind in TOKEN_KINDS.items():
+            tokens[kind] += (s['usage'] or {}).get(field) or 0
+    errors = {}
+    for s in samples:
+        if s['error']:
+            errors[s['error']] = errors.get(s['error'], 0) + 1
+
+    return {
+        'cases': len(samples),
+        'scored': len(scored),
+        'by_type': {t: sum(1 for s in samples if s['type'] == t) for t in ('structured', 'text')},
+        'ascod_exact': agreement(exact_pairs),
+        'categories': categories,
+        'toast': {
+            'agreement': agreement(toast_pairs),
+            'kappa': cohen_kappa(toast_pairs, TOAST_KEYS),
+            'confusion': confusion_matrix(toast_pairs, TOAST_KEYS),
+        },
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 2) if latencies else None,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'max': latencies[-1] if latencies else None,
+        },
+        'tokens': tokens,
+        'tokens_per_case': {kind: round(total / len(samples), 1) for kind, total in tokens.items()} if samples else {},
+        'tiers': {tier: sum(1 for s in samples if s['tier'] == tier) for tier in {s['tier'] for s in samples if s['tier']}},
+        'errors': errors,
+        'error_rate': round(sum(errors.values()) / len(samples), 4) if samples else 0,
+    }
+
+
+def evaluate(client, corpus: List[Dict], engines: List[str], concurrency: int) -> Dict[str, List[Dict]]:
+    """Executa todos os pares (motor, caso) aplicáveis; retorna as amostras por motor, na ordem do corpus."""
+    jobs = [(engine, case) for engine in engines for case in corpus if case['input']['type'] in ENGINE_INPUTS[engine]]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(lambda job: run_case(client, job[1], job[0]), jobs))
+    return {engine: [s for s in samples if s['engine'] == engine] for engine in engines}
+
+
+def fmt_rate(value) -> str:
+    return f'{value:.1%}' if value is not None else 'n/d'
+
+
+def fmt_number(value) -> str:
+    if value is None:
+        return 'n/d'
+    return f'{value:.3f}' if isinstance(value, float) and value < 10 else f'{value:g}'
+
+
+def fmt_ms(value) -> str:
+    return f'{value:.1f}' if value is not None else 'n/d'
+
+
+def print_report(reports: Dict[str, Dict], samples: Dict[str, List[Dict]], show_matrices: bool):
+    """Tabela lado a lado dos motores, divergências por caso e matrizes de confusão."""
+    engines = list(reports)
+    rows = [('casos avaliados', lambda r: f"{r['scored']}/{r['cases']}"),
+            ('ASCOD exato', lambda r: fmt_rate(r['ascod_exact']))]
+    for cat in ASCOD_CATEGORIES:
+        rows.append((f'{cat} concordância', lambda r, cat=cat: fmt_rate(r['categories'][cat]['agreement'])))
+        rows.append((f'{cat} kappa', lambda r, cat=cat: fmt_number(r['categories'][cat]['kappa'])))
+    rows += [
+        ('TOAST concordância', lambda r: fmt_rate(r['toast']['agreement'])),
+        ('TOAST kappa', lambda r: fmt_number(r['toast']['kappa'])),
+        ('latência média (ms)', lambda r: fmt_ms(r['latency_ms']['mean'])),
+        ('latência p50 (ms)', lambda r: fmt_ms(r['latency_ms']['p50'])),
+        ('latência p95 (ms)', lambda r: fmt_ms(r['latency_ms']['p95'])),
+        ('tokens entrada/caso', lambda r: fmt_number(r['tokens_per_case'].get('prompt'))),
+        ('tokens em cache/caso', lambda r: fmt_number(r['tokens_per_case'].get('cached'))),
+        ('tokens saída/caso', lambda r: fmt_number(r['tokens_per_case'].get('output'))),
+        ('erros', lambda r: ', '.join(f'{k}={v}' for k, v in sorted(r['errors'].items())) or '0'),
+    ]
+    width = max(12, *(len(engine) for engine in engines))
+    print(f"{'':<22}" + ''.join(f'{engine:>{width + 2}}' for engine in engines))
+    for label, value in rows:
+        print(f'{label:<22}' + ''.join(f'{value(reports[engine]):>{width + 2}}' for engine in engines))
+
+    for engine in engines:
+        diverging = [s for s in samples[engine] if s['error'] or
+                     s['predicted'] != {'grades': s['expected']['grades'], 'toast': s['expected']['toast']}]
+        if not diverging:
+            continue
+        print(f'\nDivergências ({engine}):')
+        for s in diverging:
+            expected = ''.join(f'{c}{g}' for c, g in s['expected']['grades'].items()) + f" TOAST {s['expected']['toast']}"
+            if s['error']:
+                print(f"  {s['id']:<8} esperado {expected:<22} erro: {s['error']}")
+                continue
+            predicted = ''.join(f'{c}{g}' for c, g in s['predicted']['grades'].items()) + f" TOAST {s['predicted']['toast']}"
+            print(f"  {s['id']:<8} esperado {expected:<22} previsto {predicted}")
+
+    if not show_matrices:
+        return
+    for engine in engines:
+        matrices = [(f'{cat} (graus)', reports[engine]['categories'][cat]['confusion']) for cat in ASCOD_CATEGORIES]
+        matrices.append(('TOAST', reports[engine]['toast']['confusion']))
+        for title, matrix in matrices:
+            columns = list(next(iter(matrix.values())))
+            print(f'\nMatriz de confusão {title} — {engine} (linhas: esperado, colunas: previsto)')
+            print('      ' + ''.join(f'{c:>5}' for c in columns))
+            for expected, row in matrix.items():
+                print(f'{expected:>5} ' + ''.join(f'{row[c]:>5}' for c in columns))
+
+
+def check_gate(reports: Dict[str, Dict], baseline: Optional[Dict], args) -> List[str]:
+    """Lista as violações dos limites configurados (vazia quando a avaliação passa)."""
+    failures = []
+    for engine, report in reports.items():
+        if report['error_rate'] > args.max_error_rate:
+            failures.append(f"{engine}: taxa de erros {report['error_rate']:.1%} acima de {args.max_error_rate:.1%} ({report['errors']})")
+        if args.min_exact is not None and (report['ascod_exact'] or 0) < args.min_exact:
+            failures.append(f"{engine}: ASCOD exato {fmt_rate(report['ascod_exact'])} abaixo de {args.min_exact:.1%}")
+        if args.min_toast is not None and (report['toast']['agreement'] or 0) < args.min_toast:
+            failures.append(f"{engine}: TOAST {fmt_rate(report['toast']['agreement'])} abaixo de {args.min_toast:.1%}")
+
+        old = (baseline or {}).get('engines', {}).get(engine)
+        if not old:
+            continue
+        compared = [('ASCOD exato', old['ascod_exact'], report['ascod_exact']),
+                    ('TOAST', old['toast']['agreement'], report['toast']['agreement'])]
+        compared += [(cat, old['categories'][cat]['agreement'], report['categories'][cat]['agreement'])
+                     for cat in ASCOD_CATEGORIES]
+        for label, before, after in compared:
+            if before is not None and (after or 0) < before - args.max_regression:
+                failures.append(f'{engine}: {label} caiu de {fmt_rate(before)} para {fmt_rate(after)}')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Avaliação de acurácia e latência contra casos rotulados')
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help='Casos rotulados (JSONL)')
+    parser.add_argument('--engines', default='rules,ai', help='Motores separados por vírgula (rules, ai, hybrid)')
+    parser.add_argument('--replay', metavar='DIR', help='Reproduz as respostas gravadas em DIR (offline)')
+    parser.add_argument('--record', metavar='DIR', help='Chama o modelo real e grava as respostas em DIR')
+    parser.add_argument('--backend', choices=['gemini', 'simulator'], help='Define ASCOD_BACKEND')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--compare', help='Avaliação anterior (JSON) usada como referência do gate')
+    parser.add_argument('--min-exact', type=float, help='Acerto mínimo do código ASCOD completo (0-1)')
+    parser.add_argument('--min-toast', type=float, help='Concordância mínima da classe TOAST (0-1)')
+    parser.add_argument('--max-regression', type=float, default=0.0,
+                        help='Queda máxima tolerada em relação a --compare (0-1, padrão 0)')
+    parser.add_argument('--max-error-rate', type=float, default=0.0,
+                        help='Fração máxima de casos com erro, incluindo respostas não gravadas (padrão 0)')
+    parser.add_argument('--matrices', action='store_true', help='Imprime as matrizes de confusão')
+    args = parser.parse_args()
+
+    engines = [e.strip() for e in args.engines.split(',') if e.strip()]
+    invalid = [e for e in engines if e not in ENGINE_INPUTS]
+    if invalid:
+        parser.error(f"Motor inválido: {', '.join(invalid)}")
+    if args.replay and args.record:
+        parser.error('Use --replay ou --record, não ambos.')
+
+    # Configuração lida pelo app na importação (feita pelo InProcessClient)
+    if args.backend:
+        os.environ['ASCOD_BACKEND'] = args.backend
+    if args.replay or args.record:
+        os.environ['ASCOD_RECORD_DIR'] = args.replay or args.record
+        os.environ['ASCOD_RECORD_MODE'] = 'replay' if args.replay else 'record'
+    # Falhas da IA devem aparecer como erro, não como o resultado do motor de regras
+    os.environ['ASCOD_FALLBACK_TO_RULES'] = 'false'
+    # Casos de avaliação não entram no histórico de classificações
+    os.environ['ASCOD_HISTORY_ENABLED'] = 'false'
+
+    try:
+        corpus = load_corpus(args.corpus)
+    except (OSError, ValueError) as e:
+        print(f'Erro ao ler o corpus: {e}', file=sys.stderr)
+        sys.exit(2)
+
+    client = InProcessClient()
+    from app import get_classifier
+    import ascod_classifier
+
+    start = time.perf_counter()
+    samples = evaluate(client, corpus, engines, args.concurrency)
+    elapsed = time.perf_counter() - start
+    classifier = get_classifier()
+    reports = {engine: summarize_engine(engine_samples) for engine, engine_samples in samples.items()}
+    print_report(reports, samples, args.matrices)
+
+    instruction = ascod_classifier.ASCOD_SYSTEM_INSTRUCTION + ascod_classifier.ASCOD_OUTPUT_FORMAT
+    result = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'source': {
+            **source_fingerprint(),
+            'system_instruction': hashlib.sha256(instruction.encode('utf-8')).hexdigest()[:12],
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'backend': os.getenv('ASCOD_BACKEND', 'gemini'),
+            'record_mode': os.getenv('ASCOD_RECORD_MODE') if os.getenv('ASCOD_RECORD_DIR') else None,
+            'record_dir': os.getenv('ASCOD_RECORD_DIR'),
+            'model': classifier.model_name if classifier else None,
+            'fast_model': classifier.fast_backend.model_id if classifier and classifier.fast_backend else None,
+            'split_categories': classifier.split_categories if classifier else None,
+        },
+        'corpus': {'path': args.corpus, 'sha256': file_digest(args.corpus), 'cases': len(corpus)},
+        'config': {'engines': engines, 'concurrency': args.concurrency},
+        'elapsed_s': round(elapsed, 3),
+        'engines': reports,
+        'cases': [s for engine in engines for s in samples[engine]],
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f'\nResultados gravados em {args.output}')
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('corpus', {}).get('sha256') != result['corpus']['sha256']:
+            print('⚠️  AVISO: o corpus mudou desde a avaliação de referência; a comparação pode não ser equivalente.')
+    failures = check_gate(reports, baseline, args)
+    if failures:
+        print('\nAvaliação REPROVADA:')
+        for failure in failures:
+            print(f'  - {failure}')
+        sys.exit(1)
+    print('\nAvaliação aprovada.')
+
+
+if __name__ == "__main__":
+    main()
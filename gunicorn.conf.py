@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Configuração do gunicorn para o Classificador ASCOD/TOAST
+
+Por padrão usa workers gevent: a chamada ao Gemini cede o processo enquanto
+aguarda a rede, e cada worker atende centenas de requisições simultâneas.
+Defina ASCOD_WORKER_CLASS=sync para voltar ao modo de um request por processo.
+
+Com preload_app (ASCOD_PRELOAD, padrão ligado) o master importa o app e o SDK
+do Gemini uma única vez e os workers herdam os módulos no fork; cada worker
+cria o seu classificador e faz o warm-up antes de aceitar requisições.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', 4))
+worker_class = os.getenv('ASCOD_WORKER_CLASS', 'gevent')
+# Conexões simultâneas por worker gevent
+worker_connections = int(os.getenv('ASCOD_WORKER_CONNECTIONS', 500))
+timeout = int(os.getenv('ASCOD_WORKER_TIMEOUT', 120))
+preload_app = os.getenv('ASCOD_PRELOAD', 'true').lower() in ['true', '1', 'on']
+
+if worker_class == 'gevent':
+    # O transporte gRPC não coopera com o gevent; o REST usa sockets monkey-patched
+    os.environ.setdefault('ASCOD_GENAI_TRANSPORT', 'rest')
+    if preload_app:
+        # O app é importado no master antes do fork: o monkey-patch precisa vir antes de ssl/socket/threading
+        from gevent import monkey
+        monkey.patch_all()
+
+
+def on_starting(server):
+    if preload_app:
+        from app import preload
+        preload()
+
+
+def post_worker_init(worker):
+    # Conexões, threads e SQLite não sobrevivem ao fork: o classificador é criado no próprio worker
+    from app import warm_up
+    try:
+        warm_up()
+    except Exception as e:
+        print(f"Warm-up do worker falhou: {e}")
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Histórico persistente das classificações, gravado em segundo plano e consultável por índices
+"""
+
+import os
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from ascod_classifier import ASCOD_CATEGORIES, parse_toast_key
+from metrics import metrics
+from result_cache import hash_text, normalize_text
+
+DEFAULT_HISTORY_PATH = 'ascod_history.sqlite3'
+# Limite de itens por página das consultas
+MAX_PAGE_SIZE = 500
+
+COLUMNS = (
+    'created_at', 'input_type', 'engine', 'input_hash', 'input', 'prompt', 'model', 'tier',
+    'ascod_code', 'a', 's', 'c', 'o', 'd', 'toast', 'latency_ms',
+    'prompt_tokens', 'cached_tokens', 'output_tokens', 'cached', 'fallback', 'output',
+)
+
+
+class HistoryStore:
+    """Classificações em SQLite (modo WAL), com índices por data, código ASCOD, grau por categoria, TOAST e hash da entrada."""
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv('ASCOD_HISTORY_PATH', DEFAULT_HISTORY_PATH)
+        self._local = threading.local()
+        self._schema_ready = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        # Uma conexão aberta no master (preload_app) não pode ser usada após o fork
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            if not self._schema_ready:
+                self._init_db(conn)
+                self._schema_ready = True
+        return conn
+
+    @staticmethod
+    def _init_db(conn: sqlite3.Connection):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS classifications (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at REAL NOT NULL,
+                input_type TEXT,
+                engine TEXT NOT NULL,
+                input_hash TEXT NOT NULL,
+                input TEXT NOT NULL,
+                prompt TEXT,
+                model TEXT,
+                tier TEXT,
+                ascod_code TEXT NOT NULL,
+                a INTEGER NOT NULL,
+                s INTEGER NOT NULL,
+                c INTEGER NOT NULL,
+                o INTEGER NOT NULL,
+                d INTEGER NOT NULL,
+                toast TEXT,
+                latency_ms REAL,
+                prompt_tokens INTEGER,
+                cached_tokens INTEGER,
+                output_tokens INTEGER,
+                cached INTEGER NOT NULL DEFAULT 0,
+                fallback TEXT,
+                output TEXT NOT NULL
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_history_created ON classifications (created_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_history_code ON classifications (ascod_code, created_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_history_toast ON classifications (toast, created_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_history_input ON classifications (input_hash)')
+        # Consultas por grau de uma categoria (ex.: todos os C1 do mês)
+        for cat in ASCOD_CATEGORIES:
+            column = cat.lower()
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_history_{column} ON classifications ({column}, created_at)')
+
+    @staticmethod
+    def build_row(data: Dict, payload: Dict, latency_ms: Optional[float], created_at: float) -> Tuple:
+        """Linha da tabela a partir do corpo da requisição e do payload de /api/analyze."""
+        usage = payload.get('usage') or {}
+        grades = {cat: payload['ascod'][cat]['grade'] for cat in ASCOD_CATEGORIES}
+        output = {'ascod': payload['ascod'], 'toast': payload['toast']}
+        if payload.get('second_opinion'):
+            output['second_opinion'] = payload['second_opinion']
+        prompt = payload.get('natural_language_prompt') or data.get('text') or ''
+        return (
+            created_at,
+            data.get('type'),
+            payload.get('engine'),
+            hash_text(normalize_text(prompt)),
+            json.dumps(data, ensure_ascii=False),
+            prompt,
+            payload.get('model'),
+            payload.get('tier'),
+            payload['ascod_code'],
+            *(grades[cat] for cat in ASCOD_CATEGORIES),
+            parse_toast_key(payload.get('toast_code')),
+            round(latency_ms, 2) if latency_ms is not None else None,
+            usage.get('prompt_token_count'),
+            usage.get('cached_content_token_count'),
+            usage.get('candidates_token_count'),
+            int(bool(payload.get('cached'))),
+            (payload.get('fallback') or {}).get('reason'),
+            json.dumps(output, ensure_ascii=False),
+        )
+
+    def insert_many(self, rows: List[Tuple]):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                f"INSERT INTO classifications ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})", rows
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def _where(filters: Dict) -> Tuple[str, List]:
+        clauses, params = [], []
+        for cat, grade in filters.get('grades', {}).items():
+            clauses.append(f'{cat.lower()} = ?')
+            params.append(grade)
+        for key, column in (('ascod_code', 'ascod_code'), ('toast', 'toast'), ('input_hash', 'input_hash'),
+                            ('engine', 'engine'), ('model', 'model')):
+            if filters.get(key) is not None:
+                clauses.append(f'{column} = ?')
+                params.append(filters[key])
+        if filters.get('since') is not None:
+            clauses.append('created_at >= ?')
+            params.append(filters['since'])
+        if filters.get('until') is not None:
+            clauses.append('created_at < ?')
+            params.append(filters['until'])
+        if filters.get('before_id') is not None:
+            clauses.append('id < ?')
+            params.append(filters['before_id'])
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    @staticmethod
+    def _to_dict(row) -> Dict:
+        item = dict(zip(('id',) + COLUMNS, row))
+        item['input'] = json.loads(item['input'])
+        item['output'] = json.loads(item['output'])
+        item['cached'] = bool(item['cached'])
+        return item
+
+    def query(self, filters: Dict, limit: int = 50) -> Tuple[List[Dict], Optional[int]]:
+        """
+        Página mais recente primeiro, com paginação por chave (before_id = next_cursor anterior).
+        Retorna (itens, próximo cursor ou None).
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        where, params = self._where(filters)
+        rows = self._connect().execute(
+            f"SELECT id, {', '.join(COLUMNS)} FROM classifications{where} ORDER BY id DESC LIMIT ?",
+            params + [limit + 1]
+        ).fetchall()
+        items = [self._to_dict(row) for row in rows[:limit]]
+        next_cursor = items[-1]['id'] if len(rows) > limit else None
+        return items, next_cursor
+
+    def iterate(self, filters: Dict, page_size: int = MAX_PAGE_SIZE, limit: Optional[int] = None) -> Iterator[Dict]:
+        """Percorre todos os resultados em páginas, sem manter uma leitura aberta entre elas."""
+        filters = dict(filters)
+        sent = 0
+        while True:
+            items, next_cursor = self.query(filters, page_size if limit is None else min(page_size, limit - sent))
+            for item in items:
+                yield item
+            sent += len(items)
+            if next_cursor is None or (limit is not None and sent >= limit):
+                return
+            filters['before_id'] = next_cursor
+
+    def get(self, entry_id: int) -> Optional[Dict]:
+        row = self._connect().execute(
+            f"SELECT id, {', '.join(COLUMNS)} FROM classifications WHERE id = ?", (entry_id,)
+        ).fetchone()
+        return self._to_dict(row) if row else None
+
+
+class HistoryWriter:
+    """
+    Fila limitada e uma thread por processo que grava o histórico em lotes,
+    fora do caminho da requisição. Com a fila cheia, o registro é descartado (e contado).
+    """
+
+    def __init__(self, store: Optional[HistoryStore] = None, max_queue=None, batch_size=None, enabled=None):
+        if enabled is None:
+            enabled = os.getenv('ASCOD_HISTORY_ENABLED', 'true').lower() in ['true', '1', 'on']
+        self.enabled = enabled
+        self.store = store or HistoryStore()
+        self.batch_size = int(batch_size or os.getenv('ASCOD_HISTORY_BATCH_SIZE', 200))
+        self._queue = queue.Queue(maxsize=int(max_queue or os.getenv('ASCOD_HISTORY_QUEUE_SIZE', 10000)))
+        self._lock = threading.Lock()
+        self._writer_pid = None
+
+    def _ensure_writer(self):
+        # Iniciada no primeiro uso de cada processo (após o fork do gunicorn)
+        if self._writer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+            threading.Thread(target=self._write_loop, name='ascod-history-writer', daemon=True).start()
+            atexit.register(self.flush)
+
+    def record(self, data: Dict, payload: Dict, latency_ms: Optional[float] = None):
+        """Enfileira uma classificação bem-sucedida; não bloqueia a requisição."""
+        if not self.enabled or not payload.get('success') or not payload.get('ascod'):
+            return
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait((data, payload, latency_ms, time.time()))
+        except queue.Full:
+            metrics.inc('ascod_history_writes_total', {'outcome': 'dropped'})
+
+    def _drain(self, first) -> List:
+        batch = [first]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: List):
+        rows = []
+        for data, payload, latency_ms, created_at in batch:
+            try:
+                rows.append(HistoryStore.build_row(data, payload, latency_ms, created_at))
+            except (KeyError, TypeError) as e:
+                metrics.inc('ascod_history_writes_total', {'outcome': 'error'})
+                print(f"Registro de histórico inválido: {e}")
+        if not rows:
+            return
+        try:
+            self.store.insert_many(rows)
+            metrics.inc('ascod_history_writes_total', {'outcome': 'written'}, len(rows))
+        except sqlite3.Error as e:
+            metrics.inc('ascod_history_writes_total', {'outcome': 'error'}, len(rows))
+            print(f"Erro ao gravar o histórico: {e}")
+
+    def _write_loop(self):
+        while True:
+            batch = self._drain(self._queue.get())
+            try:
+                self._write(batch)
+            except Exception as e:
+                print(f"Erro ao gravar o histórico: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def flush(self):
+        """Aguarda a gravação de tudo o que já foi enfileirado (encerramento do worker e scripts)."""
+        if self._writer_pid == os.getpid():
+            self._queue.join()
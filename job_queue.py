@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fila de jobs persistente para classificações demoradas
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
+
+DEFAULT_JOBS_PATH = 'ascod_jobs.sqlite3'
+
+
+class JobStore:
+    """Armazena os jobs em SQLite (modo WAL), compartilhado entre os workers e preservado entre reinícios."""
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv('ASCOD_JOBS_PATH', DEFAULT_JOBS_PATH)
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status_updated ON jobs (status, updated_at)')
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        # Uma conexão aberta no master (preload_app) não pode ser usada após o fork
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def create(self, payload: Dict) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._connect().execute(
+            'INSERT INTO jobs (id, status, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+            (job_id, 'queued', json.dumps(payload, ensure_ascii=False), now, now)
+        )
+        return job_id
+
+    def claim(self, job_id: str) -> Optional[Dict]:
+        """Marca o job como 'running' se ainda estiver na fila; só um worker consegue."""
+        conn = self._connect()
+        cursor = conn.execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ? AND status = 'queued'",
+            (time.time(), job_id)
+        )
+        if cursor.rowcount == 0:
+            return None
+        row = conn.execute('SELECT payload FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return json.loads(row[0])
+
+    def finish(self, job_id: str, status: str, result: Optional[Dict] = None, error: Optional[str] = None):
+        self._connect().execute(
+            'UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?',
+            (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, time.time(), job_id)
+        )
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        row = self._connect().execute(
+            'SELECT id, status, result, error, attempts, created_at, updated_at FROM jobs WHERE id = ?', (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            'job_id': row[0],
+            'status': row[1],
+            'result': json.loads(row[2]) if row[2] else None,
+            'error': row[3],
+            'attempts': row[4],
+            'created_at': row[5],
+            'updated_at': row[6],
+        }
+
+    def heartbeat(self, job_id: str):
+        """Renova updated_at de um job em execução, para o varredor não o considerar abandonado."""
+        self._connect().execute(
+            "UPDATE jobs SET updated_at = ? WHERE id = ? AND status = 'running'", (time.time(), job_id)
+        )
+
+    def requeue_stale(self, stale_after: float, max_attempts: int) -> int:
+        """Devolve à fila jobs 'running' abandonados (worker morto); desiste após max_attempts."""
+        conn = self._connect()
+        cutoff = time.time() - stale_after
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', error = 'Número máximo de tentativas excedido.', updated_at = ? "
+            "WHERE status = 'running' AND updated_at < ? AND attempts >= ?",
+            (time.time(), cutoff, max_attempts)
+        )
+        cursor = conn.execute(
+            "UPDATE jobs SET status = 'queued', updated_at = ? WHERE status = 'running' AND updated_at < ?",
+            (time.time(), cutoff)
+        )
+        return cursor.rowcount
+
+    def queued_ids(self, older_than: float = 0):
+        rows = self._connect().execute(
+            "SELECT id FROM jobs WHERE status = 'queued' AND updated_at < ? ORDER BY created_at",
+            (time.time() - older_than,)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def purge(self, retention: float):
+        self._connect().execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+            (time.time() - retention,)
+        )
+
+
+class JobQueue:
+    """Executa jobs em um pool local e recupera jobs pendentes após reinícios."""
+
+    def __init__(self, handler: Callable[[Dict], Tuple[Dict, int]], store=None, concurrency=None,
+                 stale_after=None, sweep_interval=None, retention=None, max_attempts=3):
+        self.handler = handler
+        self.store = store or JobStore()
+        self.concurrency = int(concurrency or os.getenv('ASCOD_JOBS_CONCURRENCY', 4))
+        # Um job 'running' sem atualização (heartbeat) por esse tempo é considerado órfão (worker morto)
+        self.stale_after = float(stale_after or os.getenv('ASCOD_JOBS_STALE_AFTER', 300))
+        self.sweep_interval = float(sweep_interval or os.getenv('ASCOD_JOBS_SWEEP_INTERVAL', 30))
+        self.retention = float(retention or os.getenv('ASCOD_JOBS_RETENTION', 7 * 24 * 3600))
+        self.max_attempts = max_attempts
+        # Jobs em execução renovam updated_at a cada heartbeat_interval (bem abaixo de stale_after)
+        self.heartbeat_interval = self.stale_after / 3
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='ascod-job')
+        # Jobs já agendados neste processo, para o varredor não reagendá-los
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._sweeper = None
+        self._sweeper_pid = None
+        self._sweeper_lock = threading.Lock()
+
+    def start(self):
+        """Inicia o varredor de jobs pendentes neste processo (após o fork, com preload_app)."""
+        with self._sweeper_lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+            self._sweeper = threading.Thread(target=self._sweep_loop, name='ascod-job-sweeper', daemon=True)
+            self._sweeper.start()
+
+    def submit(self, payload: Dict) -> str:
+        self.start()
+        job_id = self.store.create(payload)
+        self._schedule(job_id)
+        return job_id
+
+    def _schedule(self, job_id: str):
+        with self._pending_lock:
+            if job_id in self._pending:
+                return
+            self._pending.add(job_id)
+        self.executor.submit(self._run, job_id)
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        self.start()
+        return self.store.get(job_id)
+
+    def _run(self, job_id: str):
+        try:
+            self._execute(job_id)
+        finally:
+            with self._pending_lock:
+                self._pending.discard(job_id)
+
+    def _execute(self, job_id: str):
+        payload = self.store.claim(job_id)
+        if payload is None:
+            return  # Outro worker já pegou este job
+        # Enquanto o handler roda (escalonamento, novas tentativas), o job não pode parecer órfão
+        done = threading.Event()
+        threading.Thread(target=self._heartbeat_loop, args=(job_id, done), name='ascod-job-heartbeat', daemon=True).start()
+        try:
+            result, status = self.handler(payload)
+        except Exception as e:
+            self.store.finish(job_id, 'failed', error=f'Erro inesperado durante a análise: {str(e)}')
+            return
+        finally:
+            done.set()
+        if status < 400 and result.get('success'):
+            self.store.finish(job_id, 'done', result=result)
+        else:
+            self.store.finish(job_id, 'failed', result=result, error=result.get('error'))
+
+    def _heartbeat_loop(self, job_id: str, done: threading.Event):
+        while not done.wait(self.heartbeat_interval):
+            try:
+                self.store.heartbeat(job_id)
+            except sqlite3.Error as e:
+                print(f"Erro ao renovar o job {job_id}: {e}")
+
+    def recover(self):
+        """Reenfileira jobs órfãos e agenda os que ficaram na fila sem executor."""
+        self.store.requeue_stale(self.stale_after, self.max_attempts)
+        # Jobs recém-criados ainda estão na fila do próprio worker que os recebeu
+        for job_id in self.store.queued_ids(older_than=self.sweep_interval):
+            self._schedule(job_id)
+        self.store.purge(self.retention)
+
+    def _sweep_loop(self):
+        while True:
+            try:
+                self.recover()
+            except Exception as e:
+                print(f"Erro ao recuperar jobs pendentes: {e}")
+            time.sleep(self.sweep_interval)
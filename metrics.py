@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Métricas no formato Prometheus, agregadas entre os workers do gunicorn
+"""
+
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+DEFAULT_METRICS_PATH = 'ascod_metrics.sqlite3'
+
+# Limites (segundos) dos histogramas de etapas: de microssegundos (coerção) a minutos (modelo)
+STAGE_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Tipo e descrição de cada métrica exposta
+METRIC_INFO = {
+    'ascod_requests_total': ('counter', 'Análises por tipo de entrada, motor e resultado.'),
+    'ascod_stage_duration_seconds': ('histogram', 'Duração de cada etapa da análise.'),
+    'ascod_model_calls_total': ('counter', 'Chamadas ao modelo por camada e resultado.'),
+    'ascod_resilience_events_total': ('counter', 'Novas tentativas, hedges, prazos esgotados e eventos do circuit breaker.'),
+    'ascod_response_repairs_total': ('counter', 'Respostas do modelo reparadas localmente ou pedidas de novo, por tipo.'),
+    'ascod_routing_total': ('counter', 'Camada que respondeu (fast/pro) e o motivo do roteamento.'),
+    'ascod_tokens_total': ('counter', 'Tokens informados em usage_metadata, por tipo.'),
+    'ascod_prompt_chars_total': ('counter', 'Caracteres da instrução do sistema enviados, com ou sem poda.'),
+    'ascod_trimmed_tokens_total': ('counter', 'Tokens estimados removidos de notas longas antes do envio ao modelo.'),
+    'ascod_cache_requests_total': ('counter', 'Consultas ao cache de respostas por resultado.'),
+    'ascod_category_cache_requests_total': ('counter', 'Consultas ao cache por categoria (modo dividido) por categoria e resultado.'),
+    'ascod_near_duplicate_requests_total': ('counter', 'Consultas ao índice de quase-duplicatas (textos livres sem resposta exata no cache) por resultado.'),
+    'ascod_text_routing_total': ('counter', 'Textos livres enviados ao motor de regras (extração local confiável) ou ao modelo.'),
+    'ascod_coalesced_requests_total': ('counter', 'Análises atendidas por uma chamada idêntica já em andamento.'),
+    'ascod_history_writes_total': ('counter', 'Classificações gravadas no histórico, descartadas (fila cheia) ou com erro.'),
+    'ascod_cache_hit_ratio': ('gauge', 'Fração das consultas ao cache que encontraram resposta.'),
+    'ascod_coalesced_ratio': ('gauge', 'Fração das consultas sem resposta no cache atendidas por coalescência.'),
+}
+
+# Campos de usage_metadata e o rótulo correspondente
+TOKEN_KINDS = {
+    'prompt_token_count': 'prompt',
+    'cached_content_token_count': 'cached',
+    'candidates_token_count': 'output',
+}
+
+
+def format_labels(labels: Optional[Dict[str, str]]) -> str:
+    if not labels:
+        return ''
+    return ','.join(f'{k}="{str(v)}"' for k, v in sorted(labels.items()))
+
+
+def format_value(value: float) -> str:
+    """Valor completo no formato de exposição (':g' arredondaria contadores acima de 10^6)."""
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class Metrics:
+    """
+    Acumula contadores e histogramas em memória e os soma periodicamente
+    em um arquivo SQLite compartilhado, de onde o /metrics lê o total de todos os workers.
+    """
+
+    def __init__(self, path=None, flush_interval=None, enabled=None):
+        self.path = path or os.getenv('ASCOD_METRICS_PATH', DEFAULT_METRICS_PATH)
+        self.flush_interval = float(flush_interval if flush_interval is not None else os.getenv('ASCOD_METRICS_FLUSH_INTERVAL', 5))
+        if enabled is None:
+            enabled = os.getenv('ASCOD_METRICS_ENABLED', 'true').lower() not in ['false', '0', 'off']
+        self.enabled = enabled
+        # Incrementos ainda não gravados no SQLite: (nome, rótulos) -> valor
+        self._pending: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._flusher = None
+        self._flusher_pid = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # Conexões herdadas do master (preload_app) não são reaproveitadas após o fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS metrics (
+                    name TEXT NOT NULL,
+                    labels TEXT NOT NULL,
+                    value REAL NOT NULL,
+                    PRIMARY KEY (name, labels)
+                )
+            """)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _ensure_flusher(self):
+        # Iniciada no primeiro uso de cada processo (após o fork do gunicorn)
+        if self._flusher_pid == os.getpid():
+            return
+        self._flusher_pid = os.getpid()
+        self._flusher = threading.Thread(target=self._flush_loop, name='ascod-metrics-flusher', daemon=True)
+        self._flusher.start()
+
+    def inc(self, name: str, labels: Optional[Dict[str, str]] = None, amount: float = 1):
+        if not self.enabled:
+            return
+        key = (name, format_labels(labels))
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + amount
+            self._ensure_flusher()
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, str]] = None, buckets=STAGE_BUCKETS):
+        """Registra uma observação de histograma (buckets cumulativos, _sum e _count)."""
+        if not self.enabled:
+            return
+        labels = dict(labels or {})
+        base = format_labels(labels)
+        with self._lock:
+            pending = self._pending
+            # Todos os buckets são gravados (mesmo com zero) para que cada série tenha o conjunto completo
+            for le in buckets:
+                key = (f'{name}_bucket', format_labels({**labels, 'le': repr(float(le))}))
+                pending[key] = pending.get(key, 0) + (1 if value <= le else 0)
+            key = (f'{name}_bucket', format_labels({**labels, 'le': '+Inf'}))
+            pending[key] = pending.get(key, 0) + 1
+            pending[(f'{name}_sum', base)] = pending.get((f'{name}_sum', base), 0) + value
+            pending[(f'{name}_count', base)] = pending.get((f'{name}_count', base), 0) + 1
+            self._ensure_flusher()
+
+    @contextmanager
+    def time_stage(self, stage: str):
+        """Mede a duração do bloco como uma etapa de ascod_stage_duration_seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('ascod_stage_duration_seconds', time.perf_counter() - start, {'stage': stage})
+
+    def record_usage(self, usage: Optional[Dict[str, int]]):
+        if not usage:
+            return
+        for field, kind in TOKEN_KINDS.items():
+            if usage.get(field):
+                self.inc('ascod_tokens_total', {'kind': kind}, usage[field])
+
+    def flush(self):
+        """Soma os incrementos pendentes deste processo no SQLite compartilhado."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                'INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?) '
+                'ON CONFLICT(name, labels) DO UPDATE SET value = value + excluded.value',
+                [(name, labels, value) for (name, labels), value in pending.items()]
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            # Devolve os incrementos para a próxima tentativa
+            with self._lock:
+                for key, value in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + value
+            raise
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Erro ao gravar métricas: {e}")
+
+    def collect(self) -> Dict[tuple, float]:
+        """Totais de todos os workers (inclui os incrementos pendentes deste processo)."""
+        self.flush()
+        rows = self._connect().execute('SELECT name, labels, value FROM metrics').fetchall()
+        return {(name, labels): value for name, labels, value in rows}
+
+    def render(self) -> str:
+        """Gera o texto no formato de exposição do Prometheus (text/plain 0.0.4)."""
+        values = self.collect()
+
+        def total(name, **match):
+            wanted = [f'{k}="{v}"' for k, v in match.items()]
+            return sum(v for (n, labels), v in values.items() if n == name and all(w in labels for w in wanted))
+
+        hits = total('ascod_cache_requests_total', result='hit')
+        misses = total('ascod_cache_requests_total', result='miss')
+        coalesced = total('ascod_coalesced_requests_total')
+        if hits + misses:
+            values[('ascod_cache_hit_ratio', '')] = hits / (hits + misses)
+        if misses:
+            values[('ascod_coalesced_ratio', '')] = coalesced / misses
+
+        lines = []
+        for metric, (metric_type, help_text) in METRIC_INFO.items():
+            series = sorted(
+                (name, labels, value) for (name, labels), value in values.items()
+                if name == metric or (metric_type == 'histogram' and name in (f'{metric}_bucket', f'{metric}_sum', f'{metric}_count'))
+            )
+            if not series:
+                continue
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} {metric_type}')
+            if metric_type == 'histogram':
+                series.sort(key=self._histogram_order)
+            for name, labels, value in series:
+                lines.append(f'{name}{{{labels}}} {format_value(value)}' if labels else f'{name} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _histogram_order(item):
+        # Agrupa por rótulos (sem le) e ordena os buckets numericamente, com +Inf, _sum e _count ao final
+        name, labels, _ = item
+        parts = dict(part.split('=', 1) for part in labels.split(',') if part)
+        le = parts.pop('le', None)
+        group = ','.join(f'{k}={v}' for k, v in sorted(parts.items()))
+        if name.endswith('_bucket'):
+            le = le.strip('"')
+            return (group, 0, float('inf') if le == '+Inf' else float(le))
+        return (group, 1 if name.endswith('_sum') else 2, 0)
+
+
+# Instância única por processo, usada pelo app e pelo classificador
+metrics = Metrics()
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Backends de modelo para o ASCODClassifier: Gemini, simulador local e gravação/reprodução
+"""
+
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import hashlib
+import datetime
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterator, Optional, Union
+
+# Modelo atualizado para gemini-2.5-pro conforme solicitado para maior precisão
+DEFAULT_MODEL_NAME = 'gemini-2.5-pro'
+# Modelo rápido do roteamento em camadas (ASCOD_FAST_MODEL)
+FAST_MODEL_NAME = 'gemini-2.5-flash'
+
+
+@dataclass
+class ModelResponse:
+    """Texto gerado pelo modelo e a contagem de tokens, quando disponível."""
+    text: str
+    usage: Optional[Dict[str, int]] = None
+
+
+class UpstreamError(Exception):
+    """Falha ao obter resposta do modelo."""
+
+
+class TransientUpstreamError(UpstreamError):
+    """Falha temporária do serviço (ex.: 503); a chamada pode ser repetida."""
+
+
+class UpstreamTimeout(TransientUpstreamError):
+    """O modelo não respondeu dentro do tempo da tentativa."""
+
+
+def usage_to_dict(response) -> Optional[Dict[str, int]]:
+    """Extrai a contagem de tokens (usage_metadata) de uma resposta do Gemini."""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return None
+    return {
+        'prompt_token_count': usage.prompt_token_count,
+        'cached_content_token_count': getattr(usage, 'cached_content_token_count', 0),
+        'candidates_token_count': usage.candidates_token_count,
+        'total_token_count': usage.total_token_count,
+    }
+
+
+def load_genai():
+    """
+    Importa o SDK do Gemini sob demanda: a importação leva cerca de 1 s e só o
+    backend gemini precisa dela (simulador, reprodução e motor de regras não).
+    """
+    import google.generativeai as genai
+    return genai
+
+
+def preload_sdk():
+    """Importa o SDK no processo atual (master do gunicorn com preload_app) quando o backend for usá-lo."""
+    replaying = os.getenv('ASCOD_RECORD_DIR') and os.getenv('ASCOD_RECORD_MODE', 'replay') == 'replay'
+    if os.getenv('ASCOD_BACKEND', 'gemini') == 'gemini' and not replaying:
+        load_genai()
+
+
+class ModelBackend:
+    """Interface comum: recebe o prompt do paciente e devolve o texto JSON da classificação."""
+    name = 'base'
+
+    def __init__(self, model_name: str, system_instruction: str):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+
+    @property
+    def model_id(self) -> str:
+        """Identificador usado nas chaves de cache; backends diferentes não compartilham respostas."""
+        return self.model_name
+
+    def generate(self, prompt: str, system_instruction: Optional[str] = None, timeout: Optional[float] = None) -> ModelResponse:
+        """
+        Gera a resposta; system_instruction substitui a instrução padrão (ex.: prompt podado)
+        e timeout (segundos) limita a espera pela resposta.
+        """
+        raise NotImplementedError
+
+    def generate_stream(self, prompt: str, system_instruction: Optional[str] = None,
+                        timeout: Optional[float] = None) -> Iterator[Union[str, ModelResponse]]:
+        """Gera pedaços de texto; o último item é o ModelResponse completo."""
+        response = self.generate(prompt, system_instruction, timeout)
+        yield response.text
+        yield response
+
+    async def generate_async(self, prompt: str, system_instruction: Optional[str] = None,
+                             timeout: Optional[float] = None) -> ModelResponse:
+        return await asyncio.to_thread(self.generate, prompt, system_instruction, timeout)
+
+    def count_tokens(self, text: str) -> int:
+        # Aproximação de ~4 caracteres por token
+        return max(1, len(text) // 4)
+
+    def warm_up(self, timeout: float = 10):
+        """Prepara a conexão com o serviço antes da primeira requisição (nada a fazer por padrão)."""
+
+
+class GeminiBackend(ModelBackend):
+    """Google Gemini via google-generativeai, com instrução do sistema e cache de contexto opcional."""
+    name = 'gemini'
+
+    def __init__(self, model_name: str, system_instruction: str, api_key=None, context_cache_ttl=None, response_schema=None):
+        super().__init__(model_name, system_instruction)
+        # Esquema da resposta imposto pela API (structured output)
+        self.response_schema = response_schema
+        self.api_key = api_key or os.getenv('GEMINI_API_KEY')
+        if not self.api_key:
+            raise ValueError("API key for Gemini not found. Please set the GEMINI_API_KEY environment variable.")
+        self.genai = load_genai()
+        # Com workers gevent o transporte gRPC bloqueia o loop; 'rest' usa sockets que o gevent consegue ceder
+        transport = os.getenv('ASCOD_GENAI_TRANSPORT')
+        if transport:
+            self.genai.configure(api_key=self.api_key, transport=transport)
+        else:
+            self.genai.configure(api_key=self.api_key)
+        # A instrução do sistema é registrada uma única vez por processo; cada requisição leva só o resumo do paciente
+        self.model = self.genai.GenerativeModel(self.model_name, system_instruction=self.system_instruction)
+        # Cache de contexto do Gemini (TTL em segundos; 0 desabilita e usa apenas system_instruction)
+        self.context_cache_ttl = int(context_cache_ttl if context_cache_ttl is not None else os.getenv('ASCOD_CONTEXT_CACHE_TTL', 0))
+        self._context_cache = None
+        self._context_cache_expires = 0.0
+        self._context_cache_lock = threading.Lock()
+        # Após uma falha na criação do cache, usa o modelo sem cache até este instante (sem nova chamada a cada requisição)
+        self._context_cache_retry_at = 0.0
+        self.context_cache_backoff = float(os.getenv('ASCOD_CONTEXT_CACHE_BACKOFF', 300))
+        # Modelos para instruções alternativas (prompts podados), uma por combinação de seções
+        self._variant_models = {}
+
+    def _generation_config(self):
+        # Configuração para forçar a saída em JSON (e no esquema ASCOD/TOAST, quando informado)
+        return self.genai.types.GenerationConfig(response_mime_type="application/json", response_schema=self.response_schema)
+
+    @staticmethod
+    def _request_options(timeout: Optional[float]):
+        return {'timeout': timeout} if timeout else None
+
+    def _get_model(self, system_instruction: Optional[str] = None):
+        """Retorna o modelo, criando ou renovando o cache de contexto quando habilitado."""
+        if system_instruction and system_instruction != self.system_instruction:
+            model = self._variant_models.get(system_instruction)
+            if model is None:
+                model = self._variant_models[system_instruction] = self.genai.GenerativeModel(
+                    self.model_name, system_instruction=system_instruction
+                )
+            return model
+        if not self.context_cache_ttl or time.time() < self._context_cache_retry_at:
+            return self.model
+        with self._context_cache_lock:
+            if time.time() < self._context_cache_retry_at:
+                return self.model
+            # Renova com folga de 10% do TTL antes da expiração
+            if self._context_cache is None or time.time() > self._context_cache_expires - self.context_cache_ttl * 0.1:
+                try:
+                    cached_content = self.genai.caching.CachedContent.create(
+                        model=f'models/{self.model_name}',
+                        display_name='ascod-system-instruction',
+                        system_instruction=self.system_instruction,
+                        ttl=datetime.timedelta(seconds=self.context_cache_ttl),
+                    )
+                    self._context_cache = self.genai.GenerativeModel.from_cached_content(cached_content)
+                    self._context_cache_expires = time.time() + self.context_cache_ttl
+                except Exception as e:
+                    self._context_cache = None
+                    self._context_cache_retry_at = time.time() + self.context_cache_backoff
+                    print(f"Cache de contexto indisponível, usando system_instruction por {self.context_cache_backoff:.0f} s: {e}")
+                    return self.model
+            return self._context_cache
+
+    def generate(self, prompt: str, system_instruction: Optional[str] = None, timeout: Optional[float] = None) -> ModelResponse:
+        response = self._get_model(system_instruction).generate_content(
+            prompt, generation_config=self._generation_config(), request_options=self._request_options(timeout)
+        )
+        # A API com response_mime_type="application/json" já retorna o texto limpo
+        return ModelResponse(text=response.text, usage=usage_to_dict(response))
+
+    def generate_stream(self, prompt: str, system_instruction: Optional[str] = None,
+                        timeout: Optional[float] = None) -> Iterator[Union[str, ModelResponse]]:
+        response = self._get_model(system_instruction).generate_content(
+            prompt, generation_config=self._generation_config(), stream=True, request_options=self._request_options(timeout)
+        )
+        parts = []
+        for chunk in response:
+            parts.append(chunk.text)
+            yield chunk.text
+        yield ModelResponse(text=''.join(parts), usage=usage_to_dict(response))
+
+    async def generate_async(self, prompt: str, system_instruction: Optional[str] = None,
+                             timeout: Optional[float] = None) -> ModelResponse:
+        # Requer o transporte gRPC padrão
+        response = await self._get_model(system_instruction).generate_content_async(
+            prompt, generation_config=self._generation_config(), request_options=self._request_options(timeout)
+        )
+        return ModelResponse(text=response.text, usage=usage_to_dict(response))
+
+    def count_tokens(self, text: str) -> int:
+        # Modelo sem system_instruction, para contar apenas o texto informado
+        return self.genai.GenerativeModel(self.model_name).count_tokens(text).total_tokens
+
+    def warm_up(self, timeout: float = 10):
+        # count_tokens não gera texto nem consome cota de geração, mas abre a conexão (TLS) e valida a chave
+        self.model.count_tokens('ASCOD', request_options=self._request_options(timeout))
+
+
+class SimulatorBackend(ModelBackend):
+    """
+    Simulador local para testes de carga e profiling sem rede.
+
+    Gera JSON ASCOD/TOAST válido a partir das marcações do resumo (ex.: "(A1)",
+    "sugestivo de C1"), com latência log-normal (mais um custo opcional por token
+    de saída) e taxas configuráveis de erro e de saída malformada. Prompts de uma
+    categoria (modo dividido) recebem só o objeto daquela categoria.
+    """
+    name = 'simulator'
+
+    _GRADE_HINT_RE = re.compile(r'([ASCOD])([01239])\)')
+    _CATEGORY_RE = re.compile(r'Categoria ASCOD avaliada: ([ASCOD])')
+
+    def __init__(self, model_name: str, system_instruction: str, latency_ms=None, latency_sigma=None,
+                 error_rate=None, malformed_rate=None, seed=None, ms_per_token=None):
+        super().__init__(model_name, system_instruction)
+        self.latency_ms = float(latency_ms if latency_ms is not None else os.getenv('ASCOD_SIM_LATENCY_MS', 2000))
+        self.latency_sigma = float(latency_sigma if latency_sigma is not None else os.getenv('ASCOD_SIM_LATENCY_SIGMA', 0.5))
+        self.error_rate = float(error_rate if error_rate is not None else os.getenv('ASCOD_SIM_ERROR_RATE', 0))
+        self.malformed_rate = float(malformed_rate if malformed_rate is not None else os.getenv('ASCOD_SIM_MALFORMED_RATE', 0))
+        # Tempo de geração por token de saída (ms), somado à latência sorteada
+        self.ms_per_token = float(ms_per_token if ms_per_token is not None else os.getenv('ASCOD_SIM_MS_PER_TOKEN', 0))
+        seed = seed if seed is not None else os.getenv('ASCOD_SIM_SEED')
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+
+    @property
+    def model_id(self) -> str:
+        return f'simulator/{self.model_name}'
+
+    def _draw(self):
+        """Sorteia latência (s), falha e saída malformada."""
+        with self._rng_lock:
+            # Log-normal com mediana latency_ms
+            latency = self.latency_ms / 1000 * self._rng.lognormvariate(0, self.latency_sigma) if self.latency_ms else 0
+            fail = self._rng.random() < self.error_rate
+            malformed = self._rng.random() < self.malformed_rate
+        return latency, fail, malformed
+
+    def _result_text(self, prompt: str) -> str:
+        # Importação local para evitar dependência circular com ascod_classifier
+        from ascod_classifier import ASCOD_CATEGORIES, derive_toast
+
+        grades = {}
+        for category, grade in self._GRADE_HINT_RE.findall(prompt):
+            grade = int(grade)
+            current = grades.get(category)
+            # Graus causais (1 > 2 > 3) prevalecem sobre 0
+            if current is None or (grade != 0 and (current == 0 or grade < current)):
+                grades[category] = grade
+        ascod = {
+            cat: {
+                'grade': grades.get(cat, 9),
+                'justification': f"Simulado: grau {grades.get(cat, 9)} para {cat}.",
+            }
+            for cat in ASCOD_CATEGORIES
+        }
+        category = self._CATEGORY_RE.search(prompt)
+        if category:
+            return json.dumps(ascod[category.group(1)], ensure_ascii=False)
+        toast = derive_toast({cat: ascod[cat]['grade'] for cat in ASCOD_CATEGORIES})
+        return json.dumps({'ascod': ascod, 'toast': toast}, ensure_ascii=False)
+
+    def _usage(self, prompt: str, text: str, system_instruction: Optional[str] = None) -> Dict[str, int]:
+        prompt_tokens = self.count_tokens((system_instruction or self.system_instruction) + prompt)
+        output_tokens = self.count_tokens(text)
+        return {
+            'prompt_token_count': prompt_tokens,
+            'cached_content_token_count': 0,
+            'candidates_token_count': output_tokens,
+            'total_token_count': prompt_tokens + output_tokens,
+        }
+
+    def _outcome(self, prompt: str):
+        latency, fail, malformed = self._draw()
+        text = self._result_text(prompt)
+        latency += self.ms_per_token * self.count_tokens(text) / 1000
+        if malformed:
+            text = text[:len(text) // 2]
+        return latency, fail, text
+
+    @staticmethod
+    def _check_timeout(latency: float, timeout: Optional[float]) -> float:
+        """Latência efetiva da tentativa; acima do timeout, a espera é cortada e a chamada falha."""
+        return min(latency, timeout) if timeout is not None else latency
+
+    def generate(self, prompt: str, system_instruction: Optional[str] = None, timeout: Optional[float] = None) -> ModelResponse:
+        latency, fail, text = self._outcome(prompt)
+        time.sleep(self._check_timeout(latency, timeout))
+        if timeout is not None and latency > timeout:
+            raise UpstreamTimeout(f'Simulador não respondeu em {timeout:.1f}s.')
+        if fail:
+            raise TransientUpstreamError('Falha simulada do modelo (503).')
+        return ModelResponse(text=text, usage=self._usage(prompt, text, system_instruction))
+
+    def generate_stream(self, prompt: str, system_instruction: Optional[str] = None,
+                        timeout: Optional[float] = None) -> Iterator[Union[str, ModelResponse]]:
+        latency, fail, text = self._outcome(prompt)
+        chunks = [text[i:i + 64] for i in range(0, len(text), 64)]
+        # Um terço da latência até o primeiro byte; o restante distribuído entre os pedaços
+        time.sleep(self._check_timeout(latency / 3, timeout))
+        if timeout is not None and latency / 3 > timeout:
+            raise UpstreamTimeout(f'Simulador não respondeu em {timeout:.1f}s.')
+        if fail:
+            raise TransientUpstreamError('Falha simulada do modelo (503).')
+        for chunk in chunks:
+            time.sleep(latency * 2 / 3 / len(chunks))
+            yield chunk
+        yield ModelResponse(text=text, usage=self._usage(prompt, text, system_instruction))
+
+    async def generate_async(self, prompt: str, system_instruction: Optional[str] = None,
+                             timeout: Optional[float] = None) -> ModelResponse:
+        latency, fail, text = self._outcome(prompt)
+        await asyncio.sleep(self._check_timeout(latency, timeout))
+        if timeout is not None and latency > timeout:
+            raise UpstreamTimeout(f'Simulador não respondeu em {timeout:.1f}s.')
+        if fail:
+            raise TransientUpstreamError('Falha simulada do modelo (503).')
+        return ModelResponse(text=text, usage=self._usage(prompt, text, system_instruction))
+
+
+class RecordReplayBackend(ModelBackend):
+    """
+    Grava respostas reais em disco (mode='record') ou as reproduz de forma
+    determinística (mode='replay'), uma resposta por arquivo JSON.
+    """
+    name = 'replay'
+
+    def __init__(self, inner: Optional[ModelBackend], directory: str, mode: str,
+                 model_name: str = DEFAULT_MODEL_NAME, system_instruction: str = ''):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Modo de gravação inválido: {mode}. Use record ou replay.")
+        if mode == 'record' and inner is None:
+            raise ValueError("O modo record precisa de um backend real para gravar.")
+        super().__init__(inner.model_name if inner else model_name,
+                         inner.system_instruction if inner else system_instruction)
+        self.inner = inner
+        self.directory = directory
+        self.mode = mode
+        os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def model_id(self) -> str:
+        return self.inner.model_id if self.inner else self.model_name
+
+    def _path(self, prompt: str, system_instruction: Optional[str] = None) -> str:
+        # A chave não inclui o backend (só o nome do modelo): respostas gravadas com o Gemini são reproduzidas sem ele
+        instruction = system_instruction or self.system_instruction
+        key = hashlib.sha256('\x1f'.join([self.model_name, instruction, prompt]).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f'{key}.json')
+
+    def generate(self, prompt: str, system_instruction: Optional[str] = None, timeout: Optional[float] = None) -> ModelResponse:
+        path = self._path(prompt, system_instruction)
+        if self.mode == 'replay':
+            if not os.path.exists(path):
+                raise UpstreamError(f'Resposta gravada não encontrada para este prompt ({os.path.basename(path)}).')
+            with open(path, encoding='utf-8') as f:
+                record = json.load(f)
+            return ModelResponse(text=record['text'], usage=record.get('usage'))
+
+        response = self.inner.generate(prompt, system_instruction, timeout)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'model': self.model_id, 'prompt': prompt, 'text': response.text, 'usage': response.usage},
+                      f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+        return response
+
+    def count_tokens(self, text: str) -> int:
+        return self.inner.count_tokens(text) if self.inner else super().count_tokens(text)
+
+    def warm_up(self, timeout: float = 10):
+        if self.inner:
+            self.inner.warm_up(timeout)
+
+
+def create_backend(model_name: str, system_instruction: str, api_key=None, context_cache_ttl=None,
+                   tier: str = 'pro', response_schema: Optional[Dict] = None) -> ModelBackend:
+    """
+    Cria o backend conforme ASCOD_BACKEND (gemini | simulator) e, se
+    ASCOD_RECORD_DIR estiver definido, o envolve em gravação/reprodução (ASCOD_RECORD_MODE).
+    No simulador, tier='fast' usa a latência de ASCOD_SIM_FAST_LATENCY_MS.
+    response_schema é repassado ao Gemini (desative com ASCOD_RESPONSE_SCHEMA=false).
+    """
+    backend_name = os.getenv('ASCOD_BACKEND', 'gemini')
+    record_dir = os.getenv('ASCOD_RECORD_DIR')
+    record_mode = os.getenv('ASCOD_RECORD_MODE', 'replay')
+
+    if record_dir and record_mode == 'replay':
+        # A reprodução não precisa do backend real (nem de chave de API)
+        return RecordReplayBackend(None, record_dir, 'replay', model_name, system_instruction)
+
+    if backend_name == 'gemini':
+        if os.getenv('ASCOD_RESPONSE_SCHEMA', 'true').lower() not in ['true', '1', 'on']:
+            response_schema = None
+        backend = GeminiBackend(model_name, system_instruction, api_key=api_key, context_cache_ttl=context_cache_ttl,
+                                response_schema=response_schema)
+    elif backend_name == 'simulator':
+        latency_ms = os.getenv('ASCOD_SIM_FAST_LATENCY_MS') if tier == 'fast' else None
+        backend = SimulatorBackend(model_name, system_instruction, latency_ms=latency_ms)
+    else:
+        raise ValueError(f"Backend de modelo inválido: {backend_name}. Use gemini ou simulator.")
+
+    if record_dir:
+        return RecordReplayBackend(backend, record_dir, record_mode)
+    return backend
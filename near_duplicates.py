@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Índice de quase-duplicatas dos textos livres já classificados (MinHash + LSH em SQLite)
+
+O mesmo laudo colado com outros espaços, acentos, pontuação ou frases em outra ordem
+não acerta o cache exato. Cada texto vira um conjunto de trigramas de palavras, resumido
+em uma assinatura MinHash; as faixas da assinatura (LSH) são gravadas em uma tabela
+indexada, e a busca lê só os textos que compartilham alguma faixa. A memória do processo
+não cresce com o índice, que fica no disco e é compartilhado entre os workers.
+"""
+
+import os
+import re
+import time
+import zlib
+import random
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from result_cache import DEFAULT_CACHE_PATH, DEFAULT_TTL, hash_text
+
+DEFAULT_THRESHOLD = 0.8
+DEFAULT_MAX_ENTRIES = 200000
+# 64 funções de hash em 16 faixas de 4: textos com similaridade acima de ~0,7 quase sempre viram candidatos
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+# Candidatos comparados por busca (os de faixas mais comuns ficam de fora)
+MAX_CANDIDATES = 64
+
+MERSENNE_PRIME = (1 << 61) - 1
+# Coeficientes fixos: as assinaturas gravadas continuam válidas após reiniciar
+_rng = random.Random(20240601)
+PERMUTATIONS = [(_rng.randrange(1, MERSENNE_PRIME), _rng.randrange(0, MERSENNE_PRIME)) for _ in range(NUM_PERM)]
+
+WORD_RE = re.compile(r'[a-z0-9]+')
+NUMBER_RE = re.compile(r'\d+(?:[.,]\d+)?')
+# Fim de frase: ponto seguido de espaço, ponto e vírgula ou quebra de linha (não separa "1.5")
+SENTENCE_RE = re.compile(r'\.(?:\s+|$)|[;\n]+')
+# Palavras de negação e incerteza (sem acento), reduzidas ao radical: "negativa" e "negativo" contam igual
+QUALIFIER_RE = re.compile(r'(sem|nao)$|(negativ|nega|ausen|descart|exclu|provav|possiv|suspeit|aguard|esclarec|duvid)')
+# Lado e sujeito do achado (sem acento): "carótida esquerda" x "direita" e "paciente" x "mãe" mudam a classificação
+CONTEXT_RE = re.compile(r'(esquerd|direit|bilateral|contralateral|ipsilateral|homolateral|famil)'
+                        r'|(paciente|pai|mae|irmaos?|irmas?|avos?|tios?|tias?|filhos?|filhas?|primos?|primas?)$')
+
+
+def normalize_words(text: str) -> List[str]:
+    """Palavras sem acento, caixa e pontuação."""
+    decomposed = unicodedata.normalize('NFKD', (text or '').casefold())
+    return WORD_RE.findall(decomposed.encode('ascii', 'ignore').decode('ascii'))
+
+
+def shingles(text: str, size: int = 3) -> set:
+    """Trigramas de palavras dentro de cada frase: reordenar as frases não muda o conjunto."""
+    items = set()
+    for sentence in SENTENCE_RE.split(text or ''):
+        words = normalize_words(sentence)
+        if 0 < len(words) <= size:
+            items.add(' '.join(words))
+        items.update(' '.join(words[i:i + size]) for i in range(len(words) - size + 1))
+    return items
+
+
+def qualifiers(text: str) -> List[str]:
+    """Negações e termos de incerteza do texto; '?' também conta como incerteza."""
+    found = set()
+    for word in normalize_words(text):
+        match = QUALIFIER_RE.match(word)
+        if match:
+            found.add(match.group(1) or match.group(2))
+    if '?' in (text or ''):
+        found.add('?')
+    return sorted(found)
+
+
+def context_words(text: str) -> List[str]:
+    """
+    Palavras de lado e de sujeito de cada frase, na ordem em que aparecem ("direit esquerd" não é
+    "esquerd direit"); as frases em ordem alfabética, para que reordená-las não mude o resultado.
+    """
+    sentences = set()
+    for sentence in SENTENCE_RE.split(text or ''):
+        words = []
+        for word in normalize_words(sentence):
+            match = CONTEXT_RE.match(word)
+            if match:
+                words.append(match.group(1) or match.group(2))
+        if words:
+            sentences.add(' '.join(words))
+    return sorted(sentences)
+
+
+def minhash(items: set) -> List[int]:
+    hashes = [zlib.crc32(item.encode('utf-8')) for item in items]
+    return [min((a * x + b) % MERSENNE_PRIME for x in hashes) for a, b in PERMUTATIONS]
+
+
+def similarity(left: List[int], right: List[int]) -> float:
+    """Estimativa do índice de Jaccard: fração das posições iguais nas assinaturas."""
+    return sum(1 for x, y in zip(left, right) if x == y) / NUM_PERM
+
+
+class NearDuplicateIndex:
+    """
+    Busca a classificação de um texto quase idêntico a outro já classificado.
+
+    Dois textos só são considerados o mesmo caso se, além da similaridade acima do limite,
+    tiverem os mesmos números (estenose, FEVE, espessuras), os mesmos achados e negações
+    segundo o text_extractor, os mesmos trechos que ele não explica e as mesmas palavras de
+    negação e incerteza e as mesmas palavras de lado e sujeito: "FA", "sem FA", "provável FA" e
+    "mãe com FA" diferem em uma palavra, mas não na classificação; nem "carótida esquerda" e "direita".
+    """
+
+    def __init__(self, path=None, threshold=None, max_entries=None, ttl=None):
+        # Por padrão, tabelas próprias no mesmo arquivo do cache de respostas
+        self.path = path or os.getenv('ASCOD_NEAR_DUP_PATH') or os.getenv('ASCOD_CACHE_PATH', DEFAULT_CACHE_PATH)
+        self.threshold = float(threshold if threshold is not None else os.getenv('ASCOD_NEAR_DUP_THRESHOLD', DEFAULT_THRESHOLD))
+        self.max_entries = int(max_entries if max_entries is not None else os.getenv('ASCOD_NEAR_DUP_MAX_ENTRIES', DEFAULT_MAX_ENTRIES))
+        self.ttl = float(ttl if ttl is not None else os.getenv('ASCOD_CACHE_TTL', DEFAULT_TTL))
+        # Importado aqui: text_extractor depende de ascod_classifier, que importa este módulo
+        from text_extractor import TextExtractor
+        self.extractor = TextExtractor()
+        self._local = threading.local()
+        self._schema_ready = False
+
+    @classmethod
+    def from_env(cls):
+        """Cria o índice a partir das variáveis de ambiente, ou None se estiver desabilitado (padrão)."""
+        if os.getenv('ASCOD_NEAR_DUP_ENABLED', 'false').lower() not in ['true', '1', 'on']:
+            return None
+        return cls()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            if not self._schema_ready:
+                self._init_db(conn)
+                self._schema_ready = True
+        return conn
+
+    @staticmethod
+    def _init_db(conn: sqlite3.Connection):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS near_entries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                scope TEXT NOT NULL,
+                guard TEXT NOT NULL,
+                signature BLOB NOT NULL,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_near_entries_access ON near_entries (last_access)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_near_entries_created ON near_entries (created_at)')
+        # Uma linha por faixa da assinatura; o bucket já inclui o escopo (modelo + instrução)
+        conn.execute('CREATE TABLE IF NOT EXISTS near_buckets (bucket INTEGER NOT NULL, entry_id INTEGER NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_near_buckets_bucket ON near_buckets (bucket)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_near_buckets_entry ON near_buckets (entry_id)')
+
+    def guard(self, text: str) -> str:
+        """
+        Números, achados (com negações), trechos não explicados, incerteza, palavras de negação
+        e incerteza e palavras de lado e sujeito do texto: precisam ser idênticos entre quase-duplicatas.
+        """
+        numbers = sorted({n.replace(',', '.') for n in NUMBER_RE.findall(text)})
+        # Espaços normalizados: "infarto  cortical" é o mesmo achado
+        extraction = self.extractor.extract(' '.join(text.split()))
+        findings = sorted(extraction.findings)
+        # Trechos comparados sem acento, caixa e pontuação, em qualquer ordem
+        unexplained = sorted({' '.join(normalize_words(segment)) for segment in extraction.unexplained})
+        parts = [numbers, findings, unexplained, ['hedged' if extraction.hedged else ''], qualifiers(text), context_words(text)]
+        return hash_text('\x1e'.join('\x1f'.join(part) for part in parts))
+
+    @staticmethod
+    def _buckets(scope: str, signature: List[int]) -> List[int]:
+        # Inteiro de 63 bits por faixa, estável entre processos (a função hash() do Python não é)
+        return [
+            int.from_bytes(hashlib.blake2b(f'{scope}|{band}|{signature[band * ROWS:(band + 1) * ROWS]}'.encode(),
+                                           digest_size=8).digest(), 'big') >> 1
+            for band in range(BANDS)
+        ]
+
+    def _sketch(self, text: str, scope: str) -> Optional[Tuple[List[int], str, List[int]]]:
+        items = shingles(text)
+        if not items:
+            return None
+        signature = minhash(items)
+        return signature, self.guard(text), self._buckets(scope, signature)
+
+    def lookup(self, text: str, scope: str) -> Optional[Tuple[str, Dict]]:
+        """Retorna a resposta armazenada do texto mais parecido acima do limite e {id, similarity}, ou None."""
+        sketch = self._sketch(text, scope)
+        if sketch is None:
+            return None
+        signature, guard, buckets = sketch
+        conn = self._connect()
+        rows = conn.execute(
+            f"SELECT entry_id FROM near_buckets WHERE bucket IN ({', '.join('?' * len(buckets))}) "
+            f"GROUP BY entry_id ORDER BY COUNT(*) DESC LIMIT {MAX_CANDIDATES}",
+            buckets
+        ).fetchall()
+        if not rows:
+            return None
+        ids = [row[0] for row in rows]
+        candidates = conn.execute(
+            f"SELECT id, signature, value, created_at FROM near_entries WHERE id IN ({', '.join('?' * len(ids))}) AND guard = ? AND scope = ?",
+            ids + [guard, scope]
+        ).fetchall()
+        best = None
+        now = time.time()
+        for entry_id, blob, value, created_at in candidates:
+            if self.ttl and now - created_at > self.ttl:
+                continue
+            score = similarity(signature, array('Q', blob).tolist())
+            if score >= self.threshold and (best is None or score > best[0]):
+                best = (score, entry_id, value)
+        if best is None:
+            return None
+        score, entry_id, value = best
+        conn.execute('UPDATE near_entries SET last_access = ? WHERE id = ?', (now, entry_id))
+        return value, {'id': entry_id, 'similarity': round(score, 3)}
+
+    def add(self, text: str, scope: str, value: str):
+        sketch = self._sketch(text, scope)
+        if sketch is None:
+            return
+        signature, guard, buckets = sketch
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            entry_id = conn.execute(
+                'INSERT INTO near_entries (scope, guard, signature, value, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)',
+                (scope, guard, array('Q', signature).tobytes(), value, now, now)
+            ).lastrowid
+            conn.executemany('INSERT INTO near_buckets (bucket, entry_id) VALUES (?, ?)', [(b, entry_id) for b in buckets])
+            self._evict(conn, now)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        """Remove entradas expiradas e as menos usadas recentemente acima do limite (com as faixas delas)."""
+        if self.ttl:
+            self._delete(conn, [row[0] for row in conn.execute('SELECT id FROM near_entries WHERE created_at < ?', (now - self.ttl,))])
+        if self.max_entries:
+            (count,) = conn.execute('SELECT COUNT(*) FROM near_entries').fetchone()
+            if count > self.max_entries:
+                self._delete(conn, [row[0] for row in conn.execute(
+                    'SELECT id FROM near_entries ORDER BY last_access LIMIT ?', (count - self.max_entries,)
+                )])
+
+    @staticmethod
+    def _delete(conn: sqlite3.Connection, ids: List[int]):
+        conn.executemany('DELETE FROM near_buckets WHERE entry_id = ?', [(i,) for i in ids])
+        conn.executemany('DELETE FROM near_entries WHERE id = ?', [(i,) for i in ids])
+
+    def clear(self):
+        conn = self._connect()
+        conn.execute('DELETE FROM near_buckets')
+        conn.execute('DELETE FROM near_entries')
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Poda de notas clínicas longas para um orçamento de tokens antes do envio ao modelo
+
+Resumos de alta inteiros trazem milhares de tokens de história sem relação com a
+classificação. A nota é dividida em frases; ficam as que citam achados de imagem,
+vasculares, cardíacos, hematológicos, de dissecção ou fatores de risco vascular (as de
+maior pontuação primeiro) e, no orçamento que sobrar, as demais, na ordem original, até
+o orçamento (ASCOD_TEXT_TOKEN_BUDGET). Os tokens são estimados localmente pelo número
+de caracteres, sem chamada ao modelo.
+
+Exemplo:
+    python note_trimmer.py resumo_alta.txt --budget 400
+"""
+
+import os
+import re
+import sys
+import json
+import argparse
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+DEFAULT_TOKEN_BUDGET = 1500
+# Média aproximada de caracteres por token do Gemini em português
+CHARS_PER_TOKEN = 4
+
+# Termos relevantes por grupo (texto em minúsculas); cada grupo citado na frase soma um ponto
+RELEVANCE = {
+    'imagem': r'\b(?:rm|rnm|tc|angio[- ]?(?:tc|rm|grafia)|resson[âa]ncia|tomografia|doppler|duplex|ultrassom|usg|arteriografia'
+              r'|difus[ãa]o|flair|infarto|lacuna\w*|leucoaraiose|fazekas|microangiopatia|isquemia|hipodensidade|territ[óo]rio)\b',
+    'vascular': r'\b(?:estenose|oclus[ãa]o|placa\w*|ateroma\w*|ateroscler\w*|car[óo]tida\w*|vertebra(?:l|is)|basilar|cerebral m[ée]dia'
+                r'|acm|aci|aorta|a[óo]rtic\w*|arco a[óo]rtico|intracrania\w*|extracrania\w*|ulcerad\w*)\b',
+    'cardiaco': r'\b(?:fa|fibrila[çc][ãa]o|flutter|holter|ecg|eletrocardiograma|ecocardiograma|eco ?tt|eco ?te|ete|ett|feve|fe|fra[çc][ãa]o de eje[çc][ãa]o'
+                r'|trombo\w*|fop|forame oval|septo|valva\w*|pr[óo]tese|endocardite|mixoma|cardiomiopatia|miocardiopatia'
+                r'|acinesia|discinesia|iam|infarto (?:agudo )?do mioc[áa]rdio|mitral|shunt)\b',
+    'hematologico': r'\b(?:trombofilia|antifosfol\w*|anticoagulante l[úu]pico|anticardiolipina|prote[íi]na [cs]|antitrombina|fator v'
+                    r'|hemograma|plaquetas|policitemia|trombocitemia|anemia falciforme|hemoglobina|d-d[íi]mero|vasculite'
+                    r'|neoplasia|c[âa]ncer|malignidade|enxaqueca|migr[âa]nea|moya\w*)\b',
+    # HAS/DM definem S1 no infarto lacunar; DAP, IAM prévio e revascularização, o A3
+    'fatores_de_risco': r'\b(?:hipertens\w*|has|diabet\w*|dm\d?|dap|doen[çc]a arterial perif[ée]rica|claudica[çc][ãa]o'
+                        r'|revasculariza\w*|angioplastia|stent|iam|infarto (?:agudo )?do mioc[áa]rdio|dislipidemi\w*)\b',
+    'disseccao': r'\b(?:dissec[çc][ãa]o|hematoma (?:intra)?mural|flap|duplo l[úu]men|horner|trauma cervical|pseudoaneurisma)\b',
+}
+RELEVANCE_RES = {group: re.compile(pattern) for group, pattern in RELEVANCE.items()}
+# Valores numéricos de exame (estenose, FEVE, espessura) reforçam a frase
+MEASURE_RE = re.compile(r'\d+(?:[.,]\d+)?\s*(?:%|mm|cm)')
+
+# Frase: termina em pontuação seguida de espaço ou em quebra de linha ("1.5 cm" não separa); itens de lista viram frases
+SENTENCE_RE = re.compile(r'(?:[^.!?;\n]|[.!?;](?=[^\s.!?;]))+[.!?;]*')
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+@dataclass
+class TrimmedNote:
+    """Texto enviado ao modelo e quanto da nota original ficou de fora."""
+    text: str
+    original_tokens: int
+    kept_tokens: int
+    original_sentences: int
+    kept_sentences: int
+    budget: int
+
+    @property
+    def trimmed(self) -> bool:
+        return self.kept_tokens < self.original_tokens
+
+    def to_dict(self) -> Dict:
+        return {
+            'budget_tokens': self.budget,
+            'original_tokens': self.original_tokens,
+            'kept_tokens': self.kept_tokens,
+            'removed_tokens': self.original_tokens - self.kept_tokens,
+            'original_sentences': self.original_sentences,
+            'kept_sentences': self.kept_sentences,
+        }
+
+
+class NoteTrimmer:
+    """Mantém as frases relevantes para o ASCOD até o orçamento de tokens (0 desativa a poda)."""
+
+    def __init__(self, budget: Optional[int] = None):
+        self.budget = int(budget if budget is not None else os.getenv('ASCOD_TEXT_TOKEN_BUDGET', DEFAULT_TOKEN_BUDGET))
+
+    @staticmethod
+    def score(sentence: str) -> int:
+        low = sentence.lower()
+        score = sum(1 for regex in RELEVANCE_RES.values() if regex.search(low))
+        if score and MEASURE_RE.search(low):
+            score += 1
+        return score
+
+    def trim(self, text: str) -> TrimmedNote:
+        text = (text or '').strip()
+        original_tokens = estimate_tokens(text)
+        if not self.budget or original_tokens <= self.budget:
+            return TrimmedNote(text, original_tokens, original_tokens, 0, 0, self.budget)
+
+        sentences = [m.group().strip() for m in SENTENCE_RE.finditer(text)]
+        sentences = [s for s in sentences if s.strip('.!?; ')]
+        scored = [(self.score(s), i) for i, s in enumerate(sentences)]
+        # Frases mais relevantes primeiro (em empate, as que aparecem antes); o orçamento que sobrar vai
+        # para as sem pontuação, na ordem original (a primeira traz a identificação e o quadro clínico)
+        relevant = sorted((item for item in scored if item[0] > 0), key=lambda item: (-item[0], item[1]))
+        chosen, used = [], 0
+        for score, i in relevant + [item for item in scored if item[0] == 0]:
+            cost = estimate_tokens(sentences[i]) + 1
+            if used + cost > self.budget:
+                continue
+            chosen.append(i)
+            used += cost
+
+        kept = ' '.join(self._terminated(sentences[i]) for i in sorted(chosen))
+        if not kept:
+            # Nenhuma frase coube (ou texto sem pontuação): corta no orçamento, em um limite de palavra
+            kept = text[:self.budget * CHARS_PER_TOKEN].rsplit(None, 1)[0]
+        return TrimmedNote(kept, original_tokens, estimate_tokens(kept), len(sentences), len(chosen), self.budget)
+
+    @staticmethod
+    def _terminated(sentence: str) -> str:
+        # Frases vindas de listas ou quebras de linha ganham um ponto final
+        return sentence if sentence[-1] in '.!?;' else sentence + '.'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Poda uma nota clínica para o orçamento de tokens')
+    parser.add_argument('input', nargs='?', help='Arquivo de texto (padrão: entrada padrão)')
+    parser.add_argument('--budget', type=int, help='Orçamento em tokens (padrão: ASCOD_TEXT_TOKEN_BUDGET)')
+    args = parser.parse_args()
+    if args.input:
+        with open(args.input, encoding='utf-8') as f:
+            note = f.read()
+    else:
+        note = sys.stdin.read()
+    result = NoteTrimmer(args.budget).trim(note)
+    print(result.text)
+    print(json.dumps(result.to_dict(), ensure_ascii=False), file=sys.stderr)
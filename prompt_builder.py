@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Montagem da instrução do sistema apenas com as seções relevantes para cada caso
+"""
+
+import os
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+# Seções de ASCOD_SYSTEM_INSTRUCTION, na ordem do texto, e o marcador onde cada uma começa
+SECTION_MARKERS = [
+    ('intro', ''),
+    ('criteria_A', '#### **A - Aterosclerose**'),
+    ('criteria_S', '#### **S - Doença de Pequenos Vasos'),
+    ('criteria_C', '#### **C - Cardiopatia'),
+    ('criteria_O', '#### **O - Outra Causa'),
+    ('criteria_D', '#### **D - Dissecção'),
+    ('input_format', '**## Formato de Entrada do Usuário**'),
+    ('task', '**## Instruções da Tarefa e Formato de Saída**'),
+    ('rule_multiple_causes', '**## Regra Crucial: Múltiplas Causas**'),
+    ('rule_grade_0_vs_9', '**## Regra Crucial: Diferença entre Grau 0 (Ausente) e Grau 9 (Incompleto)**'),
+    ('rule_O', '** ## REGRA SOBRE O ITEM "O" (Outras Causas) **'),
+    ('toast_template', '--- CLASSIFICAÇÃO TOAST ---'),
+    ('toast_header', '--- Base de Conhecimento 2: Critérios TOAST'),
+    ('toast_1', 'TOAST 1 –'),
+    ('toast_2', 'TOAST 2 –'),
+    ('toast_3', 'TOAST 3 –'),
+    ('toast_4', 'TOAST 4 –'),
+    ('toast_5', 'TOAST 5 –'),
+    ('rule_S0', '**## Regra Específica e Rigorosa para Doença de Pequenos Vasos (Categoria S)**'),
+    ('toast_template_repeat', '--- CLASSIFICAÇÃO TOAST ---'),
+]
+
+# Seções que dependem de uma categoria ASCOD ter dados no caso
+CATEGORY_SECTIONS = {
+    'A': ('criteria_A', 'toast_1'),
+    'S': ('criteria_S', 'toast_3'),
+    'C': ('criteria_C', 'toast_2'),
+    'O': ('criteria_O', 'toast_4'),
+    'D': ('criteria_D', 'toast_4'),
+}
+
+# Regras específicas enviadas junto com os critérios de uma categoria no modo dividido
+CATEGORY_RULES = {
+    'S': ('rule_S0',),
+    'O': ('rule_O',),
+}
+
+# Seções de cada instrução por categoria (ASCOD_SPLIT_CATEGORIES), na ordem do texto
+SPLIT_COMMON_SECTIONS = ('intro', 'input_format', 'rule_grade_0_vs_9')
+
+# Repetição literal de 'toast_template'; nunca é enviada
+DROPPED_SECTIONS = ('toast_template_repeat',)
+
+# Cabeçalhos gerados por PatientData.to_natural_language para cada categoria
+STRUCTURED_HEADERS = {
+    'A': 'Aterosclerose:',
+    'S': 'Pequenos Vasos:',
+    'C': 'Cardiopatia:',
+    'O': 'Outras Causas:',
+    'D': 'Dissecção:',
+}
+
+# Termos que indicam dados de cada categoria em texto livre (usados só com ASCOD_PROMPT_PRUNING=all)
+TEXT_KEYWORDS = {
+    'A': r'esteno|placa|ateroma|ateroscl|car[óo]tid|aort|vertebr|basilar|angio|doppler|oclus|iam\b|infarto (agudo )?do mioc[áa]rdio|arterial perif',
+    'S': r'lacun|leuco|fazekas|pequenos vasos|microangiopat|micro-?hemorrag|perivascular|subcortical|cortical|resson[âa]ncia|\brm\b|\btc\b|tomografia',
+    'C': r'fibrila|\bfa\b|flutter|ecocardio|\beco\b|holter|feve|fra[çc][ãa]o de eje|trombo|pr[óo]tese|valv|forame oval|\bfop\b|septo|mixoma|endocardite|cardiomiopat|miocard|mitral',
+    'O': r'trombofil|antifosfol|vasculit|angi[ií]te|moyamoya|policitemia|trombocitemia|enxaqueca|neoplas|c[âa]ncer|malign|hematol|lúpus|lupus|outras causas',
+    'D': r'dissec|hematoma|flap|horner|duplo l[úu]men|trauma cervical',
+}
+
+
+@dataclass(frozen=True)
+class AssembledPrompt:
+    """Instrução do sistema montada para um caso e o tamanho dela."""
+    system_instruction: str
+    categories: Tuple[str, ...]
+    pruned: bool
+    full_chars: int
+
+    def size(self) -> Dict:
+        chars = len(self.system_instruction)
+        return {
+            'chars': chars,
+            'full_chars': self.full_chars,
+            # Aproximação de ~4 caracteres por token
+            'estimated_tokens': chars // 4,
+            'reduction': round(1 - chars / self.full_chars, 3) if self.full_chars else 0,
+            'categories': list(self.categories),
+        }
+
+
+def split_sections(instruction: str) -> Dict[str, str]:
+    """Divide a instrução nas seções de SECTION_MARKERS (concatenadas, reproduzem o texto original)."""
+    starts = []
+    position = 0
+    for name, marker in SECTION_MARKERS:
+        index = instruction.find(marker, position) if marker else 0
+        if index < 0:
+            raise ValueError(f"Seção '{name}' não encontrada na instrução do sistema.")
+        starts.append((name, index))
+        position = index + len(marker)
+    sections = {}
+    for i, (name, start) in enumerate(starts):
+        end = starts[i + 1][1] if i + 1 < len(starts) else len(instruction)
+        sections[name] = instruction[start:end]
+    return sections
+
+
+class PromptBuilder:
+    """
+    Monta a instrução do sistema com os critérios apenas das categorias que
+    têm dados no caso; as regras gerais (ex.: S0 estrito, grau 0 x 9) sempre vão.
+
+    ASCOD_PROMPT_PRUNING: 'structured' (padrão, só resumos gerados pelo
+    formulário), 'all' (também texto livre, por palavras-chave) ou 'off'.
+    """
+
+    def __init__(self, instruction: str, output_format: str = '', mode=None):
+        self.full_instruction = instruction + output_format
+        self.output_format = output_format
+        self.mode = mode or os.getenv('ASCOD_PROMPT_PRUNING', 'structured')
+        if self.mode not in ('structured', 'all', 'off'):
+            raise ValueError(f"ASCOD_PROMPT_PRUNING inválido: {self.mode}. Use structured, all ou off.")
+        try:
+            self.sections = split_sections(instruction)
+        except ValueError as e:
+            print(f"Poda do prompt desabilitada: {e}")
+            self.sections = None
+        self._keywords = {cat: re.compile(pattern, re.IGNORECASE) for cat, pattern in TEXT_KEYWORDS.items()}
+        # Cache por processo (no máximo 32 combinações de categorias)
+        self._assemble = lru_cache(maxsize=None)(self._assemble_uncached)
+        # Uma instrução por categoria no modo dividido
+        self.category_instruction = lru_cache(maxsize=None)(self._category_instruction_uncached)
+
+    def relevant_categories(self, text: str, structured: bool = False) -> Tuple[str, ...]:
+        """
+        Categorias com dados no caso; todas quando não for possível decidir.
+        structured: o texto é um resumo gerado por PatientData.to_natural_language (informado
+        por quem o gerou; um texto livre colado com o mesmo início não é podado por isso).
+        """
+        all_categories = tuple(CATEGORY_SECTIONS)
+        if self.sections is None or self.mode == 'off':
+            return all_categories
+        if structured:
+            return tuple(cat for cat, header in STRUCTURED_HEADERS.items() if header in text)
+        if self.mode == 'all':
+            return tuple(cat for cat, pattern in self._keywords.items() if pattern.search(text))
+        return all_categories
+
+    def build(self, text: str, structured: bool = False) -> AssembledPrompt:
+        return self._assemble(self.relevant_categories(text, structured))
+
+    def _assemble_uncached(self, categories: Tuple[str, ...]) -> AssembledPrompt:
+        all_categories = tuple(CATEGORY_SECTIONS)
+        if categories == all_categories or self.sections is None:
+            # Sem poda: mantém a instrução original (e o cache de contexto do Gemini)
+            return AssembledPrompt(self.full_instruction, all_categories, False, len(self.full_instruction))
+
+        wanted = {section for cat in categories for section in CATEGORY_SECTIONS[cat]}
+        optional = {section for sections in CATEGORY_SECTIONS.values() for section in sections}
+        parts: List[str] = []
+        for name, content in self.sections.items():
+            if name in DROPPED_SECTIONS or (name in optional and name not in wanted):
+                continue
+            if name == 'input_format':
+                # Logo após a tabela de critérios
+                parts.append(self._omitted_note(categories))
+            parts.append(content)
+        parts.append(self.output_format)
+        return AssembledPrompt(''.join(parts), categories, True, len(self.full_instruction))
+
+    def _category_instruction_uncached(self, category: str, output_format: str) -> str:
+        """
+        Instrução do modo dividido: introdução, critérios e regras só da categoria,
+        a regra de grau 0 x 9 e o formato de resposta da categoria (sem TOAST).
+        """
+        if self.sections is None:
+            return self.full_instruction + output_format
+        wanted = set(SPLIT_COMMON_SECTIONS) | {f'criteria_{category}'} | set(CATEGORY_RULES.get(category, ()))
+        return ''.join(content for name, content in self.sections.items() if name in wanted) + output_format
+
+    @staticmethod
+    def _omitted_note(categories: Tuple[str, ...]) -> str:
+        omitted = [cat for cat in CATEGORY_SECTIONS if cat not in categories]
+        return (
+            f"**Nota:** O resumo deste paciente não traz dados para as categorias {', '.join(omitted)}; "
+            "por isso os critérios delas foram omitidos. Atribua grau 9 a essas categorias, "
+            "informando que a avaliação correspondente não foi relatada.\n\n---\n\n"
+        )
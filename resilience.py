@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Política de chamadas ao modelo: prazo, novas tentativas com jitter, circuit breaker e requisições hedged
+"""
+
+import os
+import time
+import random
+import functools
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Iterator, Optional
+
+from metrics import metrics
+from model_backends import TransientUpstreamError, UpstreamError, UpstreamTimeout
+
+
+@functools.lru_cache(maxsize=None)
+def transient_errors() -> tuple:
+    """
+    Erros que indicam instabilidade do serviço e justificam nova tentativa.
+    Montada no primeiro uso: as exceções do requests e do google-api-core pesam na inicialização.
+    """
+    import requests
+    from google.api_core import exceptions as google_exceptions
+    return (
+        TransientUpstreamError,
+        TimeoutError,
+        ConnectionError,
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+        google_exceptions.BadGateway,
+        google_exceptions.GatewayTimeout,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.TooManyRequests,
+        google_exceptions.ResourceExhausted,
+    )
+
+
+class CircuitOpenError(UpstreamError):
+    """O circuit breaker está aberto: o modelo está instável e a chamada nem é feita."""
+
+
+class DeadlineExceeded(UpstreamError):
+    """O prazo total da requisição terminou."""
+
+
+def is_transient(error: Exception) -> bool:
+    return isinstance(error, transient_errors())
+
+
+def env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ['true', '1', 'on']
+
+
+class Deadline:
+    """Prazo absoluto de uma requisição, compartilhado entre tentativas e camadas."""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+class CircuitBreaker:
+    """
+    Abre após `failure_threshold` falhas transitórias consecutivas; depois de
+    `reset_timeout` segundos deixa passar uma chamada de teste (meio-aberto).
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self._probing = False
+            if self.state == 'half_open' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self._failures = 0
+            self._probing = False
+
+    def release(self):
+        """Chamada sem resposta do modelo nem falha dele (ex.: prazo esgotado na fila): o estado não muda."""
+        with self._lock:
+            # Meio-aberto: a próxima chamada pode fazer o teste
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == 'half_open' or self._failures >= self.failure_threshold:
+                if self.state != 'open':
+                    metrics.inc('ascod_resilience_events_total', {'tier': self.name, 'event': 'circuit_opened'})
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+class CallPolicy:
+    """Aplica prazo, novas tentativas, circuit breaker e hedging às chamadas de um backend."""
+
+    def __init__(self, name: str, attempts: int = 3, backoff: float = 0.5, max_backoff: float = 8.0,
+                 breaker: Optional[CircuitBreaker] = None, hedge: bool = False, hedge_after: Optional[float] = None,
+                 hedge_pool: int = 64, seed=None):
+        self.name = name
+        self.attempts = max(1, attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker(name)
+        self.hedge = hedge
+        # Atraso fixo do hedge; None usa o p95 das latências recentes
+        self.hedge_after = hedge_after
+        self._latencies = deque(maxlen=200)
+        self._rng = random.Random(seed)
+        self._hedge_pool = hedge_pool
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, name: str):
+        hedge_after_ms = float(os.getenv('ASCOD_HEDGE_AFTER_MS', 0))
+        return cls(
+            name,
+            attempts=int(os.getenv('ASCOD_RETRY_ATTEMPTS', 3)),
+            backoff=float(os.getenv('ASCOD_RETRY_BACKOFF_MS', 500)) / 1000,
+            max_backoff=float(os.getenv('ASCOD_RETRY_MAX_BACKOFF_MS', 8000)) / 1000,
+            breaker=CircuitBreaker(
+                name,
+                failure_threshold=int(os.getenv('ASCOD_BREAKER_FAILURES', 5)),
+                reset_timeout=float(os.getenv('ASCOD_BREAKER_RESET_SECONDS', 30)),
+            ),
+            hedge=env_flag('ASCOD_HEDGE_ENABLED', 'false'),
+            hedge_after=hedge_after_ms / 1000 if hedge_after_ms else None,
+            hedge_pool=int(os.getenv('ASCOD_HEDGE_POOL', 64)),
+        )
+
+    # Regras comuns às versões síncrona, assíncrona e de streaming
+
+    def _before_attempt(self, deadline: Deadline) -> float:
+        """Verifica prazo e circuito; retorna o tempo restante para a tentativa."""
+        remaining = deadline.remaining()
+        if remaining <= 0:
+            metrics.inc('ascod_resilience_events_total', {'tier': self.name, 'event': 'deadline'})
+            raise DeadlineExceeded(f'Prazo de {deadline.seconds:.0f}s esgotado antes da resposta do modelo.')
+        if not self.breaker.allow():
+            metrics.inc('ascod_resilience_events_total', {'tier': self.name, 'event': 'circuit_rejected'})
+            raise CircuitOpenError('Modelo indisponível no momento (circuit breaker aberto).')
+        return remaining
+
+    def _after_failure(self, error: Exception, attempt: int, deadline: Deadline) -> Optional[float]:
+        """Registra a falha; retorna a espera antes da próxima tentativa ou None para desistir."""
+        if not is_transient(error):
+            # Erros da requisição (ex.: argumento inválido) ou locais (ex.: prazo esgotado aguardando vaga
+            # para o upstream) não dizem nada sobre o serviço: só uma resposta completa fecha o circuito
+            self.breaker.release()
+            return None
+        self.breaker.record_failure()
+        if attempt + 1 >= self.attempts:
+            return None
+        # Backoff exponencial com jitter completo
+        delay = self._rng.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if delay >= deadline.remaining():
+            return None
+        metrics.inc('ascod_resilience_events_total', {'tier': self.name, 'event': 'retry'})
+        return delay
+
+    def _after_success(self, latency: float):
+        self.breaker.record_success()
+        self._latencies.append(latency)
+
+    def _final_error(self, error: Exception, deadline: Deadline) -> Exception:
+        if deadline.expired() and not isinstance(error, DeadlineExceeded):
+            metrics.inc('ascod_resilience_events_total', {'tier': self.name, 'event': 'deadline'})
+            return DeadlineExceeded(f'Prazo de {deadline.seconds:.0f}s esgotado: {error}')
+        return error
+
+    def hedge_delay(self) -> Optional[float]:
+        """Espera antes de disparar a segunda requisição; None desativa o hedge."""
+        if not self.hedge:
+            return None
+        if self.hedge_after:
+            return self.hedge_after
+        if len(self._latencies) < 20:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    # Chamada síncrona
+
+    def call(self, fn: Callable[[float], object], deadline: Deadline):
+        """Executa fn(timeout) com novas tentativas até o prazo; fn recebe o tempo restante."""
+        attempt = 0
+        while True:
+            remaining = self._before_attempt(deadline)
+            start = time.monotonic()
+            try:
+                result = self._hedged(fn, remaining)
+            except Exception as e:
+                delay = self._after_failure(e, attempt, deadline)
+                if delay is None:
+                    raise self._final_error(e, deadline) from e
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._after_success(time.monotonic() - start)
+            return result
+
+    def _hedged(self, fn, timeout: float):
+        delay = self.hedge_delay()
+        if delay is None or delay >= timeout:
+            return fn(timeout)
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._hedge_pool, thread_name_prefix=f'ascod-hedge-{self.name}')
+        started = time.monotonic()
+        primary = self._executor.submit(fn, timeout)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+        metrics.inc('ascod_resilience_events_total', {'tier': self.name, 'event': 'hedge'})
+        hedge = self._executor.submit(fn, timeout - (time.monotonic() - started))
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, timeout - (time.monotonic() - started)), return_when=FIRST_COMPLETED)
+            if not done:
+                raise UpstreamTimeout('Tempo esgotado aguardando o modelo (requisição hedged).')
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        metrics.inc('ascod_resilience_events_total', {'tier': self.name, 'event': 'hedge_won'})
+                    # A outra requisição continua em segundo plano e seu resultado é descartado
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    # Streaming: novas tentativas só enquanto nenhum pedaço foi entregue
+
+    def stream(self, open_stream: Callable[[float], Iterator], deadline: Deadline) -> Iterator:
+        attempt = 0
+        while True:
+            remaining = self._before_attempt(deadline)
+            start = time.monotonic()
+            started = False
+            try:
+                for item in open_stream(remaining):
+                    started = True
+                    yield item
+            except Exception as e:
+                delay = None if started else self._after_failure(e, attempt, deadline)
+                if started and is_transient(e):
+                    self.breaker.record_failure()
+                if delay is None:
+                    raise self._final_error(e, deadline) from e
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._after_success(time.monotonic() - start)
+            return
+
+    # Chamada assíncrona
+
+    async def call_async(self, fn, deadline: Deadline):
+        """Versão assíncrona de call; fn(timeout) é uma corrotina."""
+        attempt = 0
+        while True:
+            remaining = self._before_attempt(deadline)
+            start = time.monotonic()
+            try:
+                result = await self._hedged_async(fn, remaining)
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    e = UpstreamTimeout('Tempo esgotado aguardando o modelo.')
+                delay = self._after_failure(e, attempt, deadline)
+                if delay is None:
+                    raise self._final_error(e, deadline) from e
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._after_success(time.monotonic() - start)
+            return result
+
+    async def _hedged_async(self, fn, timeout: float):
+        delay = self.hedge_delay()
+        if delay is None or delay >= timeout:
+            return await asyncio.wait_for(fn(timeout), timeout)
+        started = time.monotonic()
+        primary = asyncio.ensure_future(fn(timeout))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+        metrics.inc('ascod_resilience_events_total', {'tier': self.name, 'event': 'hedge'})
+        hedge = asyncio.ensure_future(fn(timeout - delay))
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, timeout - (time.monotonic() - started)),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise UpstreamTimeout('Tempo esgotado aguardando o modelo (requisição hedged).')
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            metrics.inc('ascod_resilience_events_total', {'tier': self.name, 'event': 'hedge_won'})
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cache persistente de respostas da IA, compartilhado entre os workers do gunicorn
+"""
+
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Optional
+
+DEFAULT_CACHE_PATH = 'ascod_cache.sqlite3'
+DEFAULT_TTL = 7 * 24 * 3600  # 7 dias
+DEFAULT_MAX_ENTRIES = 10000
+
+
+def normalize_text(text: str) -> str:
+    """Normaliza o texto de entrada (espaços e caixa) para compor a chave do cache."""
+    return re.sub(r'\s+', ' ', text or '').strip().casefold()
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """Cache endereçado por conteúdo em um arquivo SQLite (modo WAL), com TTL e despejo LRU."""
+
+    def __init__(self, path=None, ttl=None, max_entries=None):
+        self.path = path or os.getenv('ASCOD_CACHE_PATH', DEFAULT_CACHE_PATH)
+        self.ttl = float(ttl if ttl is not None else os.getenv('ASCOD_CACHE_TTL', DEFAULT_TTL))
+        self.max_entries = int(max_entries if max_entries is not None else os.getenv('ASCOD_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES))
+        self._local = threading.local()
+        self._init_db()
+
+    @classmethod
+    def from_env(cls):
+        """Cria o cache a partir das variáveis de ambiente, ou None se estiver desabilitado."""
+        if os.getenv('ASCOD_CACHE_ENABLED', 'true').lower() in ['false', '0', 'off']:
+            return None
+        return cls()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Uma conexão por thread; o arquivo é compartilhado entre processos.
+        # Conexões herdadas do master (preload_app) não são reaproveitadas após o fork.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        conn = self._connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_results_last_access ON results (last_access)')
+        # Chamadas em andamento (single-flight entre workers) e contadores agregados
+        conn.execute('CREATE TABLE IF NOT EXISTS inflight (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+
+    @staticmethod
+    def make_key(text: str, model_name: str, instruction: str) -> str:
+        """Chave = texto normalizado + nome do modelo + hash da instrução do sistema."""
+        return hash_text('\x1f'.join([normalize_text(text), model_name, hash_text(instruction)]))
+
+    def get(self, key: str) -> Optional[str]:
+        conn = self._connect()
+        row = conn.execute('SELECT value, created_at FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, created_at = row
+        now = time.time()
+        if self.ttl and now - created_at > self.ttl:
+            conn.execute('DELETE FROM results WHERE key = ?', (key,))
+            return None
+        conn.execute('UPDATE results SET last_access = ? WHERE key = ?', (now, key))
+        return value
+
+    def set(self, key: str, value: str):
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            'INSERT OR REPLACE INTO results (key, value, created_at, last_access) VALUES (?, ?, ?, ?)',
+            (key, value, now, now)
+        )
+        self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection):
+        """Remove entradas expiradas e as menos usadas recentemente acima do limite."""
+        if self.ttl:
+            conn.execute('DELETE FROM results WHERE created_at < ?', (time.time() - self.ttl,))
+        if self.max_entries:
+            (count,) = conn.execute('SELECT COUNT(*) FROM results').fetchone()
+            if count > self.max_entries:
+                conn.execute(
+                    'DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_access LIMIT ?)',
+                    (count - self.max_entries,)
+                )
+
+    def acquire_lease(self, key: str, ttl: float) -> bool:
+        """Registra este processo como responsável pela chamada; False se outro já estiver."""
+        conn = self._connect()
+        now = time.time()
+        conn.execute('DELETE FROM inflight WHERE key = ? AND expires_at < ?', (key, now))
+        cursor = conn.execute('INSERT OR IGNORE INTO inflight (key, expires_at) VALUES (?, ?)', (key, now + ttl))
+        return cursor.rowcount == 1
+
+    def lease_active(self, key: str) -> bool:
+        row = self._connect().execute('SELECT expires_at FROM inflight WHERE key = ?', (key,)).fetchone()
+        return row is not None and row[0] >= time.time()
+
+    def release_lease(self, key: str):
+        self._connect().execute('DELETE FROM inflight WHERE key = ?', (key,))
+
+    def incr(self, name: str, amount: int = 1):
+        self._connect().execute(
+            'INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+            (name, amount)
+        )
+
+    def counters(self):
+        return dict(self._connect().execute('SELECT name, value FROM counters').fetchall())
+
+    def clear(self):
+        self._connect().execute('DELETE FROM results')
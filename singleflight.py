@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Coalescência de chamadas idênticas em andamento (single-flight)
+"""
+
+import os
+import time
+import threading
+from typing import Any, Callable, Optional, Tuple
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Garante uma única chamada em andamento por chave.
+
+    Dentro do processo, quem chega enquanto a chamada roda espera e recebe o mesmo
+    resultado. Entre workers, um lease no cache SQLite indica que outro processo já
+    está chamando o modelo; nesse caso aguardamos o resultado aparecer no cache.
+    """
+
+    def __init__(self, cache=None, lease_ttl=None, poll_interval=0.1):
+        self.cache = cache
+        # O lease expira sozinho se o worker morrer no meio da chamada
+        self.lease_ttl = float(lease_ttl or os.getenv('ASCOD_INFLIGHT_LEASE_TTL', 130))
+        self.poll_interval = poll_interval
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn: Callable[[], Any], remote_fetch: Optional[Callable[[], Any]] = None) -> Tuple[Any, bool]:
+        """Executa fn uma vez por chave; retorna (resultado, coalescido)."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            self._count()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        coalesced = False
+        try:
+            result = None
+            have_lease = False
+            if self.cache and remote_fetch is not None:
+                have_lease = self.cache.acquire_lease(key, self.lease_ttl)
+                if not have_lease:
+                    result = self._wait_remote(key, remote_fetch)
+                    coalesced = result is not None
+                    if coalesced:
+                        self._count()
+            if result is None:
+                try:
+                    result = fn()
+                finally:
+                    if have_lease:
+                        self.cache.release_lease(key)
+            call.result = result
+            return result, coalesced
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def _wait_remote(self, key, remote_fetch):
+        """Aguarda o worker que detém o lease gravar o resultado no cache."""
+        while True:
+            result = remote_fetch()
+            if result is not None:
+                return result
+            if not self.cache.lease_active(key):
+                # O outro worker terminou sem resultado utilizável (erro) ou morreu
+                return remote_fetch()
+            time.sleep(self.poll_interval)
+
+    def _count(self):
+        with self._lock:
+            self.coalesced += 1
+        if self.cache:
+            self.cache.incr('coalesced_requests')
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark de inicialização (cold start) do app
+
+Em processos Python novos, mede o tempo até o interpretador importar o app,
+até a primeira resposta do /api/analyze (motor de regras) e do warm-up do
+worker, além da importação do SDK do Gemini que o master do gunicorn paga uma
+vez com preload_app. Também verifica que nenhum módulo pesado é carregado na
+importação do app; isso e uma piora acima de --max-slowdown em relação a
+--compare reprovam a execução (código de saída 1).
+
+Exemplos:
+    python startup_benchmark.py --runs 7 --output startup_base.json
+    python startup_benchmark.py --compare startup_base.json --max-slowdown 1.3
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import platform
+import statistics
+import subprocess
+import tempfile
+from typing import Dict, List
+
+from benchmark import source_fingerprint
+
+DEFAULT_OUTPUT = 'startup_results.json'
+
+# Módulos que não podem ser importados junto com o app (carregados sob demanda)
+HEAVY_MODULES = ('google.generativeai', 'google.ai.generativelanguage', 'google.api_core', 'grpc', 'numpy', 'requests')
+
+# Executado em um processo novo; imprime os tempos em JSON na última linha
+PROBE = r'''
+import sys, time, json
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+heavy = sorted(m for m in HEAVY_MODULES if m in sys.modules)
+client = app.app.test_client()
+response = client.post('/api/analyze', json={'type': 'structured', 'stenosis': '70'})
+first_response = time.perf_counter()
+app.warm_up()
+warmed = time.perf_counter()
+from model_backends import load_genai
+load_genai()
+sdk = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'first_request_ms': (first_response - imported) * 1000,
+    'warm_up_ms': (warmed - first_response) * 1000,
+    'sdk_import_ms': (sdk - warmed) * 1000,
+    'status': response.status_code,
+    'heavy_modules': heavy,
+}))
+'''
+
+# Métricas comparadas com a execução de referência
+COMPARED = ('import_ms', 'first_request_ms', 'warm_up_ms')
+
+
+def run_probe(env: Dict[str, str]) -> Dict:
+    """Executa uma medição em um interpretador novo; process_ms inclui a subida do Python."""
+    base = os.path.dirname(os.path.abspath(__file__))
+    code = f'HEAVY_MODULES = {HEAVY_MODULES!r}\n' + PROBE
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-c', code], cwd=base, env=env, capture_output=True, text=True)
+    elapsed = (time.perf_counter() - start) * 1000
+    if completed.returncode != 0:
+        raise RuntimeError(f'A medição falhou:\n{completed.stderr[-2000:]}')
+    sample = json.loads(completed.stdout.strip().splitlines()[-1])
+    sample['process_ms'] = elapsed
+    return sample
+
+
+def summarize(samples: List[Dict]) -> Dict:
+    summary = {}
+    for key in ('process_ms', 'import_ms', 'first_request_ms', 'warm_up_ms', 'sdk_import_ms'):
+        values = sorted(s[key] for s in samples)
+        summary[key] = {
+            'median': round(statistics.median(values), 2),
+            'min': round(values[0], 2),
+            'max': round(values[-1], 2),
+        }
+    summary['heavy_modules'] = sorted({m for s in samples for m in s['heavy_modules']})
+    return summary
+
+
+def check(summary: Dict, baseline: Dict, max_slowdown: float, min_delta_ms: float) -> List[str]:
+    """Violações: módulos pesados na importação e pioras acima do limite em relação à referência."""
+    failures = []
+    if summary['heavy_modules']:
+        failures.append(f"Módulos pesados importados com o app: {', '.join(summary['heavy_modules'])}")
+    old = (baseline or {}).get('summary')
+    if not old:
+        return failures
+    for key in COMPARED:
+        before, after = old[key]['median'], summary[key]['median']
+        # Diferenças pequenas em valores absolutos são ruído de agendamento
+        if before and after > before * max_slowdown and after - before > min_delta_ms:
+            failures.append(f'{key}: {before:.0f} ms -> {after:.0f} ms ({after / before:.2f}x)')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de inicialização do app')
+    parser.add_argument('--runs', type=int, default=5, help='Processos medidos (a mediana é comparada)')
+    parser.add_argument('--backend', choices=['gemini', 'simulator'], default='simulator',
+                        help='ASCOD_BACKEND dos processos medidos (gemini requer GEMINI_API_KEY)')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--compare', help='Resultado anterior (JSON) usado como referência')
+    parser.add_argument('--max-slowdown', type=float, default=1.25, help='Piora máxima da mediana (padrão 1.25x)')
+    parser.add_argument('--min-delta-ms', type=float, default=30, help='Diferença absoluta abaixo da qual não reprova')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Bancos SQLite descartáveis e sem chamada ao modelo no warm-up: mede só a inicialização local
+        env = dict(os.environ, ASCOD_BACKEND=args.backend, ASCOD_WARMUP_MODEL='false',
+                   ASCOD_CACHE_PATH=os.path.join(tmp, 'cache.sqlite3'),
+                   ASCOD_JOBS_PATH=os.path.join(tmp, 'jobs.sqlite3'),
+                   ASCOD_METRICS_PATH=os.path.join(tmp, 'metrics.sqlite3'),
+                   ASCOD_HISTORY_PATH=os.path.join(tmp, 'history.sqlite3'))
+        samples = []
+        for i in range(args.runs):
+            samples.append(run_probe(env))
+            s = samples[-1]
+            print(f"execução {i + 1}: processo {s['process_ms']:.0f} ms   importação {s['import_ms']:.0f} ms   "
+                  f"1ª resposta {s['first_request_ms']:.0f} ms   warm-up {s['warm_up_ms']:.0f} ms   "
+                  f"SDK {s['sdk_import_ms']:.0f} ms")
+
+    summary = summarize(samples)
+    print(f"\nMediana: processo {summary['process_ms']['median']:.0f} ms, importação {summary['import_ms']['median']:.0f} ms, "
+          f"1ª resposta {summary['first_request_ms']['median']:.0f} ms, SDK do Gemini {summary['sdk_import_ms']['median']:.0f} ms")
+
+    result = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'source': source_fingerprint(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'backend': args.backend,
+        },
+        'runs': args.runs,
+        'summary': summary,
+        'samples': samples,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"Resultados gravados em {args.output}")
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    failures = check(summary, baseline, args.max_slowdown, args.min_delta_ms)
+    if failures:
+        print('\nInicialização REPROVADA:')
+        for failure in failures:
+            print(f'  - {failure}')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -190,7 +190,7 @@ async function submitAnalysis(data) {
     showLoading();
     
     try {
-        const response = await fetch('/api/analyze', {
+        const response = await fetch('/api/analyze/stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
@@ -198,18 +198,74 @@ async function submitAnalysis(data) {
             body: JSON.stringify(data)
         });
         
-        const result = await response.json();
-        
-        if (response.ok && result.success) {
-            displayResults(result);
-        } else {
+        if (!response.ok || !response.body) {
+            const result = await response.json();
             showError(result.error || 'Erro ao processar análise');
+            return;
         }
+
+        await readAnalysisStream(response);
     } catch (error) {
         showError('Erro de conexão. Verifique se o servidor está rodando.');
     }
 }
 
+// Lê os Server-Sent Events da análise e atualiza a tela a cada evento
+async function readAnalysisStream(response) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    const partial = { ascod: {}, toast_code: null };
+    let buffer = '';
+    let finished = false;
+
+    while (!finished) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Eventos SSE são separados por uma linha em branco
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let eventName = 'message';
+            let eventData = '';
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) eventName = line.slice(7);
+                else if (line.startsWith('data: ')) eventData += line.slice(6);
+            });
+            const payload = eventData ? JSON.parse(eventData) : {};
+
+            if (eventName === 'progress' && payload.stage === 'escalated') {
+                // A resposta do modelo rápido foi descartada: limpa os resultados parciais
+                partial.ascod = {};
+                partial.toast_code = null;
+                displayPartialResults(partial);
+            } else if (eventName === 'grade') {
+                partial.ascod[payload.category] = { ...partial.ascod[payload.category], grade: payload.grade };
+                displayPartialResults(partial);
+            } else if (eventName === 'justification') {
+                partial.ascod[payload.category] = { ...partial.ascod[payload.category], justification: payload.text };
+                displayPartialResults(partial);
+            } else if (eventName === 'toast') {
+                partial.toast_code = payload.classification;
+                displayPartialResults(partial);
+            } else if (eventName === 'final') {
+                displayResults(payload);
+                finished = true;
+            } else if (eventName === 'error') {
+                showError(payload.error || 'Erro ao processar análise');
+                finished = true;
+            }
+        }
+    }
+
+    if (!finished) {
+        showError('A conexão foi encerrada antes do fim da análise.');
+    }
+}
+
 // Display Functions
 function showResults() {
     resultsSection.style.display = 'block';
@@ -234,6 +290,46 @@ function showLoading() {
     document.getElementById('full-analysis-content').innerHTML = '';
 }
 
+function displayPartialResults(partial) {
+    // Graus ainda não recebidos aparecem como "?"
+    const code = ['A', 'S', 'C', 'O', 'D'].map(key => {
+        const grade = partial.ascod[key]?.grade;
+        return `${key}${(grade !== null && typeof grade !== 'undefined') ? grade : '?'}`;
+    }).join('');
+    document.getElementById('ascod-badge').textContent = code;
+    if (partial.toast_code) {
+        document.getElementById('toast-badge').textContent = partial.toast_code;
+    }
+    document.getElementById('ascod-details').innerHTML = renderAscodJustifications(partial.ascod);
+}
+
+function renderAscodJustifications(ascod) {
+    const ascodOrder = ['A', 'S', 'C', 'O', 'D'];
+    const ascodNames = { A: 'Aterosclerose', S: 'Pequenos Vasos', C: 'Cardiopatia', O: 'Outras Causas', D: 'Dissecção' };
+    
+    return ascodOrder.map(key => {
+        const item = ascod[key];
+        if (!item) return '';
+        
+        // Garante que o grau 0 seja exibido corretamente
+        const grade = (item.grade !== null && typeof item.grade !== 'undefined') ? item.grade : 'N/A';
+
+        // Tenta obter a justificativa a partir de várias possíveis chaves que o modelo possa retornar
+        const justification = item.justification || item.justificativa || item.raciocinio || item.rationale || item.reason || '';
+
+        return `
+            <div class="justification-item">
+                <div class="justification-header">
+                    <span class="component-key">${key}</span>
+                    <span class="component-grade grade-${grade}">${grade}</span>
+                    <span class="component-name">${ascodNames[key]}</span>
+                </div>
+                <p class="justification-text">${justification || 'Justificativa não fornecida.'}</p>
+            </div>
+        `;
+    }).join('');
+}
+
 function displayResults(result) {
     // Update Badges
     document.getElementById('ascod-badge').textContent = result.ascod_code || 'N/A';
@@ -242,30 +338,7 @@ function displayResults(result) {
     // Display ASCOD Justifications
     let ascodHtml = '';
     if (result.ascod) {
-        const ascodOrder = ['A', 'S', 'C', 'O', 'D'];
-        const ascodNames = { A: 'Aterosclerose', S: 'Pequenos Vasos', C: 'Cardiopatia', O: 'Outras Causas', D: 'Dissecção' };
-        
-        ascodHtml = ascodOrder.map(key => {
-            const item = result.ascod[key];
-            if (!item) return '';
-            
-            // Garante que o grau 0 seja exibido corretamente
-            const grade = (item.grade !== null && typeof item.grade !== 'undefined') ? item.grade : 'N/A';
-
-            // Tenta obter a justificativa a partir de várias possíveis chaves que o modelo possa retornar
-            const justification = item.justification || item.justificativa || item.raciocinio || item.rationale || item.reason || '';
-
-            return `
-                <div class="justification-item">
-                    <div class="justification-header">
-                        <span class="component-key">${key}</span>
-                        <span class="component-grade grade-${grade}">${grade}</span>
-                        <span class="component-name">${ascodNames[key]}</span>
-                    </div>
-                    <p class="justification-text">${justification || 'Justificativa não fornecida.'}</p>
-                </div>
-            `;
-        }).join('');
+        ascodHtml = renderAscodJustifications(result.ascod);
     } else {
         ascodHtml = '<p>Justificativas ASCOD não disponíveis.</p>';
     }
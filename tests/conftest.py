@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""
+Configuração comum dos testes: módulos na raiz do repositório e bancos SQLite em diretório temporário
+"""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# Definido antes de importar os módulos: métricas, cache e histórico são criados na importação
+_tmp = tempfile.mkdtemp(prefix='ascod-tests-')
+os.environ.setdefault('ASCOD_METRICS_PATH', os.path.join(_tmp, 'metrics.sqlite3'))
+os.environ.setdefault('ASCOD_CACHE_PATH', os.path.join(_tmp, 'cache.sqlite3'))
+os.environ.setdefault('ASCOD_JOBS_PATH', os.path.join(_tmp, 'jobs.sqlite3'))
+os.environ.setdefault('ASCOD_HISTORY_ENABLED', 'false')
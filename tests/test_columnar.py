@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Testes da avaliação vetorizada (columnar.evaluate_cohort) contra o motor de regras por paciente
+"""
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from ascod_classifier import PatientData
+from columnar import CohortColumns, evaluate_cohort, random_patients, verify_against_rules
+
+# Avaliação completa sem causa grau 1: A2 (estenose 30-49%), S2 (lacunar sem critério), C3, O0 e D0
+COMPLETE_WITHOUT_CAUSE = dict(stenosis=49, infarct_type='subcortical_small_lacunar', lvef=30, c3_pfo_isolated=True,
+                              o0_other_causes_excluded=True, d0_dissection_excluded=True)
+
+
+def test_seeded_cohort_matches_rule_engine():
+    cohort = CohortColumns.from_patients(random_patients(5000, seed=1))
+    result = evaluate_cohort(cohort)
+
+    assert verify_against_rules(cohort, result) == []
+    # A coorte aleatória cobre as demais classes; o 5b fica no teste abaixo
+    assert all(result.counts()[key] for key in ('1', '2', '3', '4', '5a', '5c'))
+
+
+def test_toast_5b_edge_cases():
+    patients = [
+        PatientData(**COMPLETE_WITHOUT_CAUSE),
+        # Uma categoria não avaliada (grau 9) já leva a 5c
+        PatientData(**dict(COMPLETE_WITHOUT_CAUSE, d0_dissection_excluded=False)),
+        PatientData(**dict(COMPLETE_WITHOUT_CAUSE, stenosis=None)),
+        # Limiares: estenose de 50% e FEVE abaixo de 30% são causas grau 1
+        PatientData(**dict(COMPLETE_WITHOUT_CAUSE, stenosis=50)),
+        PatientData(**dict(COMPLETE_WITHOUT_CAUSE, lvef=29)),
+        PatientData(**dict(COMPLETE_WITHOUT_CAUSE, lvef=34)),
+        # Graus 2 e 3 em todas as categorias avaliadas continuam 5b
+        PatientData(**dict(COMPLETE_WITHOUT_CAUSE, stenosis=1, o2_migraine_with_aura=True, d2_weak_evidence=True)),
+    ]
+    cohort = CohortColumns.from_patients(patients)
+    result = evaluate_cohort(cohort)
+
+    assert verify_against_rules(cohort, result) == []
+    assert list(result.toast_keys()) == ['5b', '5c', '5c', '1', '2', '5b', '5b']
+    assert list(result.ascod_codes()[:2]) == ['A2S2C3O0D0', 'A2S2C3O0D9']
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Testes do índice de quase-duplicatas: reaproveita textos equivalentes, nunca os que mudam negação ou incerteza
+"""
+
+import pytest
+
+from near_duplicates import NearDuplicateIndex, context_words, minhash, qualifiers, shingles, similarity
+
+SCOPE = 'modelo|instrucao'
+NOTE = ('Homem, 66 anos, hipertenso. Hemiparesia esquerda súbita. '
+        'RM de crânio com infarto cortical no território da artéria cerebral média direita. '
+        'Holter de 24 horas com FA paroxística confirmada. '
+        'Ecocardiograma transtorácico sem trombos. Doppler de carótidas sem estenoses.')
+
+LATERAL_NOTE = ('Paciente com 70 anos e hipertensão. Afasia súbita. '
+                'RM com infarto cortical no território da artéria cerebral média esquerda. '
+                'Angiotomografia com estenose de 70% na carótida interna esquerda. '
+                'Holter de 24 horas em ritmo sinusal. Ecocardiograma transtorácico normal.')
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = NearDuplicateIndex(path=str(tmp_path / 'near.sqlite3'), ttl=0)
+    index.add(NOTE, SCOPE, 'resposta')
+    return index
+
+
+def test_reuses_reordered_and_reformatted_text(index):
+    sentences = NOTE.split('. ')
+    variant = '.  '.join(sentences[::-1]).upper()
+
+    hit = index.lookup(variant, SCOPE)
+    assert hit is not None
+    assert hit[0] == 'resposta'
+
+
+@pytest.mark.parametrize('variant', [
+    NOTE.replace('FA paroxística confirmada', 'FA paroxística não confirmada'),
+    NOTE.replace('FA paroxística confirmada', 'provável FA paroxística'),
+    NOTE.replace('FA paroxística confirmada', 'FA paroxística confirmada?'),
+    NOTE.replace('Doppler de carótidas sem estenoses', 'Doppler de carótidas com estenoses'),
+])
+def test_refuses_reuse_when_negation_or_hedging_changes(index, variant):
+    assert index.lookup(variant, SCOPE) is None
+
+
+@pytest.mark.parametrize('variant', [
+    LATERAL_NOTE.replace('carótida interna esquerda', 'carótida interna direita'),
+    LATERAL_NOTE.replace('Paciente com 70 anos', 'Mãe com 70 anos'),
+])
+def test_refuses_reuse_when_side_or_subject_changes(tmp_path, variant):
+    index = NearDuplicateIndex(path=str(tmp_path / 'near.sqlite3'), ttl=0)
+    index.add(LATERAL_NOTE, SCOPE, 'A1')
+    assert similarity(minhash(shingles(LATERAL_NOTE)), minhash(shingles(variant))) >= index.threshold
+
+    assert index.lookup(LATERAL_NOTE, SCOPE) is not None
+    assert index.lookup(variant, SCOPE) is None
+
+
+def test_context_words_follow_each_sentence():
+    assert context_words('Infarto na ACM esquerda. Estenose na carótida direita.') == ['direit', 'esquerd']
+    assert context_words('Carótida direita e ACM esquerda.') != context_words('Carótida esquerda e ACM direita.')
+
+
+def test_refuses_reuse_in_another_scope(index):
+    assert index.lookup(NOTE, 'outro-modelo|instrucao') is None
+
+
+def test_qualifiers_are_compared_by_stem():
+    assert qualifiers('trombofilia negativa') == qualifiers('Trombofilia: NEGATIVO')
+    assert qualifiers('FA paroxística confirmada') == []
+    assert qualifiers('FA não confirmada') == ['nao']
+    assert qualifiers('suspeita de FA?') == ['?', 'suspeit']
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Testes da poda de notas longas (note_trimmer): frases relevantes primeiro, o resto do orçamento na ordem original
+"""
+
+from note_trimmer import NoteTrimmer, estimate_tokens
+
+RISK_FACTORS = 'Portador de hipertensão arterial e diabetes mellitus há 15 anos.'
+IMAGING = 'RM com infarto subcortical lacunar de 12 mm na cápsula interna esquerda.'
+FILLER = 'Refere que gosta de caminhar na praia aos domingos com a família.'
+
+
+def test_short_note_is_not_trimmed():
+    result = NoteTrimmer(300).trim(f'{RISK_FACTORS} {IMAGING}')
+
+    assert not result.trimmed
+    assert result.text == f'{RISK_FACTORS} {IMAGING}'
+
+
+def test_vascular_risk_factors_are_relevant():
+    assert NoteTrimmer.score(RISK_FACTORS) > 0
+    assert NoteTrimmer.score('Doença arterial periférica com revascularização prévia.') > 0
+    assert NoteTrimmer.score(FILLER) == 0
+
+
+def test_keeps_risk_factors_and_fills_the_budget_in_original_order():
+    note = ' '.join([RISK_FACTORS, FILLER, IMAGING] + [FILLER] * 80)
+    result = NoteTrimmer(300).trim(note)
+
+    assert result.trimmed
+    assert RISK_FACTORS in result.text and IMAGING in result.text
+    # Sobrou orçamento: frases sem pontuação também entram, sem passar do limite
+    assert result.text.startswith(f'{RISK_FACTORS} {FILLER} {IMAGING} {FILLER}')
+    assert result.kept_tokens <= 300
+    # Cada frase custa os próprios tokens mais um de separação: mais uma frase não caberia
+    used = sum(estimate_tokens(s) + 1 for s in [RISK_FACTORS, IMAGING] + [FILLER] * (result.kept_sentences - 2))
+    assert used <= 300 < used + estimate_tokens(FILLER) + 1
+
+
+def test_relevant_sentences_win_when_the_budget_is_tight():
+    note = ' '.join([FILLER] * 5 + [IMAGING, RISK_FACTORS])
+    result = NoteTrimmer(40).trim(note)
+
+    assert result.text == f'{IMAGING} {RISK_FACTORS}'
+    assert result.kept_sentences == 2
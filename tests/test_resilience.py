@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Testes da política de chamadas (resilience.CallPolicy) com uma função falsa no lugar do modelo
+"""
+
+import random
+import threading
+import time
+
+import pytest
+
+import resilience
+from model_backends import TransientUpstreamError
+from resilience import CallPolicy, CircuitBreaker, CircuitOpenError, Deadline, DeadlineExceeded
+
+
+class FakeCall:
+    """Executa os passos em ordem: uma exceção é lançada, um callable é chamado com o timeout, outro valor é retornado."""
+
+    def __init__(self, *steps):
+        self.steps = list(steps)
+        self.timeouts = []
+        self._lock = threading.Lock()
+
+    @property
+    def calls(self):
+        return len(self.timeouts)
+
+    def __call__(self, timeout):
+        with self._lock:
+            self.timeouts.append(timeout)
+            step = self.steps.pop(0) if len(self.steps) > 1 else self.steps[0]
+        if isinstance(step, Exception):
+            raise step
+        if callable(step):
+            return step(timeout)
+        return step
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Registra as esperas entre tentativas sem dormir de verdade."""
+    recorded = []
+    caller = threading.get_ident()
+    real_sleep = time.sleep
+
+    def fake_sleep(seconds):
+        # Outras threads (ex.: gravação das métricas) continuam dormindo normalmente
+        if threading.get_ident() != caller:
+            return real_sleep(seconds)
+        recorded.append(seconds)
+
+    monkeypatch.setattr(resilience.time, 'sleep', fake_sleep)
+    return recorded
+
+
+def test_retries_transient_errors_with_seeded_full_jitter(sleeps):
+    policy = CallPolicy('test', attempts=4, backoff=0.5, max_backoff=0.8, seed=7)
+    fn = FakeCall(TransientUpstreamError('503'), TransientUpstreamError('503'), TransientUpstreamError('503'), 'ok')
+
+    assert policy.call(fn, Deadline(60)) == 'ok'
+    assert fn.calls == 4
+    # Jitter completo: uniforme entre 0 e min(max_backoff, backoff * 2^tentativa)
+    rng = random.Random(7)
+    assert sleeps == [rng.uniform(0, 0.5), rng.uniform(0, 0.8), rng.uniform(0, 0.8)]
+    assert policy.breaker.state == 'closed'
+
+
+def test_gives_up_after_the_last_attempt(sleeps):
+    policy = CallPolicy('test', attempts=3, backoff=0.01, seed=1)
+    fn = FakeCall(TransientUpstreamError('503'))
+
+    with pytest.raises(TransientUpstreamError):
+        policy.call(fn, Deadline(60))
+    assert fn.calls == 3
+    assert len(sleeps) == 2
+
+
+def test_does_not_retry_request_errors(sleeps):
+    policy = CallPolicy('test', attempts=3, seed=1)
+    fn = FakeCall(ValueError('argumento inválido'))
+
+    with pytest.raises(ValueError):
+        policy.call(fn, Deadline(60))
+    assert fn.calls == 1
+    assert sleeps == []
+    assert policy.breaker.state == 'closed'
+
+
+def test_circuit_opens_after_consecutive_failures_and_rejects_without_calling():
+    policy = CallPolicy('test', attempts=1, breaker=CircuitBreaker('test', failure_threshold=2, reset_timeout=60))
+    fn = FakeCall(TransientUpstreamError('503'))
+
+    for _ in range(2):
+        with pytest.raises(TransientUpstreamError):
+            policy.call(fn, Deadline(60))
+    assert policy.breaker.state == 'open'
+
+    with pytest.raises(CircuitOpenError):
+        policy.call(fn, Deadline(60))
+    assert fn.calls == 2
+
+
+def test_half_open_lets_a_single_probe_through():
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0.05)
+    policy = CallPolicy('test', attempts=1, breaker=breaker)
+    with pytest.raises(TransientUpstreamError):
+        policy.call(FakeCall(TransientUpstreamError('503')), Deadline(60))
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    # A chamada de teste passa; enquanto ela não termina, as demais são rejeitadas
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert policy.call(FakeCall('ok'), Deadline(60)) == 'ok'
+
+
+def test_local_errors_do_not_close_a_half_open_circuit():
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0.05)
+    policy = CallPolicy('test', attempts=1, breaker=breaker)
+    with pytest.raises(TransientUpstreamError):
+        policy.call(FakeCall(TransientUpstreamError('503')), Deadline(60))
+
+    time.sleep(0.06)
+    # Prazo esgotado aguardando vaga para o upstream: nenhuma resposta do modelo
+    with pytest.raises(DeadlineExceeded):
+        policy.call(FakeCall(DeadlineExceeded('fila')), Deadline(60))
+    assert breaker.state == 'half_open'
+    # O teste volta a ficar disponível e só uma resposta completa fecha o circuito
+    assert policy.call(FakeCall('ok'), Deadline(60)) == 'ok'
+    assert breaker.state == 'closed'
+
+
+def test_request_errors_keep_the_failure_count():
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=60)
+    policy = CallPolicy('test', attempts=1, breaker=breaker)
+    for error in (TransientUpstreamError('503'), ValueError('argumento inválido'), TransientUpstreamError('503')):
+        with pytest.raises(type(error)):
+            policy.call(FakeCall(error), Deadline(60))
+    assert breaker.state == 'open'
+
+
+def test_failed_probe_reopens_the_circuit():
+    breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=0.05)
+    policy = CallPolicy('test', attempts=1, breaker=breaker)
+    fn = FakeCall(TransientUpstreamError('503'))
+    for _ in range(3):
+        with pytest.raises(TransientUpstreamError):
+            policy.call(fn, Deadline(60))
+
+    time.sleep(0.06)
+    # Uma única falha no meio-aberto basta para abrir de novo
+    with pytest.raises(TransientUpstreamError):
+        policy.call(fn, Deadline(60))
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        policy.call(fn, Deadline(60))
+    assert fn.calls == 4
+
+
+def test_expired_deadline_fails_before_calling():
+    policy = CallPolicy('test')
+    fn = FakeCall('ok')
+
+    with pytest.raises(DeadlineExceeded):
+        policy.call(fn, Deadline(0))
+    assert fn.calls == 0
+
+
+def test_fn_receives_the_remaining_time_and_deadline_ends_retries():
+    policy = CallPolicy('test', attempts=5, backoff=0.01, max_backoff=0.01, seed=3)
+
+    def slow_failure(timeout):
+        time.sleep(0.06)
+        raise TransientUpstreamError('503')
+
+    fn = FakeCall(slow_failure)
+    with pytest.raises(DeadlineExceeded):
+        policy.call(fn, Deadline(0.1))
+    assert fn.timeouts[0] <= 0.1
+    assert fn.timeouts == sorted(fn.timeouts, reverse=True)
+    assert fn.calls < 5
+
+
+def test_hedge_fires_a_second_request_and_takes_the_fastest():
+    policy = CallPolicy('test', hedge=True, hedge_after=0.05)
+
+    def slow(timeout):
+        time.sleep(0.5)
+        return 'lenta'
+
+    fn = FakeCall(slow, 'rápida')
+    started = time.monotonic()
+    assert policy.call(fn, Deadline(5)) == 'rápida'
+    assert time.monotonic() - started < 0.4
+    assert fn.calls == 2
+    # A segunda requisição recebe só o que resta do prazo
+    assert fn.timeouts[1] < fn.timeouts[0]
+
+
+def test_hedge_not_fired_when_the_first_request_is_fast():
+    policy = CallPolicy('test', hedge=True, hedge_after=0.2)
+    fn = FakeCall('ok')
+
+    assert policy.call(fn, Deadline(5)) == 'ok'
+    assert fn.calls == 1
+
+
+def test_hedge_delay_uses_recent_p95_without_fixed_delay():
+    policy = CallPolicy('test', hedge=True)
+    assert policy.hedge_delay() is None
+    for latency in range(1, 101):
+        policy._after_success(latency / 100)
+    assert policy.hedge_delay() == pytest.approx(0.95)
+    assert CallPolicy('test', hedge=False, hedge_after=0.1).hedge_delay() is None
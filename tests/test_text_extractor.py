@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Testes da extração local de texto livre (text_extractor): valores, limites e negações
+"""
+
+import pytest
+
+from text_extractor import TextExtractor
+
+
+@pytest.fixture(scope='module')
+def extractor():
+    return TextExtractor()
+
+
+def test_captures_stenosis_and_lvef(extractor):
+    extraction = extractor.extract('FA paroxística, estenose de 70% da carótida interna direita, FEVE 30%')
+
+    assert extraction.fields == {'c1_afib_documented': True, 'stenosis': 70, 'lvef': 30}
+    assert extraction.unexplained == []
+    assert extraction.confidence == 1.0
+
+
+@pytest.mark.parametrize('text', [
+    'Sem estenose significativa (<50%) nas carótidas',
+    'estenose carotídea inferior a 50%',
+    'estenose de até 30% na carótida',
+    'FEVE menor que 35%',
+])
+def test_bounds_and_negated_values_are_not_captured(extractor, text):
+    extraction = extractor.extract(text)
+
+    assert 'stenosis' not in extraction.fields
+    assert 'lvef' not in extraction.fields
+    assert extraction.unexplained == [text]
+    assert extraction.confidence == 0.0
+
+
+def test_bound_segment_lowers_confidence_of_the_whole_text(extractor):
+    extraction = extractor.extract('FA paroxística, estenose carotídea inferior a 50%')
+
+    assert extraction.fields == {'c1_afib_documented': True}
+    assert extraction.unexplained == ['estenose carotídea inferior a 50%']
+    assert extraction.confidence == 0.5
+
+
+@pytest.mark.parametrize('text', ['FA não documentada', 'FA não confirmada', 'Holter: FA não há'])
+def test_negation_after_the_term(extractor, text):
+    extraction = extractor.extract(text)
+
+    assert 'c1_afib_documented' not in extraction.fields
+    assert 'não c1_afib_documented' in extraction.findings
+
+
+def test_negated_thrombophilia_does_not_exclude_other_causes(extractor):
+    extraction = extractor.extract('sem trombofilia')
+
+    assert extraction.fields == {}
+    assert extraction.findings == ['não o1_thrombophilia']
+
+
+def test_negated_dissection_is_an_explicit_exclusion(extractor):
+    extraction = extractor.extract('angiotomografia sem dissecção')
+
+    assert extraction.fields == {'d0_dissection_excluded': True}
+
+
+@pytest.mark.parametrize('text', [
+    'Paciente sem comorbidades exceto FA',
+    'Sem alterações no ECG mas com FA no Holter',
+    'Sem alterações no ECG, porém FA no Holter',
+])
+def test_negation_ends_at_exceto_mas_and_porem(extractor, text):
+    extraction = extractor.extract(text)
+
+    assert extraction.fields == {'c1_afib_documented': True}
+    assert 'não c1_afib_documented' not in extraction.findings
+
+
+@pytest.mark.parametrize('text', [
+    'Pai com FA',
+    'Irmão teve dissecção',
+    'Antecedente familiar de trombofilia',
+    'Mãe com estenose carotídea de 70%',
+])
+def test_findings_of_relatives_are_not_credited_to_the_patient(extractor, text):
+    extraction = extractor.extract(text)
+
+    assert extraction.fields == {}
+    assert extraction.unexplained == [text]
+    assert extraction.confidence == 0.0
+
+
+def test_relative_segment_keeps_the_patient_findings(extractor):
+    extraction = extractor.extract('História familiar de AVC, FA paroxística')
+
+    assert extraction.fields == {'c1_afib_documented': True}
+    assert extraction.unexplained == ['História familiar de AVC']
+    assert extraction.confidence == 0.5
+
+
+@pytest.mark.parametrize('text', ['estenose de 40 a 60%', 'estenose de 40-60% na carótida', 'estenose de 60% a 70%'])
+def test_ranges_are_not_captured(extractor, text):
+    extraction = extractor.extract(text)
+
+    assert 'stenosis' not in extraction.fields
+    assert extraction.unexplained == [text]
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Extração local de achados ASCOD em texto livre (português) para campos do PatientData
+
+Um léxico de expressões compiladas, filtradas por palavras-chave, reconhece os termos
+clínicos, com tratamento de negação ("sem dissecção", "trombofilia negativa") e captura de
+valores numéricos (estenose em %, FEVE). A confiança é a fração dos trechos do
+texto que o léxico explica; abaixo do limite, o caso deve ir para o modelo.
+
+Exemplo:
+    python text_extractor.py "FA paroxística, estenose carótida 70% ipsilateral"
+"""
+
+import re
+import sys
+import json
+import time
+from bisect import bisect_right
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from ascod_classifier import PatientData
+
+# Termos clínicos -> campo do PatientData. Cada termo tem palavras-chave (trechos sem acento
+# presentes em todas as variantes): a expressão só roda se uma delas aparece no texto, o que
+# mantém a extração em dezenas de microssegundos. Campos com '_' são achados combinados em _combine.
+LEXICON: List[Tuple[str, Tuple[str, ...], str]] = [
+    # A - Aterosclerose
+    ('a1_aortic_mobile_thrombus', ('trombo m',), r'trombo m[óo]vel (?:no |em )?(?:arco )?a[óo]rt\w*'),
+    ('a1_stenosis_lt_50_thrombus', ('luminal',), r'trombo (?:intra)?luminal'),
+    ('a2_aortic_plaque_ge_4mm', ('placa',), r'placa (?:no arco |de )?a[óo]rt\w*'),
+    ('a3_history_mi_pad', ('iam', 'infarto', 'hist', 'perif', 'dao'),
+     r'(?:iam|infarto (?:agudo )?do mioc[áa]rdio) (?:pr[ée]vio|antigo)|hist[óo]ria de (?:iam|infarto do mioc[áa]rdio)'
+     r'|doen[çc]a arterial perif[ée]rica|daop?\b'),
+    # S - Pequenos vasos
+    ('s1_lacunar_infarct_syndrome', ('ndrome lacunar',), r's[íi]ndrome lacunar'),
+    ('_severe_leuko', ('leucoaraiose', 'fazekas'), r'leucoaraiose (?:grave|acentuada|importante|extensa)|fazekas (?:3|iii)\b'),
+    ('_lacunar', ('lacunar', 'subcortical'), r'(?:infarto|lacuna|les[ãa]o) (?:\w+ )?lacunar|infarto subcortical (?:pequeno|<\s*1[,.]5)'),
+    ('_cortical', ('cortical', 'territorial', 'extenso'),
+     r'infarto (?:\w+ )?(?:cortical|territorial|extenso)|les[ãa]o (?:isqu[êe]mica )?cortical'),
+    ('s_has_htn_or_dm', ('has', 'hipertens', 'dm', 'diabet'), r'has\b|hipertens[ãa]o|hipertens[oa]|dm\d?\b|diabet\w*'),
+    # C - Cardiopatia
+    ('c1_afib_documented', ('fibrila', 'fa', 'flutter'), r'fibrila[çc][ãa]o atrial|fa\b|flutter(?: atrial)?'),
+    ('c1_mechanical_valve', ('mec',), r'pr[óo]tese (?:valvar )?mec[âa]nica|valva mec[âa]nica'),
+    ('c1_mural_thrombus', ('trombo',),
+     r'trombo (?:mural|intracavit[áa]rio|apical|em (?:ve|ae|ventr[íi]culo|[áa]trio|ap[êe]ndice)\w*|no (?:ve|ae)\b)'),
+    ('c1_recent_mi', ('recente',), r'(?:iam|infarto (?:agudo )?do mioc[áa]rdio) recente'),
+    ('c1_infective_endocarditis', ('endocardite',), r'endocardite'),
+    ('c1_cardiomyopathy', ('patia dilatada',), r'(?:cardio|mioc[áa]rdio)patia dilatada'),
+    ('c1_intracardiac_mass', ('mixoma', 'fibroelastoma', 'massa'), r'mixoma|fibroelastoma|massa intracard[íi]aca'),
+    ('c1_mitral_stenosis', ('estenose mitral',), r'estenose mitral'),
+    ('_pfo', ('forame', 'fop'), r'forame oval (?:patente|p[ée]rvio)|fop\b'),
+    ('_asa', ('aneurisma', 'asa'), r'aneurisma (?:do |de )?septo|asa\b'),
+    ('_venous', ('tep', 'tvp', 'venosa', 'embolia'), r'tep\b|tvp\b|trombose venosa|embolia pulmonar'),
+    # O - Outras causas
+    ('o1_antiphospholipid', ('antifosfol', 'saf'), r'antifosfol[íi]pide\w*|saf\b'),
+    ('o1_other_angiitis', ('vasculite', 'te'), r'vasculite|angi[íi]te'),
+    ('o1_thrombophilia', ('trombofilia',), r'trombofilia'),
+    ('o1_hematologic', ('citemia',), r'policitemia|trombocitemia'),
+    ('o1_moyamoya', ('moya',), r'moya-?moya'),
+    ('o2_migraine_with_aura', ('com aura',), r'(?:enxaqueca|migr[âa]nea) com aura'),
+    ('o3_malignancy', ('neoplasia', 'ncer', 'malignidade', 'carcinoma', 'stase'),
+     r'neoplasia|c[âa]ncer|malignidade|adenocarcinoma|met[áa]stase\w*'),
+    ('_other_workup', ('outras causas',), r'investiga[çc][ãa]o (?:para |de )?outras causas|rastreio (?:para |de )?outras causas'),
+    # D - Dissecção
+    ('d1_direct', ('dissec', 'hematoma', 'flap', 'men'), r'dissec[çc][ãa]o|hematoma (?:intra)?mural|flap intimal|duplo l[úu]men'),
+    ('d2_weak_evidence', ('horner', 'trauma cervical'), r's[íi]ndrome de horner|trauma cervical'),
+]
+
+# Termos negados que indicam exclusão explícita (grau 0) em vez de simples ausência do achado
+NEGATED_FIELDS = {
+    'd1_direct': 'd0_dissection_excluded',
+    '_other_workup': 'o0_other_causes_excluded',
+}
+
+# As expressões abaixo rodam sobre o texto em minúsculas (sem re.IGNORECASE, que é mais lento)
+
+# Trechos sem valor para a classificação, mas que o léxico "entende" (não reduzem a confiança)
+NEUTRAL_RE = re.compile(
+    r'\b(?:paciente|anos|masculino|feminino|homem|mulher|avci?|ictus|isqu[êe]mic|hemiparesia|hemiplegia|afasia|disartria'
+    r'|d[ée]ficit|hemianopsia|ataxia|admitid|internad|tabagis|dislipidemi|etilis|obesidade|sedent[áa]ri)'
+)
+# Negação antes do termo (no mesmo trecho) ou logo depois dele
+NEGATION_BEFORE_RE = re.compile(r'\b(?:sem|nega|n[ãa]o|aus[êe]ncia de|ausente|negativ[oa] para|exclu[íi]d[oa]|descartad[oa])\b')
+# Palavras que encerram o alcance da negação ("sem comorbidades exceto FA", "sem alterações no ECG mas com FA")
+NEGATION_SCOPE_END = r'\b(?:exceto|mas|por[ée]m|contudo|entretanto|salvo)\b'
+NEGATION_SCOPE_END_RE = re.compile(NEGATION_SCOPE_END)
+NEGATION_AFTER_RE = re.compile(
+    r'(?:(?!' + NEGATION_SCOPE_END + r')[^,;.]){0,25}?\b(?:ausente|negativ[oa]|descartad[oa]|exclu[íi]d[oa]'
+    r'|n[ãa]o (?:visualizad|identificad|evidenciad|demonstrad|documentad|confirmad|h[áa]\b))'
+)
+# Termos de incerteza: o texto precisa da interpretação do modelo
+HEDGE_RE = re.compile(r'suspeit|poss[íi]vel|prov[áa]vel|a esclarecer|em investiga[çc][ãa]o|aguarda|n[ãa]o realizad')
+# Trechos que invalidam o mapeamento direto (ex.: estenose do lado oposto ao infarto)
+CONFLICT_RE = re.compile(r'contralateral|bilateral')
+# Limite em vez de medida ("<50%", "inferior a 50%"): o valor não vai para o campo
+BOUND_RE = re.compile(r'<|inferior a|at[ée]\b|menor que')
+# Faixa de valores ("de 40 a 60%", "40-60%", "60% a 70%"): número logo antes ou logo depois do valor
+RANGE_BEFORE_RE = re.compile(r'\d\s*%?\s*(?:a|e|ou|-|–)\s*$')
+RANGE_AFTER_RE = re.compile(r'\s*%?\s*(?:a|e|ou|-|–)\s*\d')
+# Achados de familiares ("pai com FA", "antecedente familiar de trombofilia") não são do paciente
+FAMILY_RE = re.compile(r'\b(?:pai|m[ãa]e|irm[ãa]os?|irm[ãa]s|av[óôo]s?|tios?|tias?|filh[oa]s?|primos?|primas?|famil\w*)\b')
+
+STENOSIS_RE = re.compile(r'estenose[^,;.%]{0,40}?(\d{1,3})\s*%|(\d{1,3})\s*%\s*de estenose')
+LVEF_RE = re.compile(r'(?:\bfeve\b|\bfe\b|fra[çc][ãa]o de eje[çc][ãa]o)[^,;.%\d]{0,20}(\d{1,2})\s*%')
+PLAQUE_MM_RE = re.compile(r'placa[^,;.]{0,30}?(\d+(?:[.,]\d+)?)\s*mm')
+
+SEGMENT_RE = re.compile(r'[^,;.\n]+')
+
+
+@dataclass
+class Extraction:
+    """Campos do PatientData encontrados no texto e a confiança da extração (0 a 1)."""
+    fields: Dict[str, object]
+    confidence: float
+    findings: List[str] = field(default_factory=list)
+    unexplained: List[str] = field(default_factory=list)
+    hedged: bool = False
+
+    def patient(self) -> PatientData:
+        return PatientData(**self.fields)
+
+    def to_dict(self) -> Dict:
+        return {
+            'confidence': self.confidence,
+            'fields': self.fields,
+            'findings': self.findings,
+            'unexplained': self.unexplained,
+            'hedged': self.hedged,
+        }
+
+
+class TextExtractor:
+    """Léxico compilado uma vez por processo; extract() leva dezenas de microssegundos por laudo."""
+
+    def __init__(self):
+        self._lexicon = [(name, re.compile(pattern)) for name, _, pattern in LEXICON]
+        self._keywords = [(keyword, i) for i, (_, keywords, _) in enumerate(LEXICON) for keyword in keywords]
+
+    def extract(self, text: str) -> Extraction:
+        text = text or ''
+        low = text.lower()
+        if len(low) != len(text):
+            # Raro (ex.: 'İ'): os trechos não explicados saem em minúsculas
+            text = low
+        # Trechos entre vírgulas, pontos e ponto e vírgula; negação e conflitos valem dentro do trecho
+        segments = [m.span() for m in SEGMENT_RE.finditer(low)]
+        starts = [start for start, _ in segments]
+        explained = set()
+        # Trechos com valor que não pode ser capturado (limite, faixa, negação ou achado de familiar):
+        # contam como não explicados
+        uncertain = set()
+        if FAMILY_RE.search(low):
+            uncertain.update(i for i, (start, end) in enumerate(segments) if FAMILY_RE.search(low, start, end))
+        fields: Dict[str, object] = {}
+        findings: List[str] = []
+        matched = set()
+
+        # Só as expressões com alguma palavra-chave no texto
+        for i in sorted({i for keyword, i in self._keywords if keyword in low}):
+            name, pattern = self._lexicon[i]
+            for match in pattern.finditer(low):
+                start, end = match.span()
+                # Termos começam no início de uma palavra
+                if start and low[start - 1].isalnum():
+                    continue
+                segment = bisect_right(starts, start) - 1
+                if segment in uncertain:
+                    continue
+                explained.add(segment)
+                if self._negated(low, start, end, max(segments[segment][0], start - 40)):
+                    findings.append(f'não {name}')
+                    if name in NEGATED_FIELDS:
+                        fields[NEGATED_FIELDS[name]] = True
+                    continue
+                findings.append(name)
+                matched.add(name)
+                if not name.startswith('_'):
+                    fields[name] = True
+
+        if '%' in low:
+            for regex, name in ((STENOSIS_RE, 'stenosis'), (LVEF_RE, 'lvef')):
+                for number in regex.finditer(low):
+                    segment = bisect_right(starts, number.start()) - 1
+                    if segment in uncertain or CONFLICT_RE.search(low, *segments[segment]):
+                        continue
+                    group = 1 if number.group(1) else 2
+                    # O limite fica entre o termo e o número ou logo antes do número
+                    bound_start = max(segments[segment][0], min(number.start(), number.start(group) - 15))
+                    if (BOUND_RE.search(low, bound_start, number.start(group))
+                            or RANGE_BEFORE_RE.search(low, bound_start, number.start(group))
+                            or RANGE_AFTER_RE.match(low, number.end(group), segments[segment][1])
+                            or self._negated(low, number.start(), number.end(), max(segments[segment][0], number.start() - 40))):
+                        uncertain.add(segment)
+                        continue
+                    value = int(number.group(group))
+                    if value > 100:
+                        continue
+                    explained.add(segment)
+                    # Mais de uma estenose: vale a maior
+                    if name not in fields or (name == 'stenosis' and value > fields[name]):
+                        fields[name] = value
+                if name in fields:
+                    findings.append(f'{name}={fields[name]}')
+
+        self._combine(low, fields, matched)
+
+        unexplained = []
+        counted = 0
+        for i, (start, end) in enumerate(segments):
+            if low[start:end].isspace():
+                continue
+            counted += 1
+            if (i in uncertain or CONFLICT_RE.search(low, start, end)
+                    or (i not in explained and not NEUTRAL_RE.search(low, start, end))):
+                unexplained.append(text[start:end].strip())
+        hedged = '?' in low or HEDGE_RE.search(low) is not None
+
+        confidence = 0.0
+        if counted and findings:
+            confidence = 1 - len(unexplained) / counted
+            if hedged:
+                confidence = min(confidence, 0.5)
+        return Extraction(fields, round(confidence, 3), list(dict.fromkeys(findings)), unexplained, hedged)
+
+    @staticmethod
+    def _negated(low: str, start: int, end: int, window_start: int) -> bool:
+        """
+        Negação no mesmo trecho, até 40 caracteres antes do termo (sem atravessar "exceto", "mas",
+        "porém"...), ou logo depois dele.
+        """
+        for scope_end in NEGATION_SCOPE_END_RE.finditer(low, window_start, start):
+            window_start = scope_end.end()
+        return bool(NEGATION_BEFORE_RE.search(low, window_start, start) or NEGATION_AFTER_RE.match(low, end, end + 40))
+
+    @staticmethod
+    def _combine(low: str, fields: Dict[str, object], matched: set):
+        """Achados que dependem de mais de um termo: tipo de infarto, leucoaraiose, FOP e placa aórtica."""
+        if '_lacunar' in matched:
+            fields['infarct_type'] = 'subcortical_small_lacunar'
+        elif '_cortical' in matched:
+            fields['infarct_type'] = 'cortical_large'
+        if '_severe_leuko' in matched:
+            fields['s1_lacunar_plus_severe_leuko' if '_lacunar' in matched else 's3_severe_leuko_isolated'] = True
+        if '_pfo' in matched:
+            if '_venous' in matched:
+                fields['c1_pfo_pe_dvt'] = True
+            elif '_asa' in matched:
+                fields['c2_pfo_asa'] = True
+            else:
+                fields['c3_pfo_isolated'] = True
+        if fields.get('a2_aortic_plaque_ge_4mm'):
+            # Só placas de 4 mm ou mais (quando a espessura é informada)
+            size = PLAQUE_MM_RE.search(low)
+            if size and float(size.group(1).replace(',', '.')) < 4:
+                del fields['a2_aortic_plaque_ge_4mm']
+
+
+if __name__ == '__main__':
+    extractor = TextExtractor()
+    for text in sys.argv[1:] or [line.strip() for line in sys.stdin if line.strip()]:
+        start = time.perf_counter()
+        extraction = extractor.extract(text)
+        elapsed_us = (time.perf_counter() - start) * 1e6
+        print(json.dumps({'text': text, **extraction.to_dict(), 'elapsed_us': round(elapsed_us, 1)}, ensure_ascii=False))